@@ -1,24 +1,65 @@
 import os
+import re
+import sys
 import json
+import math
+import time
+import heapq
+import hmac
+import hashlib
+import random
+import threading
+import atexit
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import requests
+import gzip
+import zlib
 import base64
+import tempfile
+import mimetypes
+import queue
+import struct
+import wave
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
+import numpy as np
 from PIL import Image as PILImage
-from flask import Flask, request, jsonify, Response, stream_with_context, session
+from flask import Flask, Request, request, jsonify, Response, session, g, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_cors import CORS
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import retry as api_retry
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from functools import wraps
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
+import tts_worker
+
+try:
+    import zstandard  # optional: faster codec for stored message bodies
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 # Load environment variables
 load_dotenv()
@@ -48,37 +89,763 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Outbound HTTP Configuration
+OUTBOUND_CONNECT_TIMEOUT = float(os.getenv('OUTBOUND_CONNECT_TIMEOUT', 3.05))
+OUTBOUND_READ_TIMEOUT = float(os.getenv('OUTBOUND_READ_TIMEOUT', 15))
+OUTBOUND_POOL_HOSTS = int(os.getenv('OUTBOUND_POOL_HOSTS', 10))
+OUTBOUND_POOL_MAXSIZE = int(os.getenv('OUTBOUND_POOL_MAXSIZE', 10))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 2))
+SENDGRID_API_URL = "https://api.sendgrid.com/v3/mail/send"
+
 # PostgreSQL Database Configuration
 DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL not found in environment variables")
 
+# Connection pool per worker
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_PING_AFTER = int(os.getenv('DB_POOL_PING_AFTER', 30))  # seconds idle before a connection is re-checked
 
-# Database connection function
-def get_db_connection():
-    """Create and return a database connection"""
+# Optional read replica for read-only queries
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 10))  # read-your-writes window
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 2))
+REPLICA_RETRY_AFTER = float(os.getenv('REPLICA_RETRY_AFTER', 30))  # seconds to skip a replica that failed
+
+# Readiness and warm-up
+MIGRATE_ON_BOOT = os.getenv('MIGRATE_ON_BOOT', 'true').lower() == 'true'
+SCHEMA_LOCK_KEY = 0x436f72746578  # pg_advisory_lock key so booting workers migrate one at a time
+WARMUP_ON_BOOT = os.getenv('WARMUP_ON_BOOT', 'true').lower() == 'true'
+WARMUP_RETRY_SECONDS = float(os.getenv('WARMUP_RETRY_SECONDS', 5))  # first retry of failed warm-up steps, doubling
+WARMUP_RETRY_MAX_SECONDS = float(os.getenv('WARMUP_RETRY_MAX_SECONDS', 60))
+READY_CACHE_SECONDS = float(os.getenv('READY_CACHE_SECONDS', 5))
+READY_CHECK_TIMEOUT = float(os.getenv('READY_CHECK_TIMEOUT', 3))
+MODELS_CACHE_TTL = int(os.getenv('MODELS_CACHE_TTL', 300))
+
+# Token verification cache and revocation feed
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+REVOCATION_SYNC_SECONDS = float(os.getenv('REVOCATION_SYNC_SECONDS', 2))
+REVOCATION_MAX_STALENESS = float(os.getenv('REVOCATION_MAX_STALENESS', 30))
+REVOCATION_FEED_OVERLAP = 5  # seconds re-read on each poll
+AUTH_FLUSH_INTERVAL = float(os.getenv('AUTH_FLUSH_INTERVAL', 1))  # last_login / session row write-behind
+
+# Background cleanup of expired sessions, reset tokens and abandoned streams (0 = off)
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', 600))
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', 1000))
+MAINTENANCE_MAX_BATCHES = int(os.getenv('MAINTENANCE_MAX_BATCHES', 50))  # per task per run
+MAINTENANCE_STALE_STREAM_SECONDS = int(os.getenv('MAINTENANCE_STALE_STREAM_SECONDS', 3600))
+MAINTENANCE_LOCK_ID = 7342001  # pg advisory lock key shared by all workers
+
+# Operator endpoints and on-demand request profiling
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))  # fraction of requests profiled automatically
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+
+# Request tracing (Server-Timing always; span export is opt-in)
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '').lower()  # '', 'file' or 'otlp'
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE', 'traces.jsonl')
+TRACE_EXPORT_URL = os.getenv('TRACE_EXPORT_URL', 'http://localhost:4318/v1/traces')
+TRACE_EXPORT_INTERVAL = float(os.getenv('TRACE_EXPORT_INTERVAL', 1))
+TRACE_EXPORT_QUEUE = int(os.getenv('TRACE_EXPORT_QUEUE', 1000))
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'cortex-api')
+
+# Write conversations through to PostgreSQL in addition to worker memory
+PERSIST_CONVERSATIONS = os.getenv('PERSIST_CONVERSATIONS', 'false').lower() == 'true'
+
+# Bulk export/import tuning
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', 64 * 1024))
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 1000))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+
+# In-memory conversation cache bounds
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv('CONVERSATION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+CONVERSATION_IDLE_TTL = int(os.getenv('CONVERSATION_IDLE_TTL', 3600))  # seconds, 0 = never
+MESSAGE_OVERHEAD_BYTES = 200
+CONVERSATION_OVERHEAD_BYTES = 600
+
+# Relevance-based history: send the recent window plus the best matching older messages
+HISTORY_RETRIEVAL = os.getenv('HISTORY_RETRIEVAL', 'false').lower() == 'true'
+HISTORY_RECENT_MESSAGES = int(os.getenv('HISTORY_RECENT_MESSAGES', 20))
+HISTORY_RETRIEVAL_TOP_K = int(os.getenv('HISTORY_RETRIEVAL_TOP_K', 8))
+HISTORY_RETRIEVAL_MIN_SCORE = float(os.getenv('HISTORY_RETRIEVAL_MIN_SCORE', 0.2))  # cosine similarity
+HISTORY_EMBEDDER = os.getenv('HISTORY_EMBEDDER', 'hashing').lower()  # 'hashing' (local) or 'gemini'
+EMBEDDING_DIM = int(os.getenv('EMBEDDING_DIM', 256))
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'models/text-embedding-004')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+EMBEDDING_FLUSH_INTERVAL = float(os.getenv('EMBEDDING_FLUSH_INTERVAL', 0.5))
+EMBEDDING_MAX_CHARS = 4000  # of each message; the opening is what retrieval matches on
+RETRIEVED_MESSAGE_MAX_CHARS = 1500  # of each older message spliced into the history
+
+# Message bodies at least this large are stored compressed, in memory and in the database
+MESSAGE_COMPRESS_MIN_BYTES = int(os.getenv('MESSAGE_COMPRESS_MIN_BYTES', 1024))  # 0 = never compress
+MESSAGE_COMPRESS_CODEC = os.getenv('MESSAGE_COMPRESS_CODEC', 'auto').lower()  # 'auto', 'zstd', 'lz4' or 'zlib'
+
+# Chat attachment uploads (multipart/form-data)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv('UPLOAD_MAX_FILE_BYTES', 10 * 1024 * 1024))
+UPLOAD_MAX_TOTAL_BYTES = int(os.getenv('UPLOAD_MAX_TOTAL_BYTES', 20 * 1024 * 1024))  # Gemini's inline request limit
+UPLOAD_MAX_FILES = int(os.getenv('UPLOAD_MAX_FILES', 10))
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', 1024 * 1024))  # kept in memory below this, on disk above
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024  # text fields and part headers on top of the files
+UPLOAD_ALLOWED_TYPES = ('image/', 'audio/', 'video/', 'text/', 'application/pdf')
+
+# Admission control for model calls (per worker)
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', 8))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 16))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 15))  # seconds an interactive call may queue
+ADMISSION_BATCH_MAX_WAIT = float(os.getenv('ADMISSION_BATCH_MAX_WAIT', 60))
+ADMISSION_BATCH_WEIGHT = float(os.getenv('ADMISSION_BATCH_WEIGHT', 0.5))  # batch prompts get a smaller fair share
+ADMISSION_INITIAL_SERVICE_SECONDS = 5.0
+
+# Model routing: rules in MODEL_ROUTING_RULES (JSON), health from each model's recent calls
+MODEL_ROUTING_FALLBACKS = [name.strip() for name in os.getenv('MODEL_ROUTING_FALLBACKS', '').split(',') if name.strip()]
+MODEL_ROUTING_MAX_P95_MS = float(os.getenv('MODEL_ROUTING_MAX_P95_MS', 0))  # 0 = ignore latency
+MODEL_ROUTING_MAX_ERROR_RATE = float(os.getenv('MODEL_ROUTING_MAX_ERROR_RATE', 0))  # 0 = ignore errors
+MODEL_ROUTING_WINDOW = int(os.getenv('MODEL_ROUTING_WINDOW', 100))  # calls kept per model
+MODEL_ROUTING_WINDOW_SECONDS = int(os.getenv('MODEL_ROUTING_WINDOW_SECONDS', 300))
+MODEL_ROUTING_MIN_SAMPLES = int(os.getenv('MODEL_ROUTING_MIN_SAMPLES', 20))
+
+# WebSocket chat transport (/chat/ws)
+WS_MAX_STREAMS = int(os.getenv('WS_MAX_STREAMS', 8))  # concurrent generations per connection
+WS_SEND_QUEUE = int(os.getenv('WS_SEND_QUEUE', 256))  # frames buffered for a slow reader
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 60))  # disconnect a client that reads nothing this long
+WS_AUTH_TIMEOUT = float(os.getenv('WS_AUTH_TIMEOUT', 10))
+
+# Text-to-speech (pyttsx3 in a process pool, one engine per process)
+TTS_WORKERS = int(os.getenv('TTS_WORKERS', 2))
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'tts_cache')
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+TTS_CHUNK_CHARS = int(os.getenv('TTS_CHUNK_CHARS', 400))  # sentences are grouped up to this size
+TTS_MAX_CHARS = int(os.getenv('TTS_MAX_CHARS', 20000))
+TTS_MAX_PENDING = int(os.getenv('TTS_MAX_PENDING', 64))  # chunks queued or being synthesised
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', 120))  # per chunk
+TTS_DEFAULT_RATE = 200  # words per minute (pyttsx3's default)
+
+# Per-user usage accounting (0 = no quota)
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 10))
+USAGE_DAILY_REQUEST_LIMIT = int(os.getenv('USAGE_DAILY_REQUEST_LIMIT', 0))
+USAGE_DAILY_TOKEN_LIMIT = int(os.getenv('USAGE_DAILY_TOKEN_LIMIT', 0))
+
+# Batch chat limits
+BATCH_MAX_PROMPTS = int(os.getenv('BATCH_MAX_PROMPTS', 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 8))
+BATCH_POOL_SIZE = int(os.getenv('BATCH_POOL_SIZE', 16))
+BATCH_RATE_LIMIT = float(os.getenv('BATCH_RATE_LIMIT', 0))  # prompts per second per batch, 0 = unlimited
+
+# Resumable streams: how long a finished stream stays replayable
+STREAM_REPLAY_TTL = int(os.getenv('STREAM_REPLAY_TTL', 120))
+STREAM_HEARTBEAT_SECONDS = int(os.getenv('STREAM_HEARTBEAT_SECONDS', 15))
+# How long a generation keeps running with no client attached before it is cancelled
+STREAM_RESUME_GRACE_SECONDS = float(os.getenv('STREAM_RESUME_GRACE_SECONDS', 10))
+
+# Checkpointing of in-progress streamed answers
+STREAM_CHECKPOINT_CHUNKS = int(os.getenv('STREAM_CHECKPOINT_CHUNKS', 20))
+STREAM_CHECKPOINT_MS = int(os.getenv('STREAM_CHECKPOINT_MS', 500))
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv('CHECKPOINT_FLUSH_INTERVAL', 1.0))
+
+
+# ============= TRACING =============
+
+class Span:
+    """One timed phase of a request"""
+
+    __slots__ = ('name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self, trace_id, kind=1):
+        """Span in OTLP/JSON shape (kind 1 = internal, 2 = server)"""
+        record = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            record["parentSpanId"] = self.parent_id
+        return record
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """Spans recorded for one request, possibly across threads (request thread and stream producer).
+
+    Like RequestProfile, every participant retain()s the trace and release()s it when done;
+    the last release closes the root span and hands the trace to the exporter.
+    """
+
+    def __init__(self, method, path, traceparent=None):
+        parent_id = None
+        match = TRACEPARENT_PATTERN.match(traceparent or '')
+        self.trace_id = match.group(1) if match else os.urandom(16).hex()
+        if match:
+            parent_id = match.group(2)
+        self.root = Span(f"{method} {path}", parent_id, {"http.method": method, "http.target": path})
+        self.spans = []
+        self._stacks = {}  # thread ident -> open spans
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def _parent_id(self):
+        stack = self._stacks.get(threading.get_ident())
+        return stack[-1].span_id if stack else self.root.span_id
+
+    def start_span(self, name, **attributes):
+        """Open a span that is closed explicitly with end_span (for phases that don't nest as a block)"""
+        return Span(name, self._parent_id(), attributes)
+
+    def end_span(self, record):
+        record.end_ns = time.time_ns()
+        with self._lock:
+            self.spans.append(record)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        record = self.start_span(name, **attributes)
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        stack.append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record.error = str(e) or type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            self.end_span(record)
+
+    def durations(self):
+        """Milliseconds per span name, summed over repeats, in the order phases finished"""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for record in spans:
+            totals[record.name] = totals.get(record.name, 0.0) + record.duration_ms
+        totals["total"] = self.root.duration_ms
+        return {name: round(ms, 2) for name, ms in totals.items()}
+
+    def server_timing(self):
+        return ", ".join(f"{SERVER_TIMING_INVALID.sub('_', name)};dur={ms}" for name, ms in self.durations().items())
+
+    def retain(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            finished = self._refs == 0
+        if finished:
+            self.root.end_ns = time.time_ns()
+            span_exporter.submit(self)
+
+    def to_otlp(self):
+        return [self.root.to_otlp(self.trace_id, kind=2)] + [record.to_otlp(self.trace_id) for record in self.spans]
+
+
+class SpanExporter:
+    """Exports finished traces as OTLP/JSON from a background thread.
+
+    TRACE_EXPORT=file appends one ExportTraceServiceRequest per line to TRACE_EXPORT_FILE;
+    TRACE_EXPORT=otlp posts batches to an OTLP/HTTP collector at TRACE_EXPORT_URL (e.g. .../v1/traces).
+    """
+
+    def __init__(self, mode, max_queue):
+        self.mode = mode
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def submit(self, trace):
+        if not self.mode:
+            return
+        with self._wakeup:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._queue:
+                    self._wakeup.wait()
+                batch = list(self._queue)
+                self._queue.clear()
+            payload = {"resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "cortex"}, "spans": [record for trace in batch for record in trace.to_otlp()]}]
+            }]}
+            try:
+                if self.mode == 'otlp':
+                    response = outbound_http.post(TRACE_EXPORT_URL, json=payload)
+                    response.raise_for_status()
+                else:
+                    with open(TRACE_EXPORT_FILE, 'a') as f:
+                        f.write(json.dumps(payload) + "\n")
+                self.exported += len(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️ Span export failed ({len(batch)} traces): {e}")
+            time.sleep(TRACE_EXPORT_INTERVAL)
+
+    def metrics(self):
+        return {"mode": self.mode or "off", "exported": self.exported, "dropped": self.dropped, "errors": self.errors, "queued": len(self._queue)}
+
+
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+SERVER_TIMING_INVALID = re.compile(r'[^\w.-]')
+span_exporter = SpanExporter(TRACE_EXPORT, TRACE_EXPORT_QUEUE)
+# Trace of the request the current thread is working on
+trace_context = threading.local()
+
+
+def current_trace():
+    return getattr(trace_context, 'trace', None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a span of the current request's trace (no-op outside a traced request)"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attributes) as record:
+        yield record
+
+
+def traced(name):
+    """Decorator recording each call of a function as a span"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@app.before_request
+def start_request_trace():
+    trace = Trace(request.method, request.path, request.headers.get('traceparent'))
+    trace.retain()
+    trace_context.trace = trace
+    g.trace = trace
+
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        trace.root.attributes["http.status_code"] = response.status_code
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers['X-Trace-Id'] = trace.trace_id
+        response.call_on_close(trace.release)
+    return response
+
+
+@app.teardown_request
+def clear_request_trace(error=None):
+    trace_context.trace = None
+
+
+def timed_writes(events, trace):
+    """Pass SSE events through, adding the time spent handing them to the client to the trace"""
+    write_ns = 0
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        for event in events:
+            started = time.perf_counter_ns()
+            yield event
+            write_ns += time.perf_counter_ns() - started
+    finally:
+        trace.root.attributes["sse.write_ms"] = round(write_ns / 1e6, 2)
+
+
+# ============= OUTBOUND HTTP =============
+
+class OutboundHTTPClient:
+    """Process-wide keep-alive HTTP client shared by all outbound calls.
+
+    One requests.Session holds a urllib3 connection pool per host, so DNS,
+    TCP and TLS setup is paid once per worker instead of once per call.
+    Idempotent requests are retried on connect errors and 429/5xx responses;
+    non-idempotent ones (POST) are only retried when the connection could
+    not be established, so an email is never sent twice.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, pool_hosts, pool_maxsize, max_retries):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._host_stats = {}
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the shared pool and record per-host latency"""
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        try:
+            with span(f"http.{host}", **{"http.method": method}):
+                response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record(host, (time.perf_counter() - started) * 1000, error=True)
+            raise
+        self._record(host, (time.perf_counter() - started) * 1000, error=response.status_code >= 500)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record(self, host, elapsed_ms, error=False):
+        with self._lock:
+            stats = self._host_stats.get(host)
+            if stats is None:
+                stats = {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "recent": deque(maxlen=256)}
+                self._host_stats[host] = stats
+            stats["requests"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["recent"].append(elapsed_ms)
+
+    def metrics(self):
+        """Return per-host request counts and latency percentiles in milliseconds"""
+        with self._lock:
+            snapshot = {host: dict(stats, recent=sorted(stats["recent"])) for host, stats in self._host_stats.items()}
+        result = {}
+        for host, stats in snapshot.items():
+            recent = stats["recent"]
+            result[host] = {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["requests"], 2),
+                "p50_ms": round(recent[len(recent) // 2], 2) if recent else None,
+                "p95_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 2) if recent else None,
+                "max_ms": round(stats["max_ms"], 2)
+            }
+        return result
+
+
+outbound_http = OutboundHTTPClient(
+    connect_timeout=OUTBOUND_CONNECT_TIMEOUT,
+    read_timeout=OUTBOUND_READ_TIMEOUT,
+    pool_hosts=OUTBOUND_POOL_HOSTS,
+    pool_maxsize=OUTBOUND_POOL_MAXSIZE,
+    max_retries=OUTBOUND_MAX_RETRIES
+)
+
+
+def send_email(message):
+    """Send a SendGrid Mail object over the shared outbound pool"""
+    response = outbound_http.post(
+        SENDGRID_API_URL,
+        json=message.get(),
+        headers={'Authorization': f'Bearer {SENDGRID_API_KEY}'}
+    )
+    if response.status_code >= 400:
+        raise RuntimeError(f"SendGrid returned {response.status_code}: {response.text}")
+    return response
+
+
+# Metrics exposed at /metrics, keyed by subsystem name
+metrics_sources = {
+    "outbound_http": outbound_http.metrics,
+    "tracing": span_exporter.metrics
+}
+
+
+class PooledConnection:
+    """A pooled psycopg2 connection; close() hands it back to the pool instead of disconnecting"""
+
+    def __init__(self, pool, conn, pooled=True):
+        self._pool = pool
+        self._conn = conn
+        self._pooled = pooled
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._pooled:
+            self._pool.release(conn)
+        else:
+            conn.close()
+
+
+class DatabasePool:
+    """Per-worker psycopg2 connection pool for one database, created lazily so each gunicorn worker gets its own"""
+
+    def __init__(self, name, dsn, minconn, maxconn):
+        self.name = name
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+        self._last_used = {}  # id(connection) -> monotonic time it was last returned
+        self.checkouts = 0
+        self.overflow = 0
+        self.discarded = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn, cursor_factory=RealDictCursor)
+        return self._pool
+
+    def open(self):
+        """Open the pool's minimum connections"""
+        self._get_pool()
+
+    def connect(self):
+        """Borrow a connection (call close() on it to return it)"""
+        pool = self._get_pool()
+        try:
+            conn = pool.getconn()
+        except PoolError:
+            # Pool exhausted: fall back to a one-off connection rather than failing the request
+            self.overflow += 1
+            return PooledConnection(self, psycopg2.connect(self.dsn, cursor_factory=RealDictCursor), pooled=False)
+        
+        # Connections idle for a while may have been dropped by the server; check before use
+        idle_since = self._last_used.get(id(conn))
+        if conn.closed or (idle_since and time.monotonic() - idle_since > DB_POOL_PING_AFTER):
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError("connection already closed")
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                self.discarded += 1
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        
+        self.checkouts += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        pool = self._pool
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()  # No round trip unless a transaction was left open
+            except Exception:
+                broken = True
+        self._last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken)
+
+    def metrics(self):
+        pool = self._pool
+        stats = {"checkouts": self.checkouts, "overflow": self.overflow, "discarded": self.discarded, "max": self.maxconn}
+        if pool is None:
+            return dict(stats, open=0, in_use=0)
+        return dict(stats, open=len(pool._pool) + len(pool._used), in_use=len(pool._used))
+
+
+class ReplicaRouter:
+    """Decides whether a read-only query may go to the replica.
+
+    Reads go to the primary while the replica is down or lagging by more than REPLICA_MAX_LAG_SECONDS,
+    and for REPLICA_STICKY_SECONDS after a user's own write so they read what they just wrote. Write times
+    are tracked per worker, so the sticky window should comfortably exceed the replica's normal lag.
+    """
+
+    def __init__(self, replica):
+        self.replica = replica
+        self._recent_writes = {}  # user_id -> monotonic time of their last write
+        self._lock = threading.Lock()
+        self.lag_seconds = None
+        self._lag_checked_at = 0.0
+        self._down_until = 0.0
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.sticky_reads = 0
+        self.fallbacks = 0
+
+    def note_write(self, user_id):
+        if user_id is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[user_id] = now
+            if len(self._recent_writes) > 10000:
+                self._recent_writes = {uid: at for uid, at in self._recent_writes.items() if now - at < REPLICA_STICKY_SECONDS}
+
+    def _is_sticky(self, user_id):
+        written_at = self._recent_writes.get(user_id)
+        return written_at is not None and time.monotonic() - written_at < REPLICA_STICKY_SECONDS
+
+    def _check_lag(self, conn):
+        """Measure replication lag on a replica connection, at most every REPLICA_LAG_CHECK_INTERVAL seconds"""
+        now = time.monotonic()
+        if now - self._lag_checked_at < REPLICA_LAG_CHECK_INTERVAL:
+            return self.lag_seconds
+        self._lag_checked_at = now
+        cur = conn.cursor()
+        # An idle primary has nothing to replay, so only count lag while WAL is still being applied
+        cur.execute(
+            """
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END AS lag
+            """
+        )
+        self.lag_seconds = float(cur.fetchone()['lag'])
+        cur.close()
+        conn.rollback()
+        return self.lag_seconds
+
+    def connect(self, user_id=None):
+        """A replica connection when it is safe to read from one, otherwise None"""
+        if user_id is not None and self._is_sticky(user_id):
+            self.sticky_reads += 1
+            return None
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            conn = self.replica.connect()
+        except Exception as e:
+            print(f"⚠️ Replica unavailable, reading from primary: {e}")
+            self._down_until = time.monotonic() + REPLICA_RETRY_AFTER
+            self.fallbacks += 1
+            return None
+        try:
+            lag = self._check_lag(conn)
+        except Exception as e:
+            print(f"⚠️ Replica lag check failed, reading from primary: {e}")
+            conn.close()
+            self._down_until = time.monotonic() + REPLICA_RETRY_AFTER
+            self.fallbacks += 1
+            return None
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            conn.close()
+            self.fallbacks += 1
+            return None
+        self.replica_reads += 1
         return conn
+
+    def metrics(self):
+        return {
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "sticky_reads": self.sticky_reads,
+            "fallbacks": self.fallbacks,
+            "lag_seconds": self.lag_seconds,
+            "replica_down": time.monotonic() < self._down_until,
+            "replica_pool": self.replica.metrics()
+        }
+
+
+primary_db = DatabasePool('primary', DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX)
+replica_router = ReplicaRouter(DatabasePool('replica', DATABASE_REPLICA_URL, DB_POOL_MIN, DB_POOL_MAX)) if DATABASE_REPLICA_URL else None
+
+
+# Database connection function
+def get_db_connection(readonly=False, user_id=None):
+    """Borrow a database connection (call close() to return it).
+
+    readonly=True lets the query go to the replica when one is configured; pass the user_id so reads
+    right after that user's own writes stay on the primary.
+    """
+    try:
+        if readonly and replica_router is not None:
+            conn = replica_router.connect(user_id)
+            if conn is not None:
+                return conn
+            replica_router.primary_reads += 1
+        return primary_db.connect()
     except Exception as e:
         print(f"Database connection error: {e}")
         raise
 
 
+def note_user_write(user_id):
+    """Keep this user's reads on the primary for a moment after they write"""
+    if replica_router is not None:
+        replica_router.note_write(user_id)
+
+
+metrics_sources["db_pool"] = primary_db.metrics
+if replica_router is not None:
+    metrics_sources["db_replica"] = replica_router.metrics
+
+
 # Initialize database tables
 def init_db():
-    """Initialize database tables"""
+    """Create missing tables and apply the idempotent migrations; runs at every worker boot"""
     conn = get_db_connection()
     cur = conn.cursor()
-    
-    # Drop and recreate user_sessions table to fix schema issues
+    cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_KEY,))
+    conn.commit()
     try:
-        cur.execute('DROP TABLE IF EXISTS user_sessions CASCADE')
-        conn.commit()
-    except Exception as e:
-        print(f"Warning dropping user_sessions: {e}")
+        migrate_schema(conn, cur)
+    finally:
         conn.rollback()
-    
+        cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+def migrate_schema(conn, cur):
+    """Schema statements for init_db; every one is safe to repeat"""
     # Users table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -112,7 +879,8 @@ def init_db():
         cur.execute("""
             ALTER TABLE users 
             ADD COLUMN IF NOT EXISTS reset_token TEXT,
-            ADD COLUMN IF NOT EXISTS reset_token_expires TIMESTAMP
+            ADD COLUMN IF NOT EXISTS reset_token_expires TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS password_changed_at TIMESTAMP
         """)
         conn.commit()
         print("✅ Added reset token columns to users table")
@@ -123,7 +891,7 @@ def init_db():
     # Conversations table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS conversations (
-            id UUID PRIMARY KEY,
+            id VARCHAR(64) PRIMARY KEY,
             user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
             title VARCHAR(200) NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -135,75 +903,484 @@ def init_db():
     cur.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id SERIAL PRIMARY KEY,
-            conversation_id UUID REFERENCES conversations(id) ON DELETE CASCADE,
+            conversation_id VARCHAR(64) REFERENCES conversations(id) ON DELETE CASCADE,
             role VARCHAR(20) NOT NULL,
             content TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
-    # Sessions table (recreated with correct schema)
+    # Conversation ids come from the client (not always UUIDs)
+    try:
+        cur.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'conversations' AND column_name = 'id'
+        """)
+        column = cur.fetchone()
+        if column and column['data_type'] == 'uuid':
+            cur.execute("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_conversation_id_fkey")
+            cur.execute("ALTER TABLE messages ALTER COLUMN conversation_id TYPE VARCHAR(64)")
+            cur.execute("ALTER TABLE conversations ALTER COLUMN id TYPE VARCHAR(64)")
+            cur.execute("""
+                ALTER TABLE messages ADD CONSTRAINT messages_conversation_id_fkey
+                FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+            """)
+            print("✅ Migrated conversation ids to VARCHAR")
+        conn.commit()
+    except Exception as e:
+        print(f"Warning migrating conversation ids: {e}")
+        conn.rollback()
+    
+    # Message status (e.g. truncated answers of cancelled streams)
+    try:
+        cur.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS status VARCHAR(20)")
+        conn.commit()
+    except Exception as e:
+        print(f"Warning adding message status column: {e}")
+        conn.rollback()
+    
+    # Compressed bodies (content is '' when content_codec is set) and a search vector built from the plaintext
+    try:
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'messages' AND column_name = 'content_tsv'
+        """)
+        backfill_tsv = cur.fetchone() is None
+        cur.execute("""
+            ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS content_codec VARCHAR(8),
+            ADD COLUMN IF NOT EXISTS content_blob BYTEA,
+            ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR
+        """)
+        if backfill_tsv:
+            cur.execute("UPDATE messages SET content_tsv = to_tsvector('english', content) WHERE content_tsv IS NULL AND content_codec IS NULL")
+        conn.commit()
+    except Exception as e:
+        print(f"Warning adding compressed content columns: {e}")
+        conn.rollback()
+    
+    # Conversation lookup and full-text search indexes
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id, id)")
+    cur.execute("DROP INDEX IF EXISTS idx_messages_content_fts")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_content_tsv ON messages USING GIN (content_tsv)")
+    
+    # Small partial indexes for the maintenance sweeps (abandoned streams, outstanding reset tokens)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_streaming ON messages (created_at) WHERE status = 'streaming'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_reset_token_expires ON users (reset_token_expires) WHERE reset_token_expires IS NOT NULL")
+    
+    # Sessions table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS user_sessions (
             id SERIAL PRIMARY KEY,
             user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-            token TEXT UNIQUE NOT NULL,
+            jti VARCHAR(64) UNIQUE NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             expires_at TIMESTAMP NOT NULL,
-            is_active BOOLEAN DEFAULT TRUE
+            is_active BOOLEAN DEFAULT TRUE,
+            revoked_at TIMESTAMP
+        )
+    ''')
+    
+    # Sessions from before token ids stored the raw token; key them by the hash token_id() uses for such tokens
+    try:
+        cur.execute("""
+            ALTER TABLE user_sessions
+            ADD COLUMN IF NOT EXISTS jti VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS revoked_at TIMESTAMP
+        """)
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'user_sessions' AND column_name = 'token'
+        """)
+        if cur.fetchone():
+            cur.execute("ALTER TABLE user_sessions ALTER COLUMN token DROP NOT NULL")
+            cur.execute("UPDATE user_sessions SET jti = encode(sha256(convert_to(token, 'UTF8')), 'hex') WHERE jti IS NULL")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_sessions_jti ON user_sessions (jti)")
+            print("✅ Migrated user_sessions to token ids")
+        conn.commit()
+    except Exception as e:
+        print(f"Warning migrating user_sessions: {e}")
+        conn.rollback()
+    
+    # Revocation change feed and expiry cleanup (sessions are keyed by token id, not the token)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_expires_at ON user_sessions (expires_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_revoked_at ON user_sessions (revoked_at) WHERE revoked_at IS NOT NULL")
+    
+    # Daily usage per user (written behind by UsageTracker)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens BIGINT NOT NULL DEFAULT 0,
+            response_tokens BIGINT NOT NULL DEFAULT 0,
+            images INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            latency_ms BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, day)
         )
     ''')
     
     conn.commit()
-    cur.close()
-    conn.close()
     print("✅ Database tables initialized successfully")
 
 
-# JWT Token decorator
-def token_required(f):
-    """Decorator to protect routes with JWT authentication"""
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
+# ============= TOKEN VERIFICATION =============
+
+def issue_token(user):
+    """Sign a session JWT for the user; returns (token, token id, expiry)"""
+    jti = uuid.uuid4().hex
+    expires_at = datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
+    token = jwt.encode({
+        'user_id': user['id'],
+        'username': user['username'],
+        'jti': jti,
+        'exp': expires_at
+    }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+    return token, jti, expires_at
+
+
+def token_id(token, claims):
+    """Revocation key for a token: its jti, or a hash of the token for ones issued without a jti"""
+    return claims.get('jti') or hashlib.sha256(token.encode()).hexdigest()
+
+
+def utc_epoch(value):
+    """Epoch seconds for a naive UTC datetime as stored in user_sessions.expires_at"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TokenVerifier:
+    """Verifies JWTs, remembering recently verified tokens' claims so repeat requests skip the HMAC and JSON decode"""
+
+    def __init__(self, size):
+        self.size = size
+        self._claims = OrderedDict()  # token -> decoded claims
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token):
+        """Decoded claims for a valid token; raises jwt.InvalidTokenError (or ExpiredSignatureError) otherwise"""
+        with self._lock:
+            claims = self._claims.get(token)
+            if claims is not None:
+                self._claims.move_to_end(token)
+        if claims is not None:
+            if claims.get('exp', math.inf) > time.time():
+                self.hits += 1
+                return claims
+            with self._lock:
+                self._claims.pop(token, None)
         
-        # Get token from header
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
+        self.misses += 1
+        claims = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
+        with self._lock:
+            self._claims[token] = claims
+            while len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+        return claims
+
+    def metrics(self):
+        return {"cached": len(self._claims), "hits": self.hits, "misses": self.misses}
+
+
+class RevocationList:
+    """Ids of revoked, unexpired tokens held in memory, so checking a token needs no query.
+
+    Loaded from user_sessions on first use and kept in sync across workers by polling revoked_at
+    every REVOCATION_SYNC_SECONDS. If the feed falls more than REVOCATION_MAX_STALENESS seconds behind,
+    checks go to the database directly until it catches up.
+    """
+
+    def __init__(self):
+        self._revoked = {}  # token id -> expiry epoch
+        self._lock = threading.Lock()
+        self._thread = None
+        self._watermark = None  # database LOCALTIMESTAMP of the last successful sync
+        self._synced_at = 0.0
+        self.syncs = 0
+        self.sync_errors = 0
+        self.db_checks = 0
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='revocation-sync', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
             try:
-                token = auth_header.split(" ")[1]  # Bearer <token>
-            except IndexError:
-                print("❌ Token validation failed: Invalid token format")
-                return jsonify({"error": "Invalid token format"}), 401
+                self.sync()
+            except Exception as e:
+                self.sync_errors += 1
+                print(f"⚠️ Revocation sync failed: {e}")
+            time.sleep(REVOCATION_SYNC_SECONDS)
+
+    def sync(self):
+        """Pull revocations since the last sync (everything unexpired on the first run)"""
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT LOCALTIMESTAMP AS now")
+        now = cur.fetchone()['now']
+        select = "SELECT jti, expires_at FROM user_sessions"
+        if self._watermark is None:
+            cur.execute(select + " WHERE (revoked_at IS NOT NULL OR is_active = FALSE) AND expires_at > %s", (datetime.utcnow(),))
+        else:
+            # Overlap a little so revocations committed just after the last poll's snapshot aren't missed
+            cur.execute(select + " WHERE revoked_at > %s", (self._watermark - timedelta(seconds=REVOCATION_FEED_OVERLAP),))
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
         
-        if not token:
-            print("❌ Token validation failed: Token is missing")
-            return jsonify({"error": "Token is missing"}), 401
+        now_epoch = time.time()
+        with self._lock:
+            for row in rows:
+                self._revoked[row['jti']] = utc_epoch(row['expires_at'])
+            for revoked_id in [key for key, expires in self._revoked.items() if expires <= now_epoch]:
+                del self._revoked[revoked_id]
+        self._watermark = now
+        self._synced_at = time.monotonic()
+        self.syncs += 1
+
+    def add(self, revoked_id, expires_at):
+        with self._lock:
+            self._revoked[revoked_id] = utc_epoch(expires_at)
+
+    def is_revoked(self, revoked_id):
+        self.start()
+        if revoked_id in self._revoked:
+            return True
+        if time.monotonic() - self._synced_at <= REVOCATION_MAX_STALENESS:
+            return False
         
-        try:
-            # Decode token
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
-            print(f"🔑 Token decoded successfully for user_id: {data.get('user_id')}")
-            
-            # Get user from database
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM users WHERE id = %s AND (is_active = TRUE OR is_active IS NULL)", (data['user_id'],))
-            current_user = cur.fetchone()
-            
-            if not current_user:
-                print(f"❌ Token validation failed: User ID {data['user_id']} not found in database")
-                # Check if user exists at all
-                cur.execute("SELECT id, is_active FROM users WHERE id = %s", (data['user_id'],))
-                any_user = cur.fetchone()
-                if any_user:
-                    print(f"⚠️ User exists but is_active = {any_user['is_active']}")
-                else:
-                    print(f"⚠️ User ID {data['user_id']} does not exist in database at all")
-            else:
-                print(f"✅ Token valid for user: {current_user['username']} (ID: {current_user['id']})")
-            
-            cur.close()
+        # Feed is behind (or not loaded yet): the database is the source of truth
+        self.db_checks += 1
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM user_sessions WHERE jti = %s AND (revoked_at IS NOT NULL OR is_active = FALSE)",
+            (revoked_id,)
+        )
+        revoked = cur.fetchone() is not None
+        cur.close()
+        conn.close()
+        return revoked
+
+    def metrics(self):
+        return {
+            "revoked_tokens": len(self._revoked),
+            "syncs": self.syncs,
+            "sync_errors": self.sync_errors,
+            "db_checks": self.db_checks,
+            "seconds_since_sync": round(time.monotonic() - self._synced_at, 1) if self._synced_at else None
+        }
+
+
+def revoke_sessions(conn, where, params):
+    """Revoke the matching active sessions, commit, and add them to this worker's revocation list.
+
+    Callers flush auth_writer first (before taking any row locks) so buffered session rows are
+    covered; other workers pick the change up from the revoked_at feed.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        UPDATE user_sessions SET is_active = FALSE, revoked_at = LOCALTIMESTAMP
+        WHERE is_active AND {where}
+        RETURNING jti, expires_at
+        """,
+        params
+    )
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    for row in rows:
+        if row['jti']:
+            revocation_list.add(row['jti'], row['expires_at'])
+    return len(rows)
+
+
+def revoke_token(conn, user_id, token):
+    """Revoke one session token, writing its session row revoked if it hasn't been written yet"""
+    claims = token_verifier.verify(token)
+    revoked_id = token_id(token, claims)
+    expires_at = datetime.utcfromtimestamp(claims['exp'])
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO user_sessions (user_id, jti, expires_at, is_active, revoked_at)
+        VALUES (%s, %s, %s, FALSE, LOCALTIMESTAMP)
+        ON CONFLICT (jti) DO UPDATE SET is_active = FALSE, revoked_at = COALESCE(user_sessions.revoked_at, LOCALTIMESTAMP)
+        """,
+        (user_id, revoked_id, expires_at)
+    )
+    conn.commit()
+    cur.close()
+    revocation_list.add(revoked_id, expires_at)
+
+
+class AuthWriteBehind:
+    """Write-behind buffer for login bookkeeping: last_login stamps and new session rows.
+
+    Neither is needed to serve the login itself (tokens are verified from their signature and the
+    revocation list), so a background thread writes them every AUTH_FLUSH_INTERVAL seconds in one
+    transaction. A session whose user changed password after it was issued is written revoked, so a
+    login racing a password change on another worker can't leave a live session behind.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_logins = {}  # user_id -> utc timestamp
+        self._sessions = []  # (user_id, jti, expires_at, issued_at)
+        self._thread = None
+        self.sessions_written = 0
+        self.logins_written = 0
+        self.batches = 0
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='auth-writer', daemon=True)
+            self._thread.start()
+
+    def record_login(self, user_id):
+        with self._lock:
+            self._last_logins[user_id] = datetime.utcnow()
+            self._start()
+
+    def record_session(self, user_id, jti, expires_at):
+        with self._lock:
+            self._sessions.append((user_id, jti, expires_at, datetime.utcnow()))
+            self._start()
+
+    def flush(self):
+        # The flush lock lets revocation wait for an in-flight flush before it runs
+        with self._flush_lock:
+            with self._lock:
+                last_logins, self._last_logins = self._last_logins, {}
+                sessions, self._sessions = self._sessions, []
+            if not last_logins and not sessions:
+                return
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                if sessions:
+                    execute_values(
+                        cur,
+                        """
+                        INSERT INTO user_sessions (user_id, jti, expires_at, is_active, revoked_at)
+                        SELECT v.user_id, v.jti, v.expires_at,
+                               u.password_changed_at IS NULL OR u.password_changed_at <= v.issued_at,
+                               CASE WHEN u.password_changed_at > v.issued_at THEN LOCALTIMESTAMP END
+                        FROM (VALUES %s) AS v(user_id, jti, expires_at, issued_at)
+                        JOIN users u ON u.id = v.user_id
+                        ON CONFLICT (jti) DO NOTHING
+                        """,
+                        sessions,
+                        template="(%s::integer, %s::varchar, %s::timestamp, %s::timestamp)"
+                    )
+                if last_logins:
+                    execute_values(
+                        cur,
+                        """UPDATE users AS u SET last_login = v.last_login
+                           FROM (VALUES %s) AS v(id, last_login)
+                           WHERE u.id = v.id AND (u.last_login IS NULL OR u.last_login < v.last_login)""",
+                        list(last_logins.items()),
+                        template="(%s::integer, %s::timestamp)"
+                    )
+                conn.commit()
+                cur.close()
+                conn.close()
+                self.sessions_written += len(sessions)
+                self.logins_written += len(last_logins)
+                self.batches += 1
+            except Exception as e:
+                print(f"⚠️ Failed to write {len(sessions)} session(s) and {len(last_logins)} last_login(s): {e}")
+                with self._lock:
+                    self._sessions[:0] = sessions
+                    for user_id, stamp in last_logins.items():
+                        self._last_logins.setdefault(user_id, stamp)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "pending_sessions": len(self._sessions),
+                "pending_logins": len(self._last_logins),
+                "sessions_written": self.sessions_written,
+                "logins_written": self.logins_written,
+                "batches": self.batches
+            }
+
+
+token_verifier = TokenVerifier(TOKEN_CACHE_SIZE)
+revocation_list = RevocationList()
+auth_writer = AuthWriteBehind(AUTH_FLUSH_INTERVAL)
+metrics_sources["auth"] = lambda: {"verifier": token_verifier.metrics(), "revocations": revocation_list.metrics(), "write_behind": auth_writer.metrics()}
+atexit.register(auth_writer.flush)
+
+
+# JWT Token decorator
+def token_required(f):
+    """Decorator to protect routes with JWT authentication"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = None
+        
+        # Get token from header
+        if 'Authorization' in request.headers:
+            auth_header = request.headers['Authorization']
+            try:
+                token = auth_header.split(" ")[1]  # Bearer <token>
+            except IndexError:
+                print("❌ Token validation failed: Invalid token format")
+                return jsonify({"error": "Invalid token format"}), 401
+        
+        if not token:
+            print("❌ Token validation failed: Token is missing")
+            return jsonify({"error": "Token is missing"}), 401
+        
+        try:
+            # Decode token (cached after the first verification)
+            with span('auth.verify_token'):
+                data = token_verifier.verify(token)
+                revoked = revocation_list.is_revoked(token_id(token, data))
+            print(f"🔑 Token decoded successfully for user_id: {data.get('user_id')}")
+            
+            if revoked:
+                print(f"❌ Token validation failed: Token for user_id {data.get('user_id')} has been revoked")
+                return jsonify({"error": "Token has been revoked"}), 401
+            
+            # Get user from database (replica when configured)
+            with span('auth.user_lookup'):
+                conn = get_db_connection(readonly=True, user_id=data['user_id'])
+                cur = conn.cursor()
+                cur.execute("SELECT * FROM users WHERE id = %s AND (is_active = TRUE OR is_active IS NULL)", (data['user_id'],))
+                current_user = cur.fetchone()
+            
+            if not current_user:
+                print(f"❌ Token validation failed: User ID {data['user_id']} not found in database")
+                # Check if user exists at all
+                cur.execute("SELECT id, is_active FROM users WHERE id = %s", (data['user_id'],))
+                any_user = cur.fetchone()
+                if any_user:
+                    print(f"⚠️ User exists but is_active = {any_user['is_active']}")
+                else:
+                    print(f"⚠️ User ID {data['user_id']} does not exist in database at all")
+            else:
+                print(f"✅ Token valid for user: {current_user['username']} (ID: {current_user['id']})")
+            
+            cur.close()
             conn.close()
             
             if not current_user:
@@ -225,205 +1402,1595 @@ def token_required(f):
 
 
 # Store conversation histories per user (in production, use a database)
-# Format: {user_id: {conversation_id: conversation_data}}
+# Format: {user_id: {conversation_id: Conversation}}
 user_conversations = {}
 
-# Model configuration
-MODEL_NAME = "gemini-3-flash-preview"
-generation_config = {
-    "temperature": 0.9,
-    "top_p": 0.95,
-    "top_k": 40,
-    "max_output_tokens": 8192,
-}
 
-safety_settings = [
-    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-]
+# ============= CONVERSATION STORE =============
 
+# Placeholder left in stored content where a generated image's data URL was embedded. NUL-delimited,
+# so it can't collide with message text (NULs are stripped on write; Postgres TEXT rejects them anyway)
+IMAGE_REF_MARK = "\x00"
+IMAGE_REF_PATTERN = re.compile(r"\x00img:(\d+)\x00")
 
-# ============= AUTHENTICATION ENDPOINTS =============
+# Inline base64 payloads are left out of the search vector
+DATA_URL_PATTERN = re.compile(r"data:[\w/+.-]+;base64,[A-Za-z0-9+/=]+")
 
-@app.route('/auth/register', methods=['POST'])
-def register():
-    """Register a new user"""
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['username', 'email', 'password']
-        for field in required_fields:
-            if field not in data or not data[field]:
-                return jsonify({"error": f"{field} is required"}), 400
-        
-        username = data['username'].strip()
-        email = data['email'].lower().strip()  # Normalize email
-        password = data['password']
-        full_name = data.get('full_name', '').strip()
-        
-        # Validate email format
-        if '@' not in email:
-            return jsonify({"error": "Invalid email format"}), 400
-        
-        # Validate password strength
-        if len(password) < 6:
-            return jsonify({"error": "Password must be at least 6 characters"}), 400
-        
-        # Hash password
-        password_hash = generate_password_hash(password)
-        
-        print(f"🔐 Registering user: {username}, email: {email}")
-        print(f"🔑 Password length: {len(password)}")
-        print(f"🔑 Hash method: pbkdf2:sha256")
-        
-        # Insert user into database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        try:
-            cur.execute(
-                """INSERT INTO users (username, email, password_hash, full_name) 
-                   VALUES (%s, %s, %s, %s) RETURNING id, username, email, full_name, created_at""",
-                (username, email, password_hash, full_name)
-            )
-            user = cur.fetchone()
-            conn.commit()
-            
-            print(f"✅ User registered successfully with ID: {user['id']}")
-            
-            # Verify user was saved
-            cur.execute("SELECT id, username, email FROM users WHERE email = %s", (email,))
-            saved_user = cur.fetchone()
-            if saved_user:
-                print(f"✅ Verified in DB: User {saved_user['username']} (ID: {saved_user['id']}) with email {saved_user['email']}")
-            else:
-                print(f"⚠️ WARNING: User not found in DB after insert!")
-            
-            # Generate JWT token
-            token = jwt.encode({
-                'user_id': user['id'],
-                'username': user['username'],
-                'exp': datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-            }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
-            
-            # Store session in database
-            expires_at = datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-            cur.execute(
-                "INSERT INTO user_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (user['id'], token, expires_at)
-            )
-            conn.commit()
-            
-            cur.close()
-            conn.close()
-            
-            return jsonify({
-                "message": "User registered successfully",
-                "user": {
-                    "id": user['id'],
-                    "username": user['username'],
-                    "email": user['email'],
-                    "full_name": user['full_name'],
-                    "created_at": user['created_at'].isoformat() if user['created_at'] else None
-                },
-                "token": token
-            }), 201
-            
-        except psycopg2.IntegrityError as e:
-            conn.rollback()
-            cur.close()
-            conn.close()
-            if 'username' in str(e):
-                return jsonify({"error": "Username already exists"}), 409
-            elif 'email' in str(e):
-                return jsonify({"error": "Email already exists"}), 409
-            else:
-                return jsonify({"error": "User already exists"}), 409
-                
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+CONTENT_CODECS = {"zlib": (lambda data: zlib.compress(data, 6), zlib.decompress)}
+if zstandard is not None:
+    CONTENT_CODECS["zstd"] = (lambda data: zstandard.compress(data, 3), zstandard.decompress)
+if lz4 is not None:
+    CONTENT_CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
 
 
-@app.route('/auth/login', methods=['POST'])
-def login():
-    """Login user"""
+def select_content_codec(name):
+    """The configured body codec if it is installed ('auto' prefers zstd), else zlib"""
+    if name == 'auto':
+        return 'zstd' if 'zstd' in CONTENT_CODECS else 'zlib'
+    if name not in CONTENT_CODECS:
+        print(f"⚠️ Message codec {name!r} is not installed, using zlib")
+        return 'zlib'
+    return name
+
+
+CONTENT_CODEC = select_content_codec(MESSAGE_COMPRESS_CODEC)
+
+
+class CompressionStats:
+    """Bytes in/out and CPU time of message body compression in this worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def record_compress(self, raw_bytes, stored_bytes, seconds):
+        with self._lock:
+            self.compressed += 1
+            self.raw_bytes += raw_bytes
+            self.stored_bytes += stored_bytes
+            self.compress_seconds += seconds
+
+    def record_decompress(self, seconds):
+        with self._lock:
+            self.decompressed += 1
+            self.decompress_seconds += seconds
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "codec": CONTENT_CODEC,
+                "min_bytes": MESSAGE_COMPRESS_MIN_BYTES,
+                "compressed": self.compressed,
+                "raw_bytes": self.raw_bytes,
+                "stored_bytes": self.stored_bytes,
+                "ratio": round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else None,
+                "compress_ms": round(self.compress_seconds * 1000, 1),
+                "decompressed": self.decompressed,
+                "decompress_ms": round(self.decompress_seconds * 1000, 1)
+            }
+
+
+compression_stats = CompressionStats()
+metrics_sources["compression"] = compression_stats.metrics
+
+
+def compress_text(text):
+    """(codec, payload) for a message body; (None, text) when it is small or doesn't shrink"""
+    if not MESSAGE_COMPRESS_MIN_BYTES or len(text) < MESSAGE_COMPRESS_MIN_BYTES // 4:
+        return None, text
+    data = text.encode('utf-8')
+    if len(data) < MESSAGE_COMPRESS_MIN_BYTES:
+        return None, text
+    started = time.perf_counter()
+    payload = CONTENT_CODECS[CONTENT_CODEC][0](data)
+    compression_stats.record_compress(len(data), len(payload), time.perf_counter() - started)
+    if len(payload) > len(data) * 0.9:
+        return None, text
+    return CONTENT_CODEC, payload
+
+
+def decompress_text(codec, payload):
+    """Inverse of compress_text"""
+    if codec is None:
+        return payload
+    started = time.perf_counter()
+    text = CONTENT_CODECS[codec][1](bytes(payload)).decode('utf-8')
+    compression_stats.record_decompress(time.perf_counter() - started)
+    return text
+
+
+def stored_content(text):
+    """(content, content_codec, content_blob, search text) column values for a message body"""
+    codec, payload = compress_text(text)
+    search_text = DATA_URL_PATTERN.sub(' ', text)
+    if codec is None:
+        return text, None, None, search_text
+    return '', codec, psycopg2.Binary(payload), search_text
+
+
+def read_stored_content(row):
+    """Message body of a row selected with content, content_codec and content_blob"""
+    if row['content_codec'] is None:
+        return row['content']
+    return decompress_text(row['content_codec'], row['content_blob'])
+
+
+def to_epoch(value):
+    """Convert an ISO timestamp string to epoch seconds (now if missing or invalid)"""
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        if not data or 'email' not in data or 'password' not in data:
-            return jsonify({"error": "Email and password are required"}), 400
-        
-        email = data['email'].lower().strip()  # Normalize email
-        password = data['password']
-        
-        print(f"🔍 Login attempt for email: {email}")
-        print(f"🔑 Password provided length: {len(password)}")
-        
-        # Get user from database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE LOWER(email) = %s AND is_active = TRUE", (email,))
-        user = cur.fetchone()
-        
-        if not user:
-            cur.close()
-            conn.close()
-            print(f"❌ Login failed: User not found with email {email}")
-            return jsonify({"error": "Invalid email or password"}), 401
-        
-        print(f"✅ User found: ID={user['id']}, username={user['username']}")
-        print(f"🔑 Stored hash starts with: {user['password_hash'][:30]}...")
-        
-        # Verify password
-        password_match = check_password_hash(user['password_hash'], password)
-        print(f"🔐 Password verification result: {password_match}")
-        
-        if not password_match:
-            cur.close()
-            conn.close()
-            print(f"❌ Login failed: Invalid password for user {email}")
-            return jsonify({"error": "Invalid email or password"}), 401
-        
-        # Update last login
-        cur.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s", (user['id'],))
-        conn.commit()
-        
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user['id'],
-            'username': user['username'],
-            'exp': datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-        }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
-        
-        # Store session in database
-        expires_at = datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-        cur.execute(
-            "INSERT INTO user_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-            (user['id'], token, expires_at)
-        )
-        conn.commit()
-        
-        cur.close()
-        conn.close()
-        
-        return jsonify({
-            "message": "Login successful",
-            "user": {
-                "id": user['id'],
-                "username": user['username'],
-                "email": user['email'],
-                "full_name": user['full_name'],
-                "last_login": user['last_login'].isoformat() if user['last_login'] else None
-            },
-            "token": token
-        })
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return datetime.fromisoformat(value).timestamp() if value else time.time()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class Message:
+    """A stored chat message.
+
+    Slotted record with an interned role and an epoch-float timestamp instead
+    of a dict of strings. Generated images are kept once in ``images``; the
+    copies embedded as markdown in the content are swapped for short
+    references and only expanded again when the content is read. Finished
+    bodies of MESSAGE_COMPRESS_MIN_BYTES or more are held compressed and
+    decompressed on each read.
+    """
+
+    __slots__ = ('role', '_content', 'codec', 'created', 'images', 'status')
+
+    def __init__(self, role, content, created=None, images=None, status=None):
+        self.role = sys.intern(role)
+        self.created = time.time() if created is None else created
+        # None when complete; 'streaming' while being generated, 'truncated' or 'error' if it stopped early
+        self.status = status
+        # None: no images field in the API JSON; empty tuple: serialised as null
+        self.images = tuple(images) if images is not None else None
+        self._set_content(content)
+
+    @classmethod
+    def from_row(cls, role, content, codec, blob, created=None, status=None):
+        """A message loaded from the database, kept compressed if its row was"""
+        message = cls(role, content if codec is None else '', created, status=status)
+        if codec is not None:
+            message.codec, message._content = codec, bytes(blob)
+        return message
+
+    def _set_content(self, content):
+        if self.images:
+            content = content.replace(IMAGE_REF_MARK, '')
+            # Longest first, so an image URL that is a prefix of another can't split it
+            for position, image_url in sorted(enumerate(self.images), key=lambda item: -len(item[1])):
+                content = content.replace(image_url, f"{IMAGE_REF_MARK}img:{position}{IMAGE_REF_MARK}")
+        # Checkpoints of an answer still streaming stay plain; it is compressed once finished
+        if self.status == 'streaming':
+            self.codec, self._content = None, content
+        else:
+            self.codec, self._content = compress_text(content)
+
+    def update(self, content, images=None, status=None):
+        """Replace the content of an in-progress message"""
+        if images is not None:
+            self.images = tuple(images)
+        self.status = status
+        self._set_content(content)
+
+    @property
+    def content(self):
+        content = decompress_text(self.codec, self._content)
+        if self.images:
+            content = IMAGE_REF_PATTERN.sub(self._expand_image, content)
+        return content
+
+    def _expand_image(self, match):
+        position = int(match.group(1))
+        return self.images[position] if position < len(self.images) else ''
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created).isoformat()
+
+    def to_dict(self):
+        data = {
+            "role": self.role,
+            "content": self.content,
+            "timestamp": self.timestamp
+        }
+        if self.images is not None:
+            data["images"] = list(self.images) or None
+        if self.status:
+            data["status"] = self.status
+        return data
+
+
+class Conversation:
+    """A stored conversation: slotted record serialised to the original API JSON"""
+
+    __slots__ = ('id', 'title', 'created', 'messages')
+
+    def __init__(self, conversation_id, title, created=None, messages=None):
+        self.id = conversation_id
+        self.title = title
+        self.created = time.time() if created is None else created
+        self.messages = messages if messages is not None else []
+
+    @property
+    def created_at(self):
+        return datetime.fromtimestamp(self.created).isoformat()
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "title": self.title or 'Untitled',
+            "created_at": self.created_at,
+            "message_count": len(self.messages)
+        }
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "created_at": self.created_at,
+            "messages": [message.to_dict() for message in self.messages],
+            "title": self.title
+        }
+
+
+SEARCH_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase word tokens used by the in-memory search index"""
+    return [token for token in SEARCH_TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+class ConversationSearchIndex:
+    """Incremental inverted index over one user's in-memory messages.
+
+    Documents are (conversation_id, message_index) pairs. Postings keep the
+    term frequency per document so queries are ranked with BM25 and only
+    touch the postings of the query terms, not every stored message.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}  # term -> {doc: term frequency}
+        self._doc_terms = {}  # doc -> tuple of distinct terms
+        self._doc_lengths = {}  # doc -> token count
+        self._total_length = 0
+
+    def add(self, conversation_id, position, text):
+        doc = (conversation_id, position)
+        terms = tokenize(DATA_URL_PATTERN.sub(' ', text or ''))  # inline images are not searchable text
+        counts = Counter(terms)
+        with self._lock:
+            if doc in self._doc_terms:
+                self._remove_doc(doc)
+            if not terms:
+                return
+            for term, frequency in counts.items():
+                self._postings.setdefault(term, {})[doc] = frequency
+            self._doc_terms[doc] = tuple(counts)
+            self._doc_lengths[doc] = len(terms)
+            self._total_length += len(terms)
+
+    def _remove_doc(self, doc):
+        for term in self._doc_terms.pop(doc):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(doc)
+
+    def remove_conversation(self, conversation_id):
+        with self._lock:
+            for doc in [doc for doc in self._doc_terms if doc[0] == conversation_id]:
+                self._remove_doc(doc)
+
+    def search(self, query, limit, offset=0):
+        """Return (total_hits, [(doc, score), ...]) for one page of results"""
+        terms = set(tokenize(query))
+        scores = defaultdict(float)
+        with self._lock:
+            doc_count = len(self._doc_lengths)
+            if not terms or not doc_count:
+                return 0, []
+            average_length = self._total_length / doc_count
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc, frequency in postings.items():
+                    norm = self.K1 * (1 - self.B + self.B * self._doc_lengths[doc] / average_length)
+                    scores[doc] += idf * frequency * (self.K1 + 1) / (frequency + norm)
+        top = heapq.nlargest(offset + limit, scores.items(), key=lambda item: item[1])
+        return len(scores), top[offset:]
+
+
+# Format: {user_id: ConversationSearchIndex}
+search_indexes = {}
+
+
+def search_index_for(user_id):
+    """Get or create the in-memory search index for a user"""
+    index = search_indexes.get(user_id)
+    if index is None:
+        index = search_indexes.setdefault(user_id, ConversationSearchIndex())
+    return index
+
+
+def make_snippet(text, query, width=160):
+    """Cut a window of text around the first query term match"""
+    text = DATA_URL_PATTERN.sub('[image]', text)
+    lowered = text.lower()
+    positions = []
+    for term in tokenize(query):
+        match = re.search(r'\b' + re.escape(term), lowered)
+        if match:
+            positions.append(match.start())
+    start = max(0, min(positions) - width // 3) if positions else 0
+    snippet = text[start:start + width].strip()
+    if start > 0:
+        snippet = "..." + snippet
+    if start + width < len(text):
+        snippet += "..."
+    return snippet
+
+
+class HashingEmbedder:
+    """Deterministic local embedder: signed feature hashing of word unigrams and bigrams.
+
+    No model or network call, so it is cheap enough for the request path and
+    gives stable vectors in tests; it matches shared wording, not meaning.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = tokenize(text)
+        features = Counter(tokens)
+        features.update(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+        for feature, count in features.items():
+            digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+            vector[digest % self.dim] += (1.0 + math.log(count)) * (1 if digest >> 63 else -1)
+        return vector
+
+    def embed(self, texts, query=False):
+        return normalize_rows(np.stack([self._vector(text) for text in texts]) if texts else np.zeros((0, self.dim), np.float32))
+
+
+class GeminiEmbedder:
+    """Embeddings from the Gemini embedding API (one call per batch)"""
+
+    def __init__(self, dim, model_name=EMBEDDING_MODEL):
+        self.dim = dim
+        self.model_name = model_name
+
+    def embed(self, texts, query=False):
+        if not texts:
+            return np.zeros((0, self.dim), np.float32)
+        result = genai.embed_content(
+            model=self.model_name,
+            content=list(texts),
+            task_type='retrieval_query' if query else 'retrieval_document',
+            output_dimensionality=self.dim
+        )
+        return normalize_rows(np.asarray(result['embedding'], dtype=np.float32).reshape(len(texts), self.dim))
+
+
+EMBEDDERS = {"hashing": HashingEmbedder, "gemini": GeminiEmbedder}
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def embedding_text(text):
+    """The part of a message that gets embedded: no inline image data, capped length"""
+    return DATA_URL_PATTERN.sub(' ', text[:EMBEDDING_MAX_CHARS * 2])[:EMBEDDING_MAX_CHARS]
+
+
+class VectorIndex:
+    """One user's message embeddings in a growable NumPy matrix.
+
+    Rows are unit vectors, so a query is a single matrix product (cosine
+    similarity against every message at once) followed by an argpartition
+    top-k. Each row remembers its (conversation_id, position) and the Message
+    it was built from, so hits for cleared or replaced messages can be
+    recognised and skipped. Removed rows are masked and compacted away once
+    they outnumber the live ones.
+    """
+
+    def __init__(self, dim, capacity=256):
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._conversations = np.zeros(capacity, dtype=np.int32)  # conversation code per row
+        self._positions = np.zeros(capacity, dtype=np.int32)
+        self._messages = [None] * capacity
+        self._codes = {}  # conversation_id -> code
+        self._ids = []  # code -> conversation_id
+        self._rows = {}  # (conversation_id, position) -> row
+        self._size = 0
+        self._dead = 0
+
+    def _code(self, conversation_id):
+        code = self._codes.get(conversation_id)
+        if code is None:
+            code = self._codes[conversation_id] = len(self._ids)
+            self._ids.append(conversation_id)
+        return code
+
+    def _grow(self, needed):
+        capacity = len(self._alive)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        extra = capacity - len(self._alive)
+        self._vectors = np.concatenate([self._vectors, np.zeros((extra, self.dim), dtype=np.float32)])
+        self._alive = np.concatenate([self._alive, np.zeros(extra, dtype=bool)])
+        self._conversations = np.concatenate([self._conversations, np.zeros(extra, dtype=np.int32)])
+        self._positions = np.concatenate([self._positions, np.zeros(extra, dtype=np.int32)])
+        self._messages.extend([None] * extra)
+
+    def _kill(self, row):
+        if self._alive[row]:
+            self._alive[row] = False
+            self._messages[row] = None
+            self._dead += 1
+
+    def add(self, entries, vectors):
+        """Add (conversation_id, position, message) entries with their embedding rows"""
+        with self._lock:
+            self._grow(self._size + len(entries))
+            for (conversation_id, position, message), vector in zip(entries, vectors):
+                previous = self._rows.get((conversation_id, position))
+                if previous is not None:
+                    self._kill(previous)
+                row = self._size
+                self._size += 1
+                self._vectors[row] = vector
+                self._alive[row] = True
+                self._conversations[row] = self._code(conversation_id)
+                self._positions[row] = position
+                self._messages[row] = message
+                self._rows[(conversation_id, position)] = row
+
+    def remove_conversation(self, conversation_id):
+        with self._lock:
+            for doc in [doc for doc in self._rows if doc[0] == conversation_id]:
+                self._kill(self._rows.pop(doc))
+            if self._dead > 1024 and self._dead > self._size - self._dead:
+                self._compact()
+
+    def _compact(self):
+        live = np.flatnonzero(self._alive[:self._size])
+        capacity = max(256, len(self._alive) // 2 if len(live) < len(self._alive) // 4 else len(self._alive))
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:len(live)] = self._vectors[live]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(live)] = True
+        conversations = np.zeros(capacity, dtype=np.int32)
+        conversations[:len(live)] = self._conversations[live]
+        positions = np.zeros(capacity, dtype=np.int32)
+        positions[:len(live)] = self._positions[live]
+        messages = [self._messages[row] for row in live] + [None] * (capacity - len(live))
+        self._vectors, self._alive, self._conversations, self._positions, self._messages = vectors, alive, conversations, positions, messages
+        self._rows = {(self._ids[conversations[row]], int(positions[row])): row for row in range(len(live))}
+        self._size = len(live)
+        self._dead = 0
+
+    def search(self, queries, k, exclude_conversation=None, exclude_from=0):
+        """Top-k rows per query vector as [[(conversation_id, position, message, score), ...], ...].
+
+        Rows of exclude_conversation at positions >= exclude_from (the recent
+        window already sent in full) are left out.
+        """
+        with self._lock:
+            size = self._size
+            if not size or not len(queries):
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self._vectors[:size].T
+            skip = ~self._alive[:size]
+            code = self._codes.get(exclude_conversation)
+            if code is not None:
+                skip |= (self._conversations[:size] == code) & (self._positions[:size] >= exclude_from)
+            scores[:, skip] = -np.inf
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for query_scores, rows in zip(scores, top):
+                rows = rows[np.argsort(-query_scores[rows])]
+                results.append([(self._ids[self._conversations[row]], int(self._positions[row]), self._messages[row], float(query_scores[row]))
+                                for row in rows if query_scores[row] > -np.inf])
+            return results
+
+    def __len__(self):
+        return self._size - self._dead
+
+
+# Format: {user_id: VectorIndex}
+vector_indexes = {}
+
+
+def vector_index_for(user_id):
+    """Get or create the embedding index for a user"""
+    index = vector_indexes.get(user_id)
+    if index is None:
+        index = vector_indexes.setdefault(user_id, VectorIndex(EMBEDDING_DIM))
+    return index
+
+
+class EmbeddingWriter:
+    """Embeds stored messages in batches on a background thread.
+
+    Keeps embedding calls (possibly remote) off the request path; the newest
+    messages are in the recent window anyway, so a short indexing delay
+    doesn't change what the model sees.
+    """
+
+    def __init__(self, embedder, interval, batch_size):
+        self.embedder = embedder
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []  # (user_id, conversation_id, position, message, text)
+        self._thread = None
+        self.embedded = 0
+        self.failed = 0
+        self.embed_seconds = 0.0
+
+    def submit(self, user_id, conversation_id, position, message, text):
+        text = embedding_text(text or '')
+        if not text.strip():
+            return
+        with self._lock:
+            self._pending.append((user_id, conversation_id, position, message, text))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-writer', daemon=True)
+                self._thread.start()
+
+    def discard(self, user_id, conversation_id):
+        with self._lock:
+            self._pending = [item for item in self._pending if item[:2] != (user_id, conversation_id)]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            by_user = defaultdict(list)
+            for user_id, conversation_id, position, message, text in pending:
+                by_user[user_id].append(((conversation_id, position, message), text))
+            for user_id, items in by_user.items():
+                for start in range(0, len(items), self.batch_size):
+                    batch = items[start:start + self.batch_size]
+                    try:
+                        started = time.perf_counter()
+                        vectors = self.embedder.embed([text for _, text in batch])
+                        self.embed_seconds += time.perf_counter() - started
+                    except Exception as e:
+                        self.failed += len(batch)
+                        print(f"⚠️ Failed to embed {len(batch)} message(s) for user {user_id}: {e}")
+                        continue
+                    vector_index_for(user_id).add([entry for entry, _ in batch], vectors)
+                    self.embedded += len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def metrics(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "embedder": HISTORY_EMBEDDER,
+            "pending": pending,
+            "embedded": self.embedded,
+            "failed": self.failed,
+            "embed_ms": round(self.embed_seconds * 1000, 1),
+            "indexed_users": len(vector_indexes),
+            "indexed_messages": sum(len(index) for index in list(vector_indexes.values()))
+        }
+
+
+history_embedder = EMBEDDERS.get(HISTORY_EMBEDDER, HashingEmbedder)(EMBEDDING_DIM)
+embedding_writer = EmbeddingWriter(history_embedder, EMBEDDING_FLUSH_INTERVAL, EMBEDDING_BATCH_SIZE)
+if HISTORY_RETRIEVAL:
+    metrics_sources["history_retrieval"] = embedding_writer.metrics
+
+
+def index_message(user_id, conversation_id, position, message, content=None):
+    """Add a stored message to the user's search index (and embedding index when retrieval is on)"""
+    content = message.content if content is None else content
+    search_index_for(user_id).add(conversation_id, position, content)
+    if HISTORY_RETRIEVAL:
+        embedding_writer.submit(user_id, conversation_id, position, message, content)
+
+
+def unindex_conversation(user_id, conversation_id):
+    """Drop a conversation's messages from the user's indexes"""
+    search_index_for(user_id).remove_conversation(conversation_id)
+    if HISTORY_RETRIEVAL:
+        embedding_writer.discard(user_id, conversation_id)
+        vector_index_for(user_id).remove_conversation(conversation_id)
+
+
+# Serialises turns within one conversation when requests run on several threads
+conversation_locks = {}
+conversation_locks_guard = threading.Lock()
+
+
+def conversation_lock(user_id, conversation_id):
+    """Return the lock guarding one conversation's history"""
+    with conversation_locks_guard:
+        return conversation_locks.setdefault((user_id, conversation_id), threading.Lock())
+
+
+def estimate_message_bytes(message):
+    """Rough resident size of a stored message"""
+    return MESSAGE_OVERHEAD_BYTES + len(message._content) + sum(len(image) for image in message.images or ())
+
+
+class ConversationCache:
+    """Bounds the conversations resident in worker memory.
+
+    Entries are kept in LRU order with an estimated size. Conversations
+    idle for longer than idle_ttl, or the least recently used ones while
+    the estimate is over max_bytes, are evicted. Conversations pinned by
+    an in-flight turn are never evicted. Without PERSIST_CONVERSATIONS
+    worker memory is the only copy, so nothing is evicted and going over
+    the budget is only logged.
+    """
+
+    def __init__(self, max_bytes, idle_ttl):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (user_id, conversation_id) -> [last access, estimated bytes]
+        self._pins = Counter()
+        self.resident_bytes = 0
+        self.evictions = {"budget": 0, "idle": 0}
+        self.reloads = 0
+        self.over_budget = False
+
+    def touch(self, key, added_bytes=0):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [0.0, CONVERSATION_OVERHEAD_BYTES]
+                self.resident_bytes += CONVERSATION_OVERHEAD_BYTES
+            else:
+                self._entries.move_to_end(key)
+            entry[0] = time.monotonic()
+            entry[1] += added_bytes
+            self.resident_bytes += added_bytes
+
+    def reset(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.resident_bytes -= entry[1] - CONVERSATION_OVERHEAD_BYTES
+                entry[1] = CONVERSATION_OVERHEAD_BYTES
+
+    def forget(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+
+    def pin(self, key):
+        with self._lock:
+            self._pins[key] += 1
+
+    def unpin(self, key):
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+
+    @contextmanager
+    def pinned(self, key):
+        """Keep a conversation resident for the duration of a turn"""
+        self.pin(key)
+        try:
+            yield
+        finally:
+            self.unpin(key)
+
+    def collect(self):
+        """Evict idle conversations and cold ones beyond the memory budget"""
+        if not PERSIST_CONVERSATIONS:
+            with self._lock:
+                over_budget = self.resident_bytes > self.max_bytes
+                warn = over_budget and not self.over_budget
+                self.over_budget = over_budget
+            if warn:
+                print(f"⚠️ Conversations use ~{self.resident_bytes} bytes, over the {self.max_bytes} byte budget; "
+                      "not evicting because PERSIST_CONVERSATIONS is off")
+            return
+        victims = []
+        with self._lock:
+            now = time.monotonic()
+            projected = self.resident_bytes
+            for key, (last_access, size) in self._entries.items():
+                idle = self.idle_ttl and now - last_access > self.idle_ttl
+                if not idle and projected <= self.max_bytes:
+                    break
+                if self._pins[key]:
+                    continue
+                victims.append((key, last_access, "idle" if idle else "budget"))
+                projected -= size
+        for key, last_access, reason in victims:
+            # Evicted under the lock, and only if no turn pinned or touched it since it was picked
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != last_access or self._pins[key]:
+                    continue
+                del self._entries[key]
+                self.resident_bytes -= entry[1]
+                self.evictions[reason] += 1
+                evict_conversation(*key)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "resident_conversations": len(self._entries),
+                "estimated_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "idle_ttl_seconds": self.idle_ttl,
+                "pinned": len(self._pins),
+                "evictions": dict(self.evictions),
+                "reloads": self.reloads
+            }
+
+
+conversation_cache = ConversationCache(CONVERSATION_CACHE_MAX_BYTES, CONVERSATION_IDLE_TTL)
+metrics_sources["conversation_cache"] = conversation_cache.metrics
+
+
+def evict_conversation(user_id, conversation_id):
+    """Drop a cold conversation from worker memory (durable, as the cache only evicts with persistence on).
+
+    Called with the conversation cache lock held, so no turn can pin the conversation meanwhile.
+    """
+    conversations = user_conversations.get(user_id, {})
+    if conversations.pop(conversation_id, None) is None:
+        return
+    with conversation_locks_guard:
+        conversation_locks.pop((user_id, conversation_id), None)
+    unindex_conversation(user_id, conversation_id)
+    if not conversations:
+        user_conversations.pop(user_id, None)
+        search_indexes.pop(user_id, None)
+        vector_indexes.pop(user_id, None)
+    print(f"♻️ Evicted conversation {conversation_id} for user {user_id}")
+
+
+@traced('db.load_conversation')
+def load_conversation(user_id, conversation_id):
+    """Load a persisted conversation owned by the user, or None"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, title, created_at FROM conversations WHERE id = %s AND user_id = %s", (conversation_id, user_id))
+    row = cur.fetchone()
+    if not row:
+        cur.close()
+        conn.close()
+        return None
+    cur.execute(
+        "SELECT role, content, content_codec, content_blob, created_at, status FROM messages WHERE conversation_id = %s ORDER BY id",
+        (conversation_id,)
+    )
+    messages = [Message.from_row(m['role'], m['content'], m['content_codec'], m['content_blob'],
+                                 m['created_at'].timestamp() if m['created_at'] else None, status=m['status'])
+                for m in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return Conversation(row['id'], row['title'], row['created_at'].timestamp() if row['created_at'] else None, messages)
+
+
+def get_conversation_record(user_id, conversation_id):
+    """Return a user's conversation, reloading it from the database if it was evicted"""
+    key = (user_id, conversation_id)
+    conversation = user_conversations.get(user_id, {}).get(conversation_id)
+    if conversation is not None:
+        conversation_cache.touch(key)
+        return conversation
+    if not PERSIST_CONVERSATIONS:
+        return None
+    
+    loaded = load_conversation(user_id, conversation_id)
+    if loaded is None:
+        return None
+    conversation = user_conversations.setdefault(user_id, {}).setdefault(conversation_id, loaded)
+    if conversation is loaded:
+        for position, message in enumerate(loaded.messages):
+            index_message(user_id, conversation_id, position, message)
+        conversation_cache.touch(key, sum(estimate_message_bytes(message) for message in loaded.messages))
+        conversation_cache.reloads += 1
+        print(f"🔄 Reloaded conversation {conversation_id} ({len(loaded.messages)} messages)")
+    return conversation
+
+
+@traced('db.list_conversations')
+def list_conversations_db(user_id):
+    """Conversation summaries from the database, newest first"""
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT c.id, c.title, c.created_at, COUNT(m.id) AS message_count
+        FROM conversations c
+        LEFT JOIN messages m ON m.conversation_id = c.id
+        WHERE c.user_id = %s
+        GROUP BY c.id
+        ORDER BY c.created_at DESC
+        """,
+        (user_id,)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return [{
+        "id": row['id'],
+        "title": row['title'] or 'Untitled',
+        "created_at": row['created_at'].isoformat() if row['created_at'] else None,
+        "message_count": row['message_count']
+    } for row in rows]
+
+
+class ConversationConflict(Exception):
+    """A client-supplied conversation id is already taken by another user"""
+
+    def __init__(self, conversation_id):
+        super().__init__(f"Conversation id {conversation_id} is already in use")
+        self.conversation_id = conversation_id
+
+
+def ensure_conversation(user_id, conversation_id, title):
+    """Get or create a conversation for a user; raises ConversationConflict if another user owns the id"""
+    conversation = get_conversation_record(user_id, conversation_id)
+    if conversation is None:
+        created = Conversation(conversation_id, title)
+        conversation = user_conversations.setdefault(user_id, {}).setdefault(conversation_id, created)
+        if conversation is created:
+            print(f"✨ Creating new conversation: {conversation_id}")
+            conversation_cache.touch((user_id, conversation_id))
+            if PERSIST_CONVERSATIONS:
+                if persist_conversation(user_id, conversation) is False:
+                    user_conversations[user_id].pop(conversation_id, None)
+                    conversation_cache.forget((user_id, conversation_id))
+                    raise ConversationConflict(conversation_id)
+                note_user_write(user_id)
+            conversation_cache.collect()
+    return conversation
+
+
+def append_message(user_id, conversation_id, message):
+    """Append a message to a conversation and keep the search index, cache accounting and database in sync.
+
+    Returns the database row id when persistence is on, otherwise None.
+    """
+    content = message.content
+    messages = ensure_conversation(user_id, conversation_id, content[:50]).messages
+    messages.append(message)
+    index_message(user_id, conversation_id, len(messages) - 1, message, content)
+    row_id = None
+    if PERSIST_CONVERSATIONS:
+        row_id = persist_message(user_id, conversation_id, message, content)
+        note_user_write(user_id)
+    conversation_cache.touch((user_id, conversation_id), estimate_message_bytes(message))
+    conversation_cache.collect()
+    return row_id
+
+
+def build_history(conversation):
+    """Conversation messages in the shape start_chat expects (skipping empty placeholders)"""
+    return [{"role": msg.role, "parts": [msg.content]} for msg in conversation.messages if msg.content]
+
+
+def retrieve_history(user_id, conversation, query):
+    """History for start_chat: the whole conversation, or with HISTORY_RETRIEVAL the last
+    HISTORY_RECENT_MESSAGES plus the older messages (from any of the user's resident
+    conversations) most similar to the new prompt, given to the model as one context turn."""
+    if not HISTORY_RETRIEVAL:
+        return build_history(conversation)
+    messages = conversation.messages
+    cutoff = max(len(messages) - HISTORY_RECENT_MESSAGES, 0)
+    if cutoff and messages[cutoff].role != 'user':
+        cutoff -= 1  # Start the window on a user turn
+    recent = [{"role": msg.role, "parts": [msg.content]} for msg in messages[cutoff:] if msg.content]
+    
+    hits = vector_index_for(user_id).search(
+        history_embedder.embed([embedding_text(query)], query=True),
+        HISTORY_RETRIEVAL_TOP_K, exclude_conversation=conversation.id, exclude_from=cutoff)[0]
+    conversations = user_conversations.get(user_id, {})
+    relevant = []
+    for conversation_id, position, message, score in hits:
+        if score < HISTORY_RETRIEVAL_MIN_SCORE:
+            break
+        owner = conversations.get(conversation_id)
+        # Skip hits for messages that were cleared, deleted or replaced since they were indexed
+        if owner is None or position >= len(owner.messages) or owner.messages[position] is not message:
+            continue
+        relevant.append((message, owner))
+    if not relevant:
+        return recent
+    
+    relevant.sort(key=lambda hit: hit[0].created)
+    lines = []
+    for message, owner in relevant:
+        content = DATA_URL_PATTERN.sub('[image]', message.content)
+        if len(content) > RETRIEVED_MESSAGE_MAX_CHARS:
+            content = content[:RETRIEVED_MESSAGE_MAX_CHARS] + "..."
+        lines.append(f"[{owner.title or 'Untitled'}, {datetime.fromtimestamp(message.created):%Y-%m-%d}] {message.role}: {content}")
+    context = "Earlier messages that may be relevant to this conversation:\n\n" + "\n\n".join(lines)
+    return [{"role": "user", "parts": [context]}, {"role": "model", "parts": ["Noted, I'll use these if they're relevant."]}] + recent
+
+
+@traced('db.persist_conversation')
+def persist_conversation(user_id, conversation):
+    """Write a new conversation row (write-through persistence).
+
+    Returns False if the id already belongs to another user, True once the
+    row is this user's, and None if the write failed.
+    """
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO conversations (id, user_id, title) VALUES (%s, %s, %s)
+               ON CONFLICT (id) DO NOTHING RETURNING id""",
+            (conversation.id, user_id, conversation.title[:200])
+        )
+        owned = cur.fetchone() is not None
+        if not owned:
+            cur.execute("SELECT user_id FROM conversations WHERE id = %s", (conversation.id,))
+            row = cur.fetchone()
+            owned = row is None or row['user_id'] == user_id
+        conn.commit()
+        cur.close()
+        conn.close()
+        if not owned:
+            print(f"⚠️ Conversation id {conversation.id} is owned by another user")
+        return owned
+    except Exception as e:
+        print(f"⚠️ Failed to persist conversation {conversation.id}: {e}")
+        return None
+
+
+@traced('db.persist_message')
+def persist_message(user_id, conversation_id, message, content=None):
+    """Write a message row and bump the conversation's updated_at (write-through persistence); returns the row id.
+
+    Nothing is written unless user_id owns the conversation row.
+    """
+    try:
+        content, codec, blob, search_text = stored_content(message.content if content is None else content)
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO messages (conversation_id, role, content, content_codec, content_blob, content_tsv, status)
+               SELECT %s, %s, %s, %s, %s, to_tsvector('english', %s), %s
+               WHERE EXISTS (SELECT 1 FROM conversations WHERE id = %s AND user_id = %s)
+               RETURNING id""",
+            (conversation_id, message.role, content, codec, blob, search_text, message.status, conversation_id, user_id)
+        )
+        row = cur.fetchone()
+        if row is not None:
+            cur.execute(
+                "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = %s AND user_id = %s",
+                (conversation_id, user_id)
+            )
+        conn.commit()
+        cur.close()
+        conn.close()
+        if row is None:
+            print(f"⚠️ Conversation {conversation_id} is not persisted for user {user_id}; message not saved")
+            return None
+        return row['id']
+    except Exception as e:
+        print(f"⚠️ Failed to persist message for conversation {conversation_id}: {e}")
+        return None
+
+
+@traced('db.delete_messages')
+def delete_persisted_messages(user_id, conversation_id, delete_conversation=False):
+    """Remove a user's persisted conversation messages (and optionally the conversation itself)"""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        if delete_conversation:
+            cur.execute("DELETE FROM conversations WHERE id = %s AND user_id = %s", (conversation_id, user_id))
+        else:
+            cur.execute(
+                """DELETE FROM messages WHERE conversation_id = %s
+                   AND EXISTS (SELECT 1 FROM conversations WHERE id = %s AND user_id = %s)""",
+                (conversation_id, conversation_id, user_id)
+            )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ Failed to delete persisted data for conversation {conversation_id}: {e}")
+
+
+@traced('db.search_messages')
+def search_messages_db(user_id, query, limit, offset):
+    """Ranked full-text search over persisted messages using the GIN tsvector index"""
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT hits.*,
+               (SELECT COUNT(*) FROM messages prior
+                 WHERE prior.conversation_id = hits.conversation_id AND prior.id < hits.id) AS message_index
+        FROM (
+            SELECT m.id, m.conversation_id, c.title, m.role, m.created_at,
+                   ts_rank_cd(m.content_tsv, q) AS score,
+                   CASE WHEN m.content_codec IS NULL
+                        THEN ts_headline('english', m.content, q, 'MaxWords=30, MinWords=12, StartSel="", StopSel=""')
+                   END AS snippet,
+                   m.content_codec, m.content_blob,
+                   COUNT(*) OVER () AS total
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id,
+                 plainto_tsquery('english', %s) q
+            WHERE c.user_id = %s AND m.content_tsv @@ q
+            ORDER BY score DESC, m.created_at DESC
+            LIMIT %s OFFSET %s
+        ) hits
+        ORDER BY hits.score DESC, hits.created_at DESC
+        """,
+        (query, user_id, limit, offset)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    total = rows[0]['total'] if rows else 0
+    results = [{
+        "conversation_id": row['conversation_id'],
+        "conversation_title": row['title'],
+        "message_index": row['message_index'],
+        "role": row['role'],
+        "timestamp": row['created_at'].isoformat() if row['created_at'] else None,
+        # Compressed rows are snippeted here, only for the page of hits
+        "snippet": row['snippet'] if row['content_codec'] is None else
+                   make_snippet(decompress_text(row['content_codec'], row['content_blob']), query),
+        "score": round(float(row['score']), 4)
+    } for row in rows]
+    return total, results
+
+
+@traced('search.memory')
+def search_messages_memory(user_id, query, limit, offset):
+    """Ranked search over the in-memory conversations of a user"""
+    total, hits = search_index_for(user_id).search(query, limit, offset)
+    conversations = user_conversations.get(user_id, {})
+    results = []
+    for (conversation_id, position), score in hits:
+        conversation = conversations.get(conversation_id)
+        if not conversation or position >= len(conversation.messages):
+            continue
+        message = conversation.messages[position]
+        results.append({
+            "conversation_id": conversation_id,
+            "conversation_title": conversation.title or 'Untitled',
+            "message_index": position,
+            "role": message.role,
+            "timestamp": message.timestamp,
+            "snippet": make_snippet(message.content, query),
+            "score": round(score, 4)
+        })
+    return total, results
+
+
+def iter_conversations_memory(user_id):
+    """Yield a user's in-memory conversations one at a time"""
+    conversations = user_conversations.get(user_id, {})
+    for conversation_id in list(conversations):
+        conversation = conversations.get(conversation_id)
+        if conversation is not None:
+            yield conversation.to_dict()
+
+
+def iter_conversations_db(user_id):
+    """Yield a user's persisted conversations via a server-side cursor (one conversation in memory at a time)"""
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+    cur.itersize = EXPORT_FETCH_SIZE
+    try:
+        cur.execute(
+            """
+            SELECT c.id, c.title, c.created_at, m.role, m.content, m.content_codec, m.content_blob,
+                   m.created_at AS message_created_at
+            FROM conversations c
+            LEFT JOIN messages m ON m.conversation_id = c.id
+            WHERE c.user_id = %s
+            ORDER BY c.created_at, c.id, m.id
+            """,
+            (user_id,)
+        )
+        conversation = None
+        for row in cur:
+            if conversation is None or conversation['id'] != row['id']:
+                if conversation is not None:
+                    yield conversation
+                conversation = {
+                    "id": row['id'],
+                    "created_at": row['created_at'].isoformat() if row['created_at'] else None,
+                    "messages": [],
+                    "title": row['title']
+                }
+            if row['role'] is not None:
+                conversation['messages'].append({
+                    "role": row['role'],
+                    "content": read_stored_content(row),
+                    "timestamp": row['message_created_at'].isoformat() if row['message_created_at'] else None
+                })
+        if conversation is not None:
+            yield conversation
+    finally:
+        cur.close()
+        conn.close()
+
+
+def export_ndjson(conversations, compress=False):
+    """Encode conversations as NDJSON, flushing in EXPORT_CHUNK_BYTES pieces (optionally gzip-compressed)"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    buffered = 0
+    count = 0
+    started = time.perf_counter()
+    for conversation in conversations:
+        line = json.dumps(conversation, default=str) + "\n"
+        buffer.append(line)
+        buffered += len(line)
+        count += 1
+        if buffered >= EXPORT_CHUNK_BYTES:
+            data = "".join(buffer).encode('utf-8')
+            buffer, buffered = [], 0
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    data = "".join(buffer).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+    elapsed = time.perf_counter() - started
+    print(f"📤 Exported {count} conversations in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} conv/s)")
+
+
+def parse_import_line(line):
+    """Validate one NDJSON line of an import and return a normalised conversation"""
+    conversation = json.loads(line)
+    if not isinstance(conversation, dict) or not isinstance(conversation.get('messages'), list):
+        raise ValueError("each line must be a conversation object with a messages list")
+    messages = []
+    for message in conversation['messages']:
+        if not isinstance(message, dict) or message.get('role') not in ('user', 'model') or not isinstance(message.get('content'), str):
+            raise ValueError("messages need a role of 'user' or 'model' and string content")
+        messages.append(Message(message['role'], message['content'], to_epoch(message.get('timestamp')), message.get('images')))
+    return Conversation(
+        str(conversation.get('id') or uuid.uuid4())[:64],
+        str(conversation.get('title') or 'Imported Conversation')[:200],
+        to_epoch(conversation.get('created_at')),
+        messages
+    )
+
+
+@traced('db.import_batch')
+def import_batch_db(user_id, batch):
+    """Bulk insert a batch of conversations and their messages with multi-row INSERTs"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        rows = [(c.id, user_id, c.title, datetime.fromtimestamp(c.created)) for c in batch]
+        inserted = execute_values(
+            cur,
+            """INSERT INTO conversations (id, user_id, title, created_at) VALUES %s
+               ON CONFLICT (id) DO NOTHING RETURNING id""",
+            rows,
+            fetch=True
+        )
+        inserted_ids = {row['id'] for row in inserted}
+        
+        # Ids already taken (by this or another user) get a fresh id instead of merging
+        conflicts = [c for c in batch if c.id not in inserted_ids]
+        for conversation in conflicts:
+            conversation.id = str(uuid.uuid4())
+        if conflicts:
+            execute_values(
+                cur,
+                "INSERT INTO conversations (id, user_id, title, created_at) VALUES %s",
+                [(c.id, user_id, c.title, datetime.fromtimestamp(c.created)) for c in conflicts]
+            )
+        
+        execute_values(
+            cur,
+            "INSERT INTO messages (conversation_id, role, content, content_codec, content_blob, content_tsv, created_at) VALUES %s",
+            [(c.id, m.role, *stored_content(m.content), datetime.fromtimestamp(m.created)) for c in batch for m in c.messages],
+            template="(%s, %s, %s, %s, %s, to_tsvector('english', %s), %s)",
+            page_size=IMPORT_BATCH_SIZE
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def import_batch_memory(user_id, batch):
+    """Load a batch of imported conversations into worker memory and the search index"""
+    conversations = user_conversations.setdefault(user_id, {})
+    for conversation in batch:
+        if conversation.id in conversations:
+            conversation.id = str(uuid.uuid4())
+        conversations[conversation.id] = conversation
+        for position, message in enumerate(conversation.messages):
+            index_message(user_id, conversation.id, position, message)
+        conversation_cache.touch((user_id, conversation.id), sum(estimate_message_bytes(m) for m in conversation.messages))
+    conversation_cache.collect()
+
+# Model configuration
+MODEL_NAME = "gemini-3-flash-preview"
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', 64))
+
+# Server-side context caching for long system prompts ('gemini', 'local' or 'off')
+CONTEXT_CACHE_BACKEND = os.getenv('CONTEXT_CACHE_BACKEND', 'gemini').lower()
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv('CONTEXT_CACHE_MIN_CHARS', 16000))  # roughly 4k tokens
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', 3600))
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv('CONTEXT_CACHE_REFRESH_MARGIN', 60))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv('CONTEXT_CACHE_MAX_ENTRIES', 32))
+
+IMAGE_SYSTEM_PROMPT = """You are an AI with native image generation capabilities. When the user asks you to generate, create, or make an image, you must DIRECTLY generate and output the image - do not describe it or return JSON. The image will be automatically displayed to the user."""
+generation_config = {
+    "temperature": 0.9,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+
+safety_settings = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+# ============= CONTEXT CACHE =============
+
+class GeminiContextBackend:
+    """Server-side cached contexts through the Gemini caching API"""
+
+    def create(self, model_name, system_instruction, ttl_seconds):
+        cached = caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            ttl=timedelta(seconds=ttl_seconds)
+        )
+        return cached.name
+
+    def model(self, name):
+        return genai.GenerativeModel.from_cached_content(
+            caching.CachedContent.get(name),
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
+
+    def delete(self, name):
+        caching.CachedContent.get(name).delete()
+
+
+class LocalContextBackend:
+    """In-process stand-in for the caching API, for development and tests without Gemini quota"""
+
+    def __init__(self):
+        self.contexts = {}
+
+    def create(self, model_name, system_instruction, ttl_seconds):
+        name = f"cachedContents/local-{uuid.uuid4().hex[:12]}"
+        self.contexts[name] = (model_name, system_instruction)
+        return name
+
+    def model(self, name):
+        model_name, system_instruction = self.contexts[name]
+        return genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+            system_instruction=system_instruction
+        )
+
+    def delete(self, name):
+        self.contexts.pop(name, None)
+
+
+class ContextCache:
+    """Reuses cached contexts for large system prompts, keyed by model and prompt hash.
+
+    A context is created on first use and reused until shortly before its
+    TTL runs out, so a long preamble is uploaded and billed once per TTL
+    window instead of on every turn. The least recently used contexts beyond
+    max_entries are deleted server-side.
+    """
+
+    def __init__(self, backend, ttl_seconds, max_entries):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (model_name, prompt hash) -> entry dict
+        self.stats = {"created": 0, "hits": 0, "failures": 0, "deleted": 0}
+
+    def model_for(self, model_name, system_instruction):
+        """Model bound to a cached context for this prompt, or None to fall back to a plain system instruction"""
+        key = (model_name, hashlib.sha256(system_instruction.encode('utf-8')).hexdigest())
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] - now > CONTEXT_CACHE_REFRESH_MARGIN:
+                entry["hits"] += 1
+                entry["last_used"] = now
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry["model"]
+            stale = self._entries.pop(key, None)
+        if stale:
+            self._delete(stale["name"])
+        
+        try:
+            name = self.backend.create(model_name, system_instruction, self.ttl_seconds)
+            model = self.backend.model(name)
+        except Exception as e:
+            print(f"⚠️ Context cache unavailable for {model_name}: {e}")
+            with self._lock:
+                self.stats["failures"] += 1
+            return None
+        
+        print(f"🧊 Created cached context {name} for {model_name} ({len(system_instruction)} chars)")
+        evicted = []
+        with self._lock:
+            self._entries[key] = {
+                "name": name,
+                "model": model,
+                "chars": len(system_instruction),
+                "created_at": now,
+                "expires_at": now + self.ttl_seconds,
+                "last_used": now,
+                "hits": 0
+            }
+            self.stats["created"] += 1
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1]["name"])
+        for name in evicted:
+            self._delete(name)
+        return model
+
+    def _delete(self, name):
+        try:
+            self.backend.delete(name)
+            with self._lock:
+                self.stats["deleted"] += 1
+        except Exception as e:
+            print(f"⚠️ Failed to delete cached context {name}: {e}")
+
+    def metrics(self):
+        now = time.time()
+        with self._lock:
+            return dict(self.stats, backend=type(self.backend).__name__, contexts=[{
+                "model": model_name,
+                "prompt_hash": prompt_hash[:12],
+                "chars": entry["chars"],
+                "hits": entry["hits"],
+                "ttl_remaining_seconds": max(0, round(entry["expires_at"] - now))
+            } for (model_name, prompt_hash), entry in self._entries.items()])
+
+
+context_cache = ContextCache(
+    LocalContextBackend() if CONTEXT_CACHE_BACKEND == 'local' else GeminiContextBackend(),
+    ttl_seconds=CONTEXT_CACHE_TTL,
+    max_entries=CONTEXT_CACHE_MAX_ENTRIES
+)
+metrics_sources["context_cache"] = context_cache.metrics
+
+
+# GenerativeModel objects are stateless between calls, so build each one once per worker
+model_cache = OrderedDict()  # (model_name, system instruction hash) -> GenerativeModel
+model_cache_lock = threading.Lock()
+
+
+def get_model(model_name=MODEL_NAME, system_instruction=None):
+    """Return a cached GenerativeModel for the model name and system instruction"""
+    if system_instruction and CONTEXT_CACHE_BACKEND != 'off' and len(system_instruction) >= CONTEXT_CACHE_MIN_CHARS:
+        model = context_cache.model_for(model_name, system_instruction)
+        if model is not None:
+            return model
+    
+    key = (model_name, hashlib.sha256(system_instruction.encode('utf-8')).hexdigest() if system_instruction else None)
+    with model_cache_lock:
+        model = model_cache.get(key)
+        if model is not None:
+            model_cache.move_to_end(key)
+            return model
+    
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        system_instruction=system_instruction or None
+    )
+    with model_cache_lock:
+        model_cache[key] = model
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+    return model
+
+
+# ============= AUTHENTICATION ENDPOINTS =============
+
+@app.route('/auth/register', methods=['POST'])
+def register():
+    """Register a new user"""
+    try:
+        data = request.get_json()
+        
+        # Validate required fields
+        required_fields = ['username', 'email', 'password']
+        for field in required_fields:
+            if field not in data or not data[field]:
+                return jsonify({"error": f"{field} is required"}), 400
+        
+        username = data['username'].strip()
+        email = data['email'].lower().strip()  # Normalize email
+        password = data['password']
+        full_name = data.get('full_name', '').strip()
+        
+        # Validate email format
+        if '@' not in email:
+            return jsonify({"error": "Invalid email format"}), 400
+        
+        # Validate password strength
+        if len(password) < 6:
+            return jsonify({"error": "Password must be at least 6 characters"}), 400
+        
+        # Hash password
+        with span('auth.password_hash'):
+            password_hash = generate_password_hash(password)
+        
+        print(f"🔐 Registering user: {username}, email: {email}")
+        print(f"🔑 Password length: {len(password)}")
+        print(f"🔑 Hash method: pbkdf2:sha256")
+        
+        # Insert user into database
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        try:
+            # The only write on the critical path: RETURNING confirms the row, no read-back needed
+            with span('db.user_insert'):
+                cur.execute(
+                    """INSERT INTO users (username, email, password_hash, full_name) 
+                       VALUES (%s, %s, %s, %s) RETURNING id, username, email, full_name, created_at""",
+                    (username, email, password_hash, full_name)
+                )
+                user = cur.fetchone()
+                conn.commit()
+            note_user_write(user['id'])
+            
+            cur.close()
+            conn.close()
+            
+            print(f"✅ User registered successfully with ID: {user['id']}")
+            
+            # Generate JWT token (session row is written behind)
+            token, jti, expires_at = issue_token(user)
+            auth_writer.record_session(user['id'], jti, expires_at)
+            
+            return jsonify({
+                "message": "User registered successfully",
+                "user": {
+                    "id": user['id'],
+                    "username": user['username'],
+                    "email": user['email'],
+                    "full_name": user['full_name'],
+                    "created_at": user['created_at'].isoformat() if user['created_at'] else None
+                },
+                "token": token
+            }), 201
+            
+        except psycopg2.IntegrityError as e:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            if 'username' in str(e):
+                return jsonify({"error": "Username already exists"}), 409
+            elif 'email' in str(e):
+                return jsonify({"error": "Email already exists"}), 409
+            else:
+                return jsonify({"error": "User already exists"}), 409
+                
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/auth/login', methods=['POST'])
+def login():
+    """Login user"""
+    try:
+        data = request.get_json()
+        
+        # Validate required fields
+        if not data or 'email' not in data or 'password' not in data:
+            return jsonify({"error": "Email and password are required"}), 400
+        
+        email = data['email'].lower().strip()  # Normalize email
+        password = data['password']
+        
+        print(f"🔍 Login attempt for email: {email}")
+        print(f"🔑 Password provided length: {len(password)}")
+        
+        # Get user from database
+        with span('db.user_lookup'):
+            conn = get_db_connection()
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM users WHERE LOWER(email) = %s AND is_active = TRUE", (email,))
+            user = cur.fetchone()
+            cur.close()
+            conn.close()
+        
+        if not user:
+            print(f"❌ Login failed: User not found with email {email}")
+            return jsonify({"error": "Invalid email or password"}), 401
+        
+        print(f"✅ User found: ID={user['id']}, username={user['username']}")
+        print(f"🔑 Stored hash starts with: {user['password_hash'][:30]}...")
+        
+        # Verify password
+        with span('auth.password_check'):
+            password_match = check_password_hash(user['password_hash'], password)
+        print(f"🔐 Password verification result: {password_match}")
+        
+        if not password_match:
+            print(f"❌ Login failed: Invalid password for user {email}")
+            return jsonify({"error": "Invalid email or password"}), 401
+        
+        # Generate JWT token; last_login and the session row are written behind
+        token, jti, expires_at = issue_token(user)
+        auth_writer.record_login(user['id'])
+        auth_writer.record_session(user['id'], jti, expires_at)
+        
+        return jsonify({
+            "message": "Login successful",
+            "user": {
+                "id": user['id'],
+                "username": user['username'],
+                "email": user['email'],
+                "full_name": user['full_name'],
+                "last_login": user['last_login'].isoformat() if user['last_login'] else None
+            },
+            "token": token
+        })
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 
 @app.route('/auth/google', methods=['POST'])
@@ -432,883 +2999,3340 @@ def google_login():
     try:
         data = request.get_json()
         
-        if not data or 'credential' not in data:
-            return jsonify({"error": "Google credential is required"}), 400
+        if not data or 'credential' not in data:
+            return jsonify({"error": "Google credential is required"}), 400
+        
+        credential = data['credential']
+        
+        print(f"🔍 Google OAuth login attempt")
+        
+        # Get user info from Google using the access token
+        try:
+            google_user_info_url = "https://www.googleapis.com/oauth2/v3/userinfo"
+            headers = {'Authorization': f'Bearer {credential}'}
+            response = outbound_http.get(google_user_info_url, headers=headers)
+            
+            if response.status_code != 200:
+                return jsonify({"error": "Invalid Google token"}), 401
+            
+            user_info = response.json()
+            email = user_info.get('email', '').lower().strip()
+            full_name = user_info.get('name', '')
+            
+            if not email:
+                return jsonify({"error": "Email not provided by Google"}), 400
+            
+            print(f"✅ Google user info retrieved: {email}")
+            
+        except Exception as e:
+            print(f"❌ Error verifying Google token: {e}")
+            return jsonify({"error": "Failed to verify Google token"}), 401
+        
+        # Check if user exists
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE LOWER(email) = %s", (email,))
+        user = cur.fetchone()
+        
+        if not user:
+            # Create new user with Google info
+            # Generate username from email
+            username = email.split('@')[0]
+            # Ensure unique username
+            base_username = username
+            counter = 1
+            while True:
+                cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+                if not cur.fetchone():
+                    break
+                username = f"{base_username}{counter}"
+                counter += 1
+            
+            # Create random password (user won't need it for Google login)
+            random_password = str(uuid.uuid4())
+            password_hash = generate_password_hash(random_password)
+            
+            print(f"🆕 Creating new user from Google: {username}, {email}")
+            
+            cur.execute(
+                """INSERT INTO users (username, email, password_hash, full_name) 
+                   VALUES (%s, %s, %s, %s) RETURNING id, username, email, full_name, created_at""",
+                (username, email, password_hash, full_name)
+            )
+            user = cur.fetchone()
+            conn.commit()
+            note_user_write(user['id'])
+            
+            print(f"✅ New user created with ID: {user['id']}")
+        else:
+            print(f"✅ Existing user found: ID={user['id']}, username={user['username']}")
+            
+            # Update last login (written behind)
+            auth_writer.record_login(user['id'])
+        
+        cur.close()
+        conn.close()
+        
+        # Generate JWT token (session row is written behind)
+        token, jti, expires_at = issue_token(user)
+        auth_writer.record_session(user['id'], jti, expires_at)
+        
+        return jsonify({
+            "message": "Login successful",
+            "user": {
+                "id": user['id'],
+                "username": user['username'],
+                "email": user['email'],
+                "full_name": user['full_name']
+            },
+            "token": token
+        })
+        
+    except Exception as e:
+        print(f"❌ Google login error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/auth/forgot-password', methods=['POST'])
+def forgot_password():
+    """Send password reset email"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'email' not in data:
+            return jsonify({"error": "Email is required"}), 400
         
-        credential = data['credential']
+        email = data['email'].lower().strip()
         
-        print(f"🔍 Google OAuth login attempt")
+        # Check if user exists
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT id, username, email, full_name FROM users WHERE LOWER(email) = %s AND is_active = TRUE", (email,))
+        user = cur.fetchone()
+        
+        # Always return success to prevent email enumeration
+        if not user:
+            cur.close()
+            conn.close()
+            return jsonify({"message": "If an account exists with that email, you will receive password reset instructions."}), 200
+        
+        # Generate reset token
+        reset_token = jwt.encode({
+            'user_id': user['id'],
+            'purpose': 'password_reset',
+            'exp': datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
+        }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+        
+        # Store a hash of the reset token in the database; the token itself only goes out by email
+        cur.execute(
+            "UPDATE users SET reset_token = %s, reset_token_expires = %s WHERE id = %s",
+            (hashlib.sha256(reset_token.encode()).hexdigest(), datetime.utcnow() + timedelta(hours=1), user['id'])
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+        
+        # Send email via SendGrid
+        reset_link = f"{FRONTEND_URL}/reset-password?token={reset_token}"
+        
+        print(f"📧 Preparing to send email to: {email}")
+        print(f"📧 From email: {SENDGRID_FROM_EMAIL}")
+        print(f"📧 Reset link: {reset_link}")
+        
+        message = Mail(
+            from_email=SENDGRID_FROM_EMAIL,
+            to_emails=email,
+            subject='Reset Your Cortex AI Password',
+            html_content=f'''
+            <html>
+              <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+                  <h2 style="color: #2563eb;">Password Reset Request</h2>
+                  <p>Hello {user['full_name'] or user['username']},</p>
+                  <p>We received a request to reset your password for your Cortex AI account.</p>
+                  <p>Click the button below to reset your password:</p>
+                  <div style="text-align: center; margin: 30px 0;">
+                    <a href="{reset_link}" 
+                       style="background-color: #2563eb; color: white; padding: 12px 30px; 
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                      Reset Password
+                    </a>
+                  </div>
+                  <p>Or copy and paste this link into your browser:</p>
+                  <p style="background-color: #f3f4f6; padding: 10px; border-radius: 5px; word-break: break-all;">
+                    {reset_link}
+                  </p>
+                  <p style="color: #ef4444; font-weight: bold;">This link will expire in 1 hour.</p>
+                  <p>If you didn't request a password reset, you can safely ignore this email.</p>
+                  <hr style="border: none; border-top: 1px solid #e5e7eb; margin: 30px 0;">
+                  <p style="color: #6b7280; font-size: 12px;">
+                    This is an automated email from Cortex AI. Please do not reply to this email.
+                  </p>
+                </div>
+              </body>
+            </html>
+            '''
+        )
         
-        # Get user info from Google using the access token
         try:
-            google_user_info_url = "https://www.googleapis.com/oauth2/v3/userinfo"
-            headers = {'Authorization': f'Bearer {credential}'}
-            response = requests.get(google_user_info_url, headers=headers)
-            
-            if response.status_code != 200:
-                return jsonify({"error": "Invalid Google token"}), 401
-            
-            user_info = response.json()
-            email = user_info.get('email', '').lower().strip()
-            full_name = user_info.get('name', '')
+            response = send_email(message)
+            print(f"✅ Password reset email sent to {email}, status code: {response.status_code}")
+            print(f"📧 SendGrid Response Body: {response.text}")
+            print(f"📧 SendGrid Response Headers: {response.headers}")
+        except Exception as email_error:
+            print(f"❌ Failed to send email: {str(email_error)}")
+            print(f"❌ Error type: {type(email_error).__name__}")
+            import traceback
+            print(f"❌ Full traceback: {traceback.format_exc()}")
+            return jsonify({"error": f"Failed to send reset email: {str(email_error)}"}), 500
+        
+        return jsonify({"message": "If an account exists with that email, you will receive password reset instructions."}), 200
+        
+    except Exception as e:
+        print(f"❌ Forgot password error: {str(e)}")
+        return jsonify({"error": "An error occurred. Please try again later."}), 500
+
+
+@app.route('/auth/reset-password', methods=['POST'])
+def reset_password():
+    """Reset user password with token"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'token' not in data or 'new_password' not in data:
+            return jsonify({"error": "Token and new password are required"}), 400
+        
+        token = data['token']
+        new_password = data['new_password']
+        
+        if len(new_password) < 8:
+            return jsonify({"error": "Password must be at least 8 characters long"}), 400
+        
+        try:
+            payload = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
             
-            if not email:
-                return jsonify({"error": "Email not provided by Google"}), 400
+            if payload.get('purpose') != 'password_reset':
+                return jsonify({"error": "Invalid token"}), 400
             
-            print(f"✅ Google user info retrieved: {email}")
+            user_id = payload.get('user_id')
             
-        except Exception as e:
-            print(f"❌ Error verifying Google token: {e}")
-            return jsonify({"error": "Failed to verify Google token"}), 401
+        except jwt.ExpiredSignatureError:
+            return jsonify({"error": "Reset token has expired. Please request a new one."}), 400
+        except jwt.InvalidTokenError:
+            return jsonify({"error": "Invalid reset token"}), 400
+        
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT reset_token, reset_token_expires FROM users WHERE id = %s AND is_active = TRUE",
+            (user_id,)
+        )
+        user_data = cur.fetchone()
+        
+        if not user_data:
+            cur.close()
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        
+        if not user_data['reset_token'] or not hmac.compare_digest(
+                user_data['reset_token'], hashlib.sha256(token.encode()).hexdigest()):
+            cur.close()
+            conn.close()
+            return jsonify({"error": "Invalid or already used reset token"}), 400
+        
+        if user_data['reset_token_expires'] < datetime.utcnow():
+            cur.close()
+            conn.close()
+            return jsonify({"error": "Reset token has expired"}), 400
+        
+        hashed_password = generate_password_hash(new_password)
+        
+        # Write buffered sessions first so the revocation below covers them
+        auth_writer.flush()
+        
+        cur.execute(
+            """UPDATE users SET password_hash = %s, reset_token = NULL, reset_token_expires = NULL,
+                   updated_at = CURRENT_TIMESTAMP, password_changed_at = (NOW() AT TIME ZONE 'UTC') WHERE id = %s""",
+            (hashed_password, user_id)
+        )
+        
+        # Sign out every existing session, as change_password does (commits together with the reset)
+        revoke_sessions(conn, "user_id = %s", (user_id,))
+        note_user_write(user_id)
+        
+        cur.close()
+        conn.close()
+        
+        print(f"✅ Password reset successful for user ID: {user_id}")
+        
+        return jsonify({"message": "Password has been reset successfully"}), 200
+        
+    except Exception as e:
+        print(f"❌ Reset password error: {str(e)}")
+        return jsonify({"error": "An error occurred. Please try again later."}), 500
+
+
+@app.route('/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user):
+    """Logout user and invalidate token"""
+    try:
+        # Get token from header
+        token = request.headers['Authorization'].split(" ")[1]
+        
+        # Invalidate session in database and this worker's revocation list
+        conn = get_db_connection()
+        revoke_token(conn, current_user['id'], token)
+        note_user_write(current_user['id'])
+        conn.close()
+        
+        return jsonify({"message": "Logout successful"})
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/auth/me', methods=['GET'])
+@token_required
+def get_current_user(current_user):
+    """Get current user information"""
+    try:
+        return jsonify({
+            "user": {
+                "id": current_user['id'],
+                "username": current_user['username'],
+                "email": current_user['email'],
+                "full_name": current_user['full_name'],
+                "created_at": current_user['created_at'].isoformat() if current_user['created_at'] else None,
+                "last_login": current_user['last_login'].isoformat() if current_user['last_login'] else None
+            }
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/auth/change-password', methods=['POST'])
+@token_required
+def change_password(current_user):
+    """Change user password"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'old_password' not in data or 'new_password' not in data:
+            return jsonify({"error": "Old password and new password are required"}), 400
+        
+        old_password = data['old_password']
+        new_password = data['new_password']
         
-        # Check if user exists
+        # Verify old password
+        with span('auth.password_check'):
+            old_password_valid = check_password_hash(current_user['password_hash'], old_password)
+        if not old_password_valid:
+            return jsonify({"error": "Invalid old password"}), 401
+        
+        # Validate new password strength
+        if len(new_password) < 6:
+            return jsonify({"error": "New password must be at least 6 characters"}), 400
+        
+        # Hash new password
+        with span('auth.password_hash'):
+            new_password_hash = generate_password_hash(new_password)
+        
+        # Write buffered sessions first so the revocation below covers them
+        auth_writer.flush()
+        
+        # Update password in database
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE LOWER(email) = %s", (email,))
-        user = cur.fetchone()
+        cur.execute(
+            """UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP,
+                   password_changed_at = (NOW() AT TIME ZONE 'UTC') WHERE id = %s""",
+            (new_password_hash, current_user['id'])
+        )
         
-        if not user:
-            # Create new user with Google info
-            # Generate username from email
-            username = email.split('@')[0]
-            # Ensure unique username
-            base_username = username
-            counter = 1
-            while True:
-                cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-                if not cur.fetchone():
-                    break
-                username = f"{base_username}{counter}"
-                counter += 1
-            
-            # Create random password (user won't need it for Google login)
-            random_password = str(uuid.uuid4())
-            password_hash = generate_password_hash(random_password)
+        # Invalidate all existing sessions (commits together with the password change)
+        revoke_sessions(conn, "user_id = %s", (current_user['id'],))
+        note_user_write(current_user['id'])
+        
+        cur.close()
+        conn.close()
+        
+        return jsonify({"message": "Password changed successfully. Please login again."})
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ============= CHAT ENDPOINTS =============
+
+@app.route('/')
+def home():
+    """Home endpoint"""
+    return jsonify({
+        "message": "Welcome to CortexAI API",
+        "version": "2.0.0",
+        "model": MODEL_NAME,
+        "endpoints": {
+            "/auth/register": "POST - Register new user",
+            "/auth/login": "POST - Login user",
+            "/auth/google": "POST - Login/Register with Google OAuth",
+            "/auth/logout": "POST - Logout user (Protected)",
+            "/auth/me": "GET - Get current user (Protected)",
+            "/auth/change-password": "POST - Change password (Protected)",
+            "/chat": "POST - Send a chat message (Protected)",
+            "/chat/stream": "POST - Stream chat responses (Protected)",
+            "/chat/batch": "POST - Run a batch of prompts, NDJSON results (Protected)",
+            "/chat/stream/<stream_id>": "GET - Resume a stream after Last-Event-ID (Protected)",
+            "/chat/stream/<stream_id>/cancel": "POST - Cancel a running stream (Protected)",
+            "/chat/ws": "WebSocket - Multiplexed chat streams with in-band cancel (Protected)",
+            "/conversations": "GET - List all conversations (Protected)",
+            "/conversations/search": "GET - Search messages with ?q= (Protected)",
+            "/conversations/export": "GET - Stream conversations as NDJSON (Protected)",
+            "/conversations/import": "POST - Import conversations from NDJSON (Protected)",
+            "/conversations/<id>": "GET - Get specific conversation (Protected)",
+            "/conversations/<id>": "DELETE - Delete a conversation (Protected)",
+            "/conversations/new": "POST - Start new conversation (Protected)",
+            "/conversations/<id>/clear": "POST - Clear conversation history (Protected)",
+            "/models": "GET - List available models",
+            "/ready": "GET - Readiness probe with dependency checks",
+            "/usage": "GET - Today's usage and remaining quota",
+            "/tts": "POST - Read text or an assistant message aloud (WAV) (Protected)",
+            "/tts/<key>": "GET - Cached speech audio with Range support",
+            "/admin/profiles": "GET - Recent request profiles (admin)",
+            "/metrics": "GET - Per-worker runtime metrics (admin)"
+        }
+
+    })
+
+
+# ============= USAGE ACCOUNTING =============
+
+USAGE_FIELDS = ('requests', 'prompt_tokens', 'response_tokens', 'images', 'errors', 'latency_ms')
+
+
+class QuotaExceeded(Exception):
+    """A user has used up a daily quota; retry_after is the seconds until it resets (UTC midnight)"""
+
+    def __init__(self, quota, limit):
+        super().__init__(f"Daily {quota} quota of {limit} reached")
+        now = datetime.utcnow()
+        self.retry_after = max(1, int((datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()))
+
+
+class UsageTracker:
+    """Per-user daily usage counters, aggregated in memory and written behind in batched upserts.
+
+    Each worker keeps a view of today's totals per user: the database row loaded on first touch,
+    plus everything recorded since. Recorded deltas are upserted every USAGE_FLUSH_INTERVAL seconds,
+    and the totals the upsert returns (which include other workers' flushed usage) refresh the view.
+    Quotas are checked against this view, so no query sits on the request path after first touch.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._totals = {}  # (user_id, day) -> Counter of USAGE_FIELDS
+        self._pending = {}  # (user_id, day) -> Counter not yet written
+        self._thread = None
+        self.rows_written = 0
+        self.batches = 0
+        self.load_errors = 0
+
+    def _load(self, key):
+        """Today's persisted totals for a user (zeros if the database is unreachable)"""
+        totals = Counter()
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            cur.execute(f"SELECT {', '.join(USAGE_FIELDS)} FROM usage_daily WHERE user_id = %s AND day = %s", key)
+            row = cur.fetchone()
+            cur.close()
+            conn.close()
+            if row:
+                totals.update({field: row[field] for field in USAGE_FIELDS})
+        except Exception as e:
+            self.load_errors += 1
+            print(f"⚠️ Failed to load usage for user {key[0]}: {e}")
+        return totals
+
+    def totals(self, user_id):
+        """Today's usage for a user as this worker sees it"""
+        key = (user_id, datetime.utcnow().date())
+        with self._lock:
+            totals = self._totals.get(key)
+        if totals is None:
+            loaded = self._load(key)
+            with self._lock:
+                totals = self._totals.setdefault(key, loaded)
+        with self._lock:
+            return {field: totals[field] for field in USAGE_FIELDS}
+
+    def check_quota(self, user_id):
+        """Raise QuotaExceeded if the user has no requests or tokens left today"""
+        if not USAGE_DAILY_REQUEST_LIMIT and not USAGE_DAILY_TOKEN_LIMIT:
+            return
+        totals = self.totals(user_id)
+        if USAGE_DAILY_REQUEST_LIMIT and totals['requests'] >= USAGE_DAILY_REQUEST_LIMIT:
+            raise QuotaExceeded('request', USAGE_DAILY_REQUEST_LIMIT)
+        if USAGE_DAILY_TOKEN_LIMIT and totals['prompt_tokens'] + totals['response_tokens'] >= USAGE_DAILY_TOKEN_LIMIT:
+            raise QuotaExceeded('token', USAGE_DAILY_TOKEN_LIMIT)
+
+    def record(self, user_id, prompt_tokens=0, response_tokens=0, images=0, latency_ms=0, error=False):
+        delta = Counter(requests=1, prompt_tokens=prompt_tokens, response_tokens=response_tokens,
+                        images=images, errors=1 if error else 0, latency_ms=int(latency_ms))
+        key = (user_id, datetime.utcnow().date())
+        if key not in self._totals:
+            self.totals(user_id)
+        with self._lock:
+            self._totals.setdefault(key, Counter()).update(delta)
+            self._pending.setdefault(key, Counter()).update(delta)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                rows = execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO usage_daily (user_id, day, {', '.join(USAGE_FIELDS)}) VALUES %s
+                    ON CONFLICT (user_id, day) DO UPDATE SET
+                        {', '.join(f'{field} = usage_daily.{field} + EXCLUDED.{field}' for field in USAGE_FIELDS)},
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING user_id, day, {', '.join(USAGE_FIELDS)}
+                    """,
+                    [(user_id, day, *(counts[field] for field in USAGE_FIELDS)) for (user_id, day), counts in batch.items()],
+                    fetch=True
+                )
+                conn.commit()
+                cur.close()
+                conn.close()
+                self.rows_written += len(batch)
+                self.batches += 1
+            except Exception as e:
+                print(f"⚠️ Failed to write usage for {len(batch)} user(s): {e}")
+                with self._lock:
+                    for key, counts in batch.items():
+                        self._pending.setdefault(key, Counter()).update(counts)
+                return
             
-            print(f"🆕 Creating new user from Google: {username}, {email}")
+            today = datetime.utcnow().date()
+            with self._lock:
+                # Persisted totals (all workers) plus whatever was recorded here during the flush
+                for row in rows:
+                    key = (row['user_id'], row['day'])
+                    refreshed = Counter({field: row[field] for field in USAGE_FIELDS})
+                    refreshed.update(self._pending.get(key, Counter()))
+                    self._totals[key] = refreshed
+                for key in [key for key in self._totals if key[1] < today and key not in self._pending]:
+                    del self._totals[key]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "tracked_users": len(self._totals),
+                "pending_users": len(self._pending),
+                "rows_written": self.rows_written,
+                "batches": self.batches,
+                "load_errors": self.load_errors
+            }
+
+
+def usage_counts(response):
+    """Prompt and response token counts from a Gemini response's usage metadata (zeros if absent)"""
+    metadata = getattr(response, 'usage_metadata', None)
+    if not metadata:
+        return 0, 0
+    return getattr(metadata, 'prompt_token_count', 0) or 0, getattr(metadata, 'candidates_token_count', 0) or 0
+
+
+def quota_response(error):
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+
+usage_tracker = UsageTracker(USAGE_FLUSH_INTERVAL)
+metrics_sources["usage"] = usage_tracker.metrics
+atexit.register(usage_tracker.flush)
+
+
+# ============= ADMISSION CONTROL =============
+
+class Overloaded(Exception):
+    """A model call was refused admission; retry_after is the suggested wait in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """One admitted (or waiting) model call"""
+
+    __slots__ = ('user_id', 'start_tag', 'finish_tag', 'enqueued_at', 'granted_at', 'event', 'cancelled')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.start_tag = 0.0
+        self.finish_tag = 0.0
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.event = threading.Event()
+        self.cancelled = False
+
+
+class AdmissionController:
+    """Per-worker admission control in front of model calls.
+
+    At most `limit` calls run at once. Further callers wait in a bounded queue ordered by
+    start-time fair queuing: each call gets a virtual finish tag of max(virtual time, the user's
+    previous finish tag) + 1/weight, so a user with many calls in flight queues behind users with
+    few, in proportion to their weights. Callers are refused straight away (Overloaded) when the
+    queue is full or the expected wait, estimated from recent call durations, exceeds their deadline.
+    A full queue pushes out its last-in-line caller when a newcomer would be served before it, so a
+    single user's backlog can't lock everyone else out.
+    """
+
+    def __init__(self, limit, max_queue, max_wait):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queue = []  # heap of (finish tag, sequence, ticket)
+        self._queued = 0
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self._user_finish = {}  # user_id -> finish tag of their latest call
+        self._service_seconds = ADMISSION_INITIAL_SERVICE_SECONDS  # moving average of call duration
+        self._waits = deque(maxlen=1024)
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def _expected_wait(self, position):
+        return position * self._service_seconds / max(self.limit, 1)
+
+    def _reject(self, reason, expected_wait):
+        self.rejected[reason] += 1
+        raise Overloaded(reason, max(1, math.ceil(expected_wait)))
+
+    def _grant(self, ticket):
+        self._active += 1
+        ticket.granted_at = time.monotonic()
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        self._waits.append(ticket.granted_at - ticket.enqueued_at)
+        self.admitted += 1
+        ticket.event.set()
+
+    def acquire(self, user_id, weight=None, max_wait=None):
+        """Admit a call for user_id, waiting up to max_wait seconds; raises Overloaded if refused"""
+        weight = weight or ADMISSION_USER_WEIGHTS.get(user_id, 1.0)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        ticket = AdmissionTicket(user_id)
+        with self._lock:
+            ticket.start_tag = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+            ticket.finish_tag = ticket.start_tag + 1.0 / weight
+            if self._active < self.limit and not self._queued:
+                self._user_finish[user_id] = ticket.finish_tag
+                self._grant(ticket)
+                return ticket
             
-            cur.execute(
-                """INSERT INTO users (username, email, password_hash, full_name) 
-                   VALUES (%s, %s, %s, %s) RETURNING id, username, email, full_name, created_at""",
-                (username, email, password_hash, full_name)
-            )
-            user = cur.fetchone()
-            conn.commit()
+            last = None
+            if self._queued >= self.max_queue:
+                last = max((entry for entry in self._queue if not entry[2].cancelled), default=None)
+                if last is None or last[0] <= ticket.finish_tag:
+                    self._reject('queue_full', self._expected_wait(self._queued + 1))
+            # Callers behind the newcomer (including the one it would push out) don't count towards its wait
+            ahead = sum(1 for finish_tag, _, queued in self._queue if not queued.cancelled and finish_tag <= ticket.finish_tag)
+            expected_wait = self._expected_wait(ahead + 1)
+            if expected_wait > max_wait:
+                self._reject('deadline', expected_wait)
+            if last is not None:
+                # Only now that the newcomer is certain to queue: push out the caller furthest back in line
+                last[2].cancelled = True
+                last[2].event.set()
+                self._queued -= 1
             
-            print(f"✅ New user created with ID: {user['id']}")
+            self._user_finish[user_id] = ticket.finish_tag
+            if len(self._user_finish) > 10000:
+                self._user_finish = {uid: tag for uid, tag in self._user_finish.items() if tag > self._virtual_time}
+            self._sequence += 1
+            heapq.heappush(self._queue, (ticket.finish_tag, self._sequence, ticket))
+            self._queued += 1
+        
+        ticket.event.wait(max_wait)
+        with self._lock:
+            if ticket.granted_at is None:
+                if ticket.cancelled:
+                    self._reject('displaced', self._expected_wait(self._queued + 1))
+                ticket.cancelled = True
+                self._queued -= 1
+                self._reject('timeout', self._expected_wait(self._queued + 1))
+        return ticket
+
+    def release(self, ticket):
+        """Finish an admitted call and hand its slot to the next queued one"""
+        with self._lock:
+            self._active -= 1
+            held = time.monotonic() - ticket.granted_at
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * held
+            while self._queue:
+                _, _, waiting = heapq.heappop(self._queue)
+                if waiting.cancelled:
+                    continue
+                self._queued -= 1
+                self._grant(waiting)
+                break
+
+    @contextmanager
+    def slot(self, user_id, weight=None, max_wait=None):
+        ticket = self.acquire(user_id, weight, max_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def metrics(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "limit": self.limit,
+                "active": self._active,
+                "queued": self._queued,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "avg_call_seconds": round(self._service_seconds, 2),
+                "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None
+            }
+
+
+def parse_user_weights(value):
+    """Parse ADMISSION_USER_WEIGHTS ("user_id:weight,...") into a dict"""
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        user_id, _, weight = item.partition(':')
+        weights[int(user_id)] = float(weight)
+    return weights
+
+
+def overloaded_response(error):
+    response = jsonify({"error": "Server is busy, please retry shortly", "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+ADMISSION_USER_WEIGHTS = parse_user_weights(os.getenv('ADMISSION_USER_WEIGHTS', ''))
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
+metrics_sources["admission"] = admission.metrics
+
+
+# ============= MODEL ROUTING =============
+
+# A request to generate an image, not just to talk about one
+IMAGE_REQUEST_PATTERN = re.compile(
+    r"\b(draw|paint|sketch|illustrate)\b|"
+    r"\b(generate|create|make|render|design)\b.{0,60}?\b(image|picture|photo|drawing|illustration|logo|painting|icon|wallpaper)s?\b",
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def wants_image_generation(message):
+    return bool(IMAGE_REQUEST_PATTERN.search(message))
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)"""
+    return len(text) // 4
+
+
+class ModelStats:
+    """Rolling latency and error rate per model over its last calls in this worker.
+
+    Latency is the time until the model's first response: the first chunk for
+    streams, the whole answer otherwise.
+    """
+
+    def __init__(self, window, window_seconds):
+        self.window = window
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._calls = defaultdict(lambda: deque(maxlen=self.window))  # model -> (monotonic, latency_ms, error)
+
+    def record(self, model_name, latency_ms, error=False):
+        with self._lock:
+            self._calls[model_name].append((time.monotonic(), latency_ms, error))
+
+    def health(self, model_name):
+        """{'samples', 'p95_ms', 'error_rate'} over the calls still inside the time window"""
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            calls = [call for call in self._calls.get(model_name, ()) if call[0] >= cutoff]
+        latencies = sorted(latency for _, latency, error in calls if not error)
+        return {
+            "samples": len(calls),
+            "p95_ms": round(latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.95) - 1)], 1) if latencies else None,
+            "error_rate": round(sum(1 for call in calls if call[2]) / len(calls), 3) if calls else None
+        }
+
+    def metrics(self):
+        with self._lock:
+            models = list(self._calls)
+        return {model_name: self.health(model_name) for model_name in models}
+
+
+class ModelRoute:
+    __slots__ = ('model', 'reason')
+
+    def __init__(self, model, reason):
+        self.model = model
+        self.reason = reason
+
+
+class ModelRouter:
+    """Picks the model for a chat turn.
+
+    A model named by the client is used as is. Otherwise the first rule whose
+    conditions all hold picks the model, else MODEL_NAME. Rule conditions:
+    ``min_tokens`` / ``max_tokens`` (prompt plus history), ``has_image`` and
+    ``image_generation``. A picked model that is unhealthy (rolling p95 or
+    error rate over the configured limits) is swapped for the first healthy
+    model of the rule's ``fallbacks`` or MODEL_ROUTING_FALLBACKS.
+    """
+
+    def __init__(self, rules, default_model, fallbacks, stats):
+        self.rules = rules
+        self.default_model = default_model
+        self.fallbacks = fallbacks
+        self.stats = stats
+        self._lock = threading.Lock()
+        self.decisions = Counter()
+
+    @staticmethod
+    def matches(rule, tokens, has_image, image_generation):
+        if 'min_tokens' in rule and tokens < rule['min_tokens']:
+            return False
+        if 'max_tokens' in rule and tokens > rule['max_tokens']:
+            return False
+        if 'has_image' in rule and has_image != rule['has_image']:
+            return False
+        if 'image_generation' in rule and image_generation != rule['image_generation']:
+            return False
+        return True
+
+    def unhealthy(self, model_name):
+        """Why the model should be avoided right now, or None"""
+        health = self.stats.health(model_name)
+        if health["samples"] < MODEL_ROUTING_MIN_SAMPLES:
+            return None
+        if MODEL_ROUTING_MAX_ERROR_RATE and health["error_rate"] > MODEL_ROUTING_MAX_ERROR_RATE:
+            return f"error rate {health['error_rate']:.0%}"
+        if MODEL_ROUTING_MAX_P95_MS and health["p95_ms"] is not None and health["p95_ms"] > MODEL_ROUTING_MAX_P95_MS:
+            return f"p95 {health['p95_ms']:.0f} ms"
+        return None
+
+    def route(self, requested_model, tokens, has_image=False, image_generation=False):
+        if requested_model:
+            route = ModelRoute(requested_model, "client")
         else:
-            print(f"✅ Existing user found: ID={user['id']}, username={user['username']}")
-            
-            # Update last login
-            cur.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s", (user['id'],))
-            conn.commit()
+            rule = next((rule for rule in self.rules if self.matches(rule, tokens, has_image, image_generation)), None)
+            model_name = rule['model'] if rule else self.default_model
+            reason = f"rule:{rule.get('name', rule['model'])}" if rule else "default"
+            route = ModelRoute(model_name, reason)
+            problem = self.unhealthy(model_name)
+            if problem:
+                fallbacks = rule.get('fallbacks', self.fallbacks) if rule else self.fallbacks
+                fallback = next((name for name in fallbacks if name != model_name and not self.unhealthy(name)), None)
+                if fallback:
+                    route = ModelRoute(fallback, f"{reason}; {model_name} {problem}, fell back")
+        with self._lock:
+            self.decisions[route.reason.split(';')[0] + ('/fallback' if ';' in route.reason else '')] += 1
+        return route
+
+    def metrics(self):
+        with self._lock:
+            decisions = dict(self.decisions)
+        return {"rules": len(self.rules), "decisions": decisions, "models": self.stats.metrics()}
+
+
+def parse_routing_rules(value):
+    """Parse MODEL_ROUTING_RULES: a JSON list of {"model": ..., <conditions>} objects"""
+    if not value:
+        return []
+    try:
+        rules = json.loads(value)
+        if not isinstance(rules, list) or not all(isinstance(rule, dict) and rule.get('model') for rule in rules):
+            raise ValueError("expected a list of objects with a model")
+        return rules
+    except ValueError as e:
+        print(f"⚠️ Ignoring MODEL_ROUTING_RULES: {e}")
+        return []
+
+
+model_stats = ModelStats(MODEL_ROUTING_WINDOW, MODEL_ROUTING_WINDOW_SECONDS)
+model_router = ModelRouter(parse_routing_rules(os.getenv('MODEL_ROUTING_RULES', '')), MODEL_NAME,
+                           MODEL_ROUTING_FALLBACKS, model_stats)
+metrics_sources["model_routing"] = model_router.metrics
+
+
+# ============= CHAT ATTACHMENTS =============
+
+class UploadError(ValueError):
+    """A rejected chat attachment, carrying the HTTP status to answer with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FileTooLarge(RequestEntityTooLarge):
+    """One uploaded file went over UPLOAD_MAX_FILE_BYTES"""
+
+
+class SpooledUpload(tempfile.SpooledTemporaryFile):
+    """Upload buffer kept in memory up to UPLOAD_SPOOL_BYTES, then on disk, refusing files over the per-file limit"""
+
+    def __init__(self):
+        super().__init__(max_size=UPLOAD_SPOOL_BYTES)
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            raise FileTooLarge(f"Each file must be at most {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} MB")
+        return super().write(data)
+
+
+class UploadRequest(Request):
+    """Request that spools multipart file parts and caps multipart bodies at UPLOAD_MAX_TOTAL_BYTES"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledUpload()
+
+    @property
+    def max_content_length(self):
+        if self.mimetype == 'multipart/form-data':
+            return UPLOAD_MAX_TOTAL_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+        return super().max_content_length
+
+
+app.request_class = UploadRequest
+
+
+def read_chat_request():
+    """Chat fields plus attachments from either a JSON body or a multipart/form-data upload.
+
+    Attachments come back as Gemini blob parts ({"mime_type", "data"}) holding the raw file bytes,
+    so nothing is base64-encoded on the way to the model. JSON bodies have no attachments (their
+    optional base64 `image` field is handled by the caller as before).
+    """
+    if request.mimetype != 'multipart/form-data':
+        return request.get_json(), []
+    
+    try:
+        data = request.form.to_dict()
+        uploads = [upload for _, upload in request.files.items(multi=True) if upload.filename]
+    except FileTooLarge as e:
+        raise UploadError(e.description, 413)
+    except RequestEntityTooLarge:
+        raise UploadError(f"Attachments must total at most {UPLOAD_MAX_TOTAL_BYTES // (1024 * 1024)} MB", 413)
+    
+    if len(uploads) > UPLOAD_MAX_FILES:
+        raise UploadError(f"At most {UPLOAD_MAX_FILES} files can be attached to a message")
+    
+    attachments = []
+    for upload in uploads:
+        mime_type = upload.mimetype or mimetypes.guess_type(upload.filename)[0]
+        if upload.mimetype == 'application/octet-stream':
+            mime_type = mimetypes.guess_type(upload.filename)[0] or mime_type
+        if not mime_type or not mime_type.startswith(UPLOAD_ALLOWED_TYPES):
+            raise UploadError(f"Unsupported attachment type for {upload.filename}: {mime_type or 'unknown'}", 415)
+        attachments.append({"mime_type": mime_type, "data": upload.read()})
+        print(f"📎 Attachment received: {upload.filename} ({mime_type}, {len(attachments[-1]['data'])} bytes)")
+    return data, attachments
+
+
+def run_chat_turn(user_id, conversation_id, user_message, system_prompt='', model_name=MODEL_NAME, attachments=None):
+    """Send one non-streaming turn to the model and store both messages"""
+    with conversation_cache.pinned((user_id, conversation_id)), conversation_lock(user_id, conversation_id):
+        # Get or create conversation history
+        conversation = ensure_conversation(user_id, conversation_id, user_message[:50] + "..." if len(user_message) > 50 else user_message)
         
-        # Generate JWT token
-        token = jwt.encode({
-            'user_id': user['id'],
-            'username': user['username'],
-            'exp': datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-        }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+        # Prepare conversation history for Gemini
+        with span('chat.history', messages=len(conversation.messages)):
+            chat_history = retrieve_history(user_id, conversation, user_message)
         
-        # Store session in database
-        expires_at = datetime.utcnow() + timedelta(hours=app.config['JWT_EXPIRATION_HOURS'])
-        cur.execute(
-            "INSERT INTO user_sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-            (user['id'], token, expires_at)
-        )
-        conn.commit()
+        # Start chat session (system prompt goes in as the model's system instruction)
+        with span('chat.model_init', model=model_name):
+            chat_session = get_model(model_name, system_prompt or None).start_chat(history=chat_history)
         
-        cur.close()
-        conn.close()
+        # Send message and get response
+        started = time.perf_counter()
+        try:
+            with span('gemini.generate', model=model_name):
+                response = chat_session.send_message([user_message, *attachments] if attachments else user_message)
+                assistant_message = response.text
+        except Exception:
+            latency_ms = (time.perf_counter() - started) * 1000
+            usage_tracker.record(user_id, latency_ms=latency_ms, error=True)
+            model_stats.record(model_name, latency_ms, error=True)
+            raise
+        latency_ms = (time.perf_counter() - started) * 1000
+        usage_tracker.record(user_id, *usage_counts(response), latency_ms=latency_ms)
+        model_stats.record(model_name, latency_ms)
+        
+        # Store messages in conversation history
+        append_message(user_id, conversation_id, Message("user", user_message))
+        append_message(user_id, conversation_id, Message("model", assistant_message))
+    
+    return assistant_message
+
+
+@app.route('/chat', methods=['POST'])
+@token_required
+def chat(current_user):
+    """Handle chat requests without streaming (JSON, or multipart/form-data with attachments)"""
+    try:
+        try:
+            data, attachments = read_chat_request()
+        except UploadError as e:
+            return jsonify({"error": str(e)}), e.status_code
+        
+        if not data or 'message' not in data:
+            return jsonify({"error": "Message is required"}), 400
+        
+        user_message = data['message']
+        conversation_id = data.get('conversation_id', str(uuid.uuid4()))
+        system_prompt = data.get('system_prompt', '')
+        
+        try:
+            usage_tracker.check_quota(current_user['id'])
+            with admission.slot(current_user['id']):
+                assistant_message = run_chat_turn(current_user['id'], conversation_id, user_message, system_prompt, attachments=attachments)
+        except QuotaExceeded as e:
+            return quota_response(e)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except ConversationConflict as e:
+            return jsonify({"error": str(e)}), 409
         
         return jsonify({
-            "message": "Login successful",
-            "user": {
-                "id": user['id'],
-                "username": user['username'],
-                "email": user['email'],
-                "full_name": user['full_name']
-            },
-            "token": token
+            "conversation_id": conversation_id,
+            "message": assistant_message,
+            "timestamp": datetime.now().isoformat(),
+            "model": MODEL_NAME
         })
-        
+    
     except Exception as e:
-        print(f"❌ Google login error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/auth/forgot-password', methods=['POST'])
-def forgot_password():
-    """Send password reset email"""
+# ============= BATCH CHAT =============
+
+# Shared by all batches in this worker; each batch keeps at most its own concurrency in flight
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_POOL_SIZE, thread_name_prefix='chat-batch')
+
+
+class RateLimiter:
+    """Token bucket limiting how fast a batch starts model calls"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def run_batch_item(user_id, index, item):
+    """Run one batch prompt and describe the outcome as a result event"""
+    started = time.perf_counter()
+    result = {
+        "type": "result",
+        "index": index,
+        "id": item.get('id'),
+        "conversation_id": item['conversation_id'],
+        "model": item['model']
+    }
+    try:
+        usage_tracker.check_quota(user_id)
+        weight = ADMISSION_USER_WEIGHTS.get(user_id, 1.0) * ADMISSION_BATCH_WEIGHT
+        with admission.slot(user_id, weight, ADMISSION_BATCH_MAX_WAIT):
+            result["message"] = run_chat_turn(user_id, item['conversation_id'], item['message'], item['system_prompt'], item['model'])
+    except QuotaExceeded as e:
+        result["error"] = str(e)
+        result["retry_after"] = e.retry_after
+    except Overloaded as e:
+        print(f"⏳ Batch item {index} refused: {str(e)}")
+        result["error"] = "Server is busy, please retry shortly"
+        result["retry_after"] = e.retry_after
+    except Exception as e:
+        print(f"❌ Batch item {index} failed: {str(e)}")
+        result["error"] = str(e)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def run_batch(user_id, items, concurrency, rate_limit):
+    """Fan a batch out over the shared pool and yield NDJSON results in completion order"""
+    limiter = RateLimiter(rate_limit, burst=concurrency)
+    started = time.perf_counter()
+    pending = set()
+    next_index = 0
+    failed = 0
+    try:
+        while next_index < len(items) or pending:
+            while next_index < len(items) and len(pending) < concurrency:
+                limiter.acquire()
+                pending.add(batch_executor.submit(run_batch_item, user_id, next_index, items[next_index]))
+                next_index += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                failed += 1 if 'error' in result else 0
+                yield json.dumps(result) + "\n"
+        yield json.dumps({
+            "type": "end",
+            "total": len(items),
+            "failed": failed,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+        }) + "\n"
+    finally:
+        # Client went away: drop work that has not started yet
+        for future in pending:
+            future.cancel()
+
+
+@app.route('/chat/batch', methods=['POST'])
+@token_required
+def chat_batch(current_user):
+    """Run many independent prompts with bounded parallelism, streaming NDJSON results"""
     try:
         data = request.get_json()
         
-        if not data or 'email' not in data:
-            return jsonify({"error": "Email is required"}), 400
+        if not data or not isinstance(data.get('prompts'), list) or not data['prompts']:
+            return jsonify({"error": "prompts must be a non-empty list"}), 400
         
-        email = data['email'].lower().strip()
+        if len(data['prompts']) > BATCH_MAX_PROMPTS:
+            return jsonify({"error": f"A batch can contain at most {BATCH_MAX_PROMPTS} prompts"}), 400
         
-        # Check if user exists
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, username, email, full_name FROM users WHERE LOWER(email) = %s AND is_active = TRUE", (email,))
-        user = cur.fetchone()
+        items = []
+        for index, prompt in enumerate(data['prompts']):
+            if not isinstance(prompt, dict) or not isinstance(prompt.get('message'), str) or not prompt['message']:
+                return jsonify({"error": f"prompts[{index}].message is required"}), 400
+            items.append({
+                "id": prompt.get('id'),
+                "message": prompt['message'],
+                "system_prompt": prompt.get('system_prompt', ''),
+                "model": prompt.get('model') or MODEL_NAME,
+                "conversation_id": prompt.get('conversation_id') or str(uuid.uuid4())
+            })
         
-        # Always return success to prevent email enumeration
-        if not user:
-            cur.close()
-            conn.close()
-            return jsonify({"message": "If an account exists with that email, you will receive password reset instructions."}), 200
+        try:
+            concurrency = min(max(int(data.get('concurrency', 4)), 1), BATCH_MAX_CONCURRENCY)
+            rate_limit = float(data.get('rate_limit', BATCH_RATE_LIMIT))
+        except (TypeError, ValueError):
+            return jsonify({"error": "concurrency and rate_limit must be numbers"}), 400
+        if BATCH_RATE_LIMIT:
+            rate_limit = min(rate_limit, BATCH_RATE_LIMIT) if rate_limit > 0 else BATCH_RATE_LIMIT
         
-        # Generate reset token
-        reset_token = jwt.encode({
-            'user_id': user['id'],
-            'purpose': 'password_reset',
-            'exp': datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
-        }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+        print(f"📦 Batch of {len(items)} prompts from {current_user['username']} (concurrency={concurrency}, rate_limit={rate_limit or 'none'})")
         
-        # Store reset token in database (you may want to create a password_resets table)
-        cur.execute(
-            "UPDATE users SET reset_token = %s, reset_token_expires = %s WHERE id = %s",
-            (reset_token, datetime.utcnow() + timedelta(hours=1), user['id'])
+        return Response(
+            run_batch(current_user['id'], items, concurrency, rate_limit),
+            mimetype='application/x-ndjson',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
         )
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        # Send email via SendGrid
-        reset_link = f"{FRONTEND_URL}/reset-password?token={reset_token}"
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ============= STREAM CHECKPOINTS =============
+
+class CheckpointWriter:
+    """Coalesces in-progress message checkpoints into batched UPDATEs.
+
+    Streams submit the latest content of their message row; a background
+    thread writes whatever is pending every CHECKPOINT_FLUSH_INTERVAL
+    seconds, so several checkpoints of one answer become a single UPDATE
+    and no database round trip sits on the per-chunk path.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # message row id -> (content, status)
+        self._thread = None
+        self.writes = 0
+        self.batches = 0
+
+    def submit(self, row_id, content, status):
+        with self._lock:
+            self._pending[row_id] = (content, status)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        # The flush lock orders writes, so a final flush always lands after older checkpoints
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                execute_values(
+                    cur,
+                    """UPDATE messages AS m
+                       SET content = v.content, content_codec = v.codec, content_blob = v.blob,
+                           content_tsv = to_tsvector('english', v.search_text), status = v.status
+                       FROM (VALUES %s) AS v(id, content, codec, blob, search_text, status) WHERE m.id = v.id""",
+                    [(row_id, *stored_content(content), status) for row_id, (content, status) in batch.items()],
+                    template="(%s::integer, %s::text, %s::varchar, %s::bytea, %s::text, %s::varchar)"
+                )
+                conn.commit()
+                cur.close()
+                conn.close()
+                self.writes += len(batch)
+                self.batches += 1
+            except Exception as e:
+                print(f"⚠️ Failed to write {len(batch)} stream checkpoint(s): {e}")
+                with self._lock:
+                    for row_id, value in batch.items():
+                        self._pending.setdefault(row_id, value)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {"pending": len(self._pending), "rows_written": self.writes, "batches": self.batches}
+
+
+checkpoint_writer = CheckpointWriter(CHECKPOINT_FLUSH_INTERVAL)
+metrics_sources["stream_checkpoints"] = checkpoint_writer.metrics
+
+
+class StreamCheckpoint:
+    """Keeps a streaming answer visible as an in-progress message.
+
+    The content is saved every STREAM_CHECKPOINT_CHUNKS chunks or
+    STREAM_CHECKPOINT_MS milliseconds, whichever comes first, and finalised
+    with the full answer (and its status) when the stream ends.
+    """
+
+    def __init__(self, user_id, conversation_id, message, row_id):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.message = message
+        self.row_id = row_id
+        self.size = estimate_message_bytes(message)
+        self.chunks_since_save = 0
+        self.last_save = time.monotonic()
+
+    def update(self, content):
+        self.chunks_since_save += 1
+        if (self.chunks_since_save < STREAM_CHECKPOINT_CHUNKS and
+                (time.monotonic() - self.last_save) * 1000 < STREAM_CHECKPOINT_MS):
+            return
+        self._save(content, 'streaming')
+
+    def finish(self, content, images=None, status=None):
+        self._save(content, status, images)
+        conversation = user_conversations.get(self.user_id, {}).get(self.conversation_id)
+        if conversation is not None:
+            try:
+                position = conversation.messages.index(self.message)
+            except ValueError:
+                position = None  # Conversation was cleared mid-stream
+            if position is not None:
+                index_message(self.user_id, self.conversation_id, position, self.message, content)
+        if self.row_id is not None:
+            checkpoint_writer.flush()
+
+    def _save(self, content, status, images=None):
+        self.message.update(content, images, status)
+        size = estimate_message_bytes(self.message)
+        conversation_cache.touch((self.user_id, self.conversation_id), size - self.size)
+        self.size = size
+        self.chunks_since_save = 0
+        self.last_save = time.monotonic()
+        if self.row_id is not None:
+            checkpoint_writer.submit(self.row_id, content, status)
+
+
+# ============= RESUMABLE STREAMS =============
+
+class StreamState:
+    """Replay buffer for one /chat/stream generation.
+
+    The generation runs in a producer thread and publishes numbered SSE
+    events here; HTTP responses are subscribers that replay everything after
+    their Last-Event-ID and then follow the live generation, so a client
+    that reconnects picks up where it left off instead of starting over.
+    """
+
+    def __init__(self, stream_id, user_id, conversation_id):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.events = []  # SSE "data: ..." chunks; event id n is events[n - 1]
+        self.done = False
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.subscribers = 0
+        self.cancel_reason = None
+        self.upstream = None
+        self._condition = threading.Condition()
+
+    @property
+    def cancelled(self):
+        return self.cancel_reason is not None
+
+    def attach_upstream(self, response):
+        """Remember the upstream response so a cancel can close it; False if already cancelled"""
+        with self._condition:
+            self.upstream = response
+            cancelled = self.cancelled
+        if cancelled:
+            close_upstream(response)
+        return not cancelled
+
+    def cancel(self, reason):
+        """Stop the upstream generation; the producer stores the partial answer as truncated"""
+        with self._condition:
+            if self.done or self.cancelled:
+                return False
+            self.cancel_reason = reason
+            upstream = self.upstream
+        record_stream_cancel(self, reason)
+        print(f"🛑 Cancelling stream {self.stream_id} ({reason})")
+        if upstream is not None:
+            close_upstream(upstream)
+        return True
+
+    def _cancel_if_abandoned(self):
+        with self._condition:
+            abandoned = self.subscribers == 0 and not self.done
+        if abandoned:
+            self.cancel('disconnect')
+
+    def publish(self, event):
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    def attach(self):
+        with self._condition:
+            self.subscribers += 1
+
+    def detach(self):
+        """Drop a subscriber; the last one leaving a running stream cancels it after the resume grace period"""
+        with self._condition:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+        if abandoned:
+            if STREAM_RESUME_GRACE_SECONDS > 0:
+                timer = threading.Timer(STREAM_RESUME_GRACE_SECONDS, self._cancel_if_abandoned)
+                timer.daemon = True
+                timer.start()
+            else:
+                self._cancel_if_abandoned()
+
+    def wait_events(self, position, timeout):
+        """Events after position (waiting up to timeout for one) and whether the stream has ended"""
+        with self._condition:
+            if position >= len(self.events) and not self.done:
+                self._condition.wait(timeout=timeout)
+            return self.events[position:], self.done
+
+    def subscribe(self, last_event_id=0):
+        """Yield SSE events after last_event_id, following the stream until it ends"""
+        position = max(0, min(last_event_id, len(self.events)))
+        self.attach()
+        try:
+            while True:
+                pending, finished = self.wait_events(position, STREAM_HEARTBEAT_SECONDS)
+                if pending:
+                    for offset, event in enumerate(pending, start=position + 1):
+                        yield f"id: {offset}\n{event}"
+                    position += len(pending)
+                elif finished:
+                    return
+                else:
+                    yield ": keep-alive\n\n"
+        finally:
+            # Runs when the client disconnects (failed write closes the generator) or the stream ends
+            self.detach()
+
+
+# Format: {stream_id: StreamState}
+active_streams = {}
+active_streams_lock = threading.Lock()
+stream_stats = {"started": 0, "resumed": 0, "replayed_events": 0, "cancelled": {"disconnect": 0, "client": 0}, "generation_seconds_saved": 0.0}
+# Durations of recently completed generations, used to estimate the time a cancel saves
+completed_stream_durations = deque(maxlen=200)
+
+
+def close_upstream(response):
+    """Best-effort cancel of a streaming Gemini response (gRPC call or HTTP body)"""
+    for target in (getattr(response, '_iterator', None), response):
+        for method in ('cancel', 'close'):
+            handler = getattr(target, method, None)
+            if callable(handler):
+                try:
+                    handler()
+                    return
+                except Exception as e:
+                    print(f"⚠️ Failed to close upstream stream: {e}")
+
+
+def record_stream_cancel(state, reason):
+    """Count a cancelled stream and the generation time it is expected to save"""
+    elapsed = time.monotonic() - state.started_at
+    with active_streams_lock:
+        typical = sum(completed_stream_durations) / len(completed_stream_durations) if completed_stream_durations else elapsed
+        stream_stats["cancelled"][reason] = stream_stats["cancelled"].get(reason, 0) + 1
+        stream_stats["generation_seconds_saved"] += max(0.0, typical - elapsed)
+
+
+def register_stream(user_id, conversation_id):
+    """Create a replay buffer for a new stream and drop expired finished ones"""
+    state = StreamState(uuid.uuid4().hex, user_id, conversation_id)
+    now = time.monotonic()
+    with active_streams_lock:
+        expired = [stream_id for stream_id, stream in active_streams.items()
+                   if stream.done and now - stream.finished_at > STREAM_REPLAY_TTL]
+        for stream_id in expired:
+            del active_streams[stream_id]
+        active_streams[state.stream_id] = state
+        stream_stats["started"] += 1
+    return state
+
+
+def run_stream_producer(state, events, profile=None, trace=None):
+    """Drain a generation into its replay buffer (runs in a background thread)"""
+    if profile is not None:
+        profile.track_thread()
+    trace_context.trace = trace
+    try:
+        for event in events:
+            state.publish(event)
+    finally:
+        state.finish()
+        if not state.cancelled:
+            with active_streams_lock:
+                completed_stream_durations.append(state.finished_at - state.started_at)
+        if profile is not None:
+            profile.release()
+        trace_context.trace = None
+        if trace is not None:
+            trace.release()
+
+
+def stream_response(state, last_event_id=0):
+    """SSE response attached to a stream's replay buffer"""
+    if last_event_id:
+        with active_streams_lock:
+            stream_stats["resumed"] += 1
+            stream_stats["replayed_events"] += max(0, len(state.events) - last_event_id)
+        print(f"🔁 Resuming stream {state.stream_id} after event {last_event_id}")
+    events = state.subscribe(last_event_id)
+    trace = current_trace()
+    if trace is not None:
+        events = timed_writes(events, trace)
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'X-Stream-Id': state.stream_id
+        }
+    )
+
+
+def parse_last_event_id():
+    """Last-Event-ID from the header (EventSource) or the last_event_id query parameter"""
+    value = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def stream_metrics():
+    with active_streams_lock:
+        live = sum(1 for stream in active_streams.values() if not stream.done)
+        return dict(
+            stream_stats,
+            cancelled=dict(stream_stats["cancelled"]),
+            generation_seconds_saved=round(stream_stats["generation_seconds_saved"], 2),
+            buffered=len(active_streams),
+            live=live
+        )
+
+
+metrics_sources["streams"] = stream_metrics
+
+
+@app.route('/chat/stream/<stream_id>', methods=['GET'])
+@token_required
+def resume_chat_stream(current_user, stream_id):
+    """Replay missed events of a stream and attach to it if still running"""
+    try:
+        with active_streams_lock:
+            state = active_streams.get(stream_id)
         
-        print(f"📧 Preparing to send email to: {email}")
-        print(f"📧 From email: {SENDGRID_FROM_EMAIL}")
-        print(f"📧 Reset link: {reset_link}")
+        if state is None or state.user_id != current_user['id']:
+            return jsonify({"error": "Stream not found or expired"}), 404
         
-        message = Mail(
-            from_email=SENDGRID_FROM_EMAIL,
-            to_emails=email,
-            subject='Reset Your Cortex AI Password',
-            html_content=f'''
-            <html>
-              <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                  <h2 style="color: #2563eb;">Password Reset Request</h2>
-                  <p>Hello {user['full_name'] or user['username']},</p>
-                  <p>We received a request to reset your password for your Cortex AI account.</p>
-                  <p>Click the button below to reset your password:</p>
-                  <div style="text-align: center; margin: 30px 0;">
-                    <a href="{reset_link}" 
-                       style="background-color: #2563eb; color: white; padding: 12px 30px; 
-                              text-decoration: none; border-radius: 5px; display: inline-block;">
-                      Reset Password
-                    </a>
-                  </div>
-                  <p>Or copy and paste this link into your browser:</p>
-                  <p style="background-color: #f3f4f6; padding: 10px; border-radius: 5px; word-break: break-all;">
-                    {reset_link}
-                  </p>
-                  <p style="color: #ef4444; font-weight: bold;">This link will expire in 1 hour.</p>
-                  <p>If you didn't request a password reset, you can safely ignore this email.</p>
-                  <hr style="border: none; border-top: 1px solid #e5e7eb; margin: 30px 0;">
-                  <p style="color: #6b7280; font-size: 12px;">
-                    This is an automated email from Cortex AI. Please do not reply to this email.
-                  </p>
-                </div>
-              </body>
-            </html>
-            '''
-        )
+        return stream_response(state, parse_last_event_id())
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/chat/stream/<stream_id>/cancel', methods=['POST'])
+@token_required
+def cancel_chat_stream(current_user, stream_id):
+    """Stop a running generation and keep the partial answer"""
+    try:
+        with active_streams_lock:
+            state = active_streams.get(stream_id)
         
-        try:
-            sg = SendGridAPIClient(SENDGRID_API_KEY)
-            response = sg.send(message)
-            print(f"✅ Password reset email sent to {email}, status code: {response.status_code}")
-            print(f"📧 SendGrid Response Body: {response.body}")
-            print(f"📧 SendGrid Response Headers: {response.headers}")
-        except Exception as email_error:
-            print(f"❌ Failed to send email: {str(email_error)}")
-            print(f"❌ Error type: {type(email_error).__name__}")
-            import traceback
-            print(f"❌ Full traceback: {traceback.format_exc()}")
-            return jsonify({"error": f"Failed to send reset email: {str(email_error)}"}), 500
+        if state is None or state.user_id != current_user['id']:
+            return jsonify({"error": "Stream not found or expired"}), 404
         
-        return jsonify({"message": "If an account exists with that email, you will receive password reset instructions."}), 200
+        if not state.cancel('client'):
+            return jsonify({"error": "Stream already finished"}), 409
         
+        return jsonify({
+            "message": "Stream cancelled",
+            "stream_id": stream_id
+        })
+    
     except Exception as e:
-        print(f"❌ Forgot password error: {str(e)}")
-        return jsonify({"error": "An error occurred. Please try again later."}), 500
+        return jsonify({"error": str(e)}), 500
+
+
+def start_chat_stream(current_user, data, attachments=(), profile=None, trace=None):
+    """Start a generation in a background producer thread and return its StreamState.
+
+    Shared by the SSE and WebSocket transports. Raises QuotaExceeded,
+    Overloaded or ConversationConflict before the stream is registered.
+    """
+    user_message = data['message']
+    conversation_id = data.get('conversation_id', str(uuid.uuid4()))
+    system_prompt = data.get('system_prompt', '')
+    requested_model = data.get('model')  # Client's choice wins over the routing rules
+    image_base64 = data.get('image')  # Get base64 image data
+    
+    user_id = current_user['id']
+    
+    print(f"💬 Message: {user_message[:50]}...")
+    print(f"🆔 Conversation ID: {conversation_id}")
+    if requested_model:
+        print(f"🤖 Requested model: {requested_model}")
+    if image_base64:
+        print(f"🖼️ Image data received: {len(image_base64)} chars")
+    
+    # Wait for a model slot (or refuse now, before any events are sent or a conversation is created)
+    usage_tracker.check_quota(user_id)
+    ticket = admission.acquire(user_id)
+    
+    # Get or create conversation history
+    conversation_title = user_message[:50] + "..." if len(user_message) > 50 else user_message
+    try:
+        ensure_conversation(user_id, conversation_id, conversation_title)
+        stream = register_stream(user_id, conversation_id)
+    except BaseException:
+        admission.release(ticket)
+        raise
+    
+    # Capture variables for closure
+    captured_image = image_base64
+    captured_attachments = attachments
+    captured_user_msg = user_message
+    captured_system_prompt = system_prompt
+    captured_conv_id = conversation_id
+    
+    def generate():
+        conversation_key = (user_id, captured_conv_id)
+        conversation_cache.pin(conversation_key)
+        checkpoint = None
+        full_response = ""
+        generation_started = None
+        model_name = None
+        try:
+            # Prepare conversation history
+            with span('chat.history'):
+                chat_history = retrieve_history(user_id, ensure_conversation(user_id, captured_conv_id, conversation_title), captured_user_msg)
+            
+            print(f"📚 Chat history length: {len(chat_history)} messages")
+            
+            # Pick the model from the prompt size, images and recent upstream health
+            prompt_tokens = estimate_tokens(captured_user_msg) + estimate_tokens(captured_system_prompt) + sum(
+                estimate_tokens(part) for turn in chat_history for part in turn['parts'])
+            has_image = bool(captured_image) or any(
+                attachment['mime_type'].startswith('image/') for attachment in captured_attachments)
+            route = model_router.route(requested_model, prompt_tokens, has_image, wants_image_generation(captured_user_msg))
+            model_name = route.model
+            print(f"🤖 Initializing Gemini model: {model_name} ({route.reason})")
+            
+            # Only the experimental image generation model can generate images
+            is_image_capable = 'image-generation' in model_name.lower()
+            print(f"🎨 Image generation capable: {is_image_capable}")
+            
+            # System instructions: image generation preamble (image models ONLY) plus the client's system prompt
+            system_parts = []
+            if is_image_capable and any(keyword in captured_user_msg.lower() for keyword in ['generate', 'create', 'make', 'draw', 'image', 'picture', 'photo']):
+                system_parts.append(IMAGE_SYSTEM_PROMPT)
+            if captured_system_prompt:
+                system_parts.append(captured_system_prompt)
+            
+            # Initialize the model and start chat session
+            with span('chat.model_init', model=model_name):
+                model = get_model(model_name, "\n\n".join(system_parts) or None)
+                chat_session = model.start_chat(history=chat_history)
+            full_message = captured_user_msg
+            
+            # Store user message
+            append_message(user_id, captured_conv_id, Message("user", captured_user_msg))
+            
+            # Placeholder answer, checkpointed while streaming and finalised at the end
+            assistant_message = Message("model", "", status='streaming')
+            row_id = append_message(user_id, captured_conv_id, assistant_message)
+            checkpoint = StreamCheckpoint(user_id, captured_conv_id, assistant_message, row_id)
+            
+            # Send metadata first
+            yield f"data: {json.dumps({'type': 'start', 'conversation_id': captured_conv_id, 'stream_id': stream.stream_id, 'model': model_name, 'route': route.reason})}\n\n"
+            
+            print(f"🚀 Starting Gemini API stream...")
+            # Stream response with image if provided
+            generated_images = []
+            trace = current_trace()
+            first_chunk_span = trace.start_span('gemini.first_chunk', model=model_name) if trace else None
+            
+            # Uploaded attachments go to the model as raw bytes alongside the text
+            message_parts = [full_message, *captured_attachments]
+            
+            if captured_image:
+                # Process image from base64
+                try:
+                    # Remove data URL prefix if present
+                    image_data_str = captured_image
+                    if ',' in image_data_str:
+                        image_data_str = image_data_str.split(',')[1]
+                    
+                    # Decode base64 image
+                    with span('image.decode'):
+                        image_bytes = base64.b64decode(image_data_str)
+                        image = PILImage.open(BytesIO(image_bytes))
+                    
+                    print(f"🖼️ Image processed: {image.format}, {image.size}")
+                    
+                    # Send message with image
+                    message_parts.insert(1, image)
+                except Exception as img_error:
+                    print(f"❌ Image processing error: {str(img_error)}")
+            
+            generation_started = time.perf_counter()
+            response = chat_session.send_message(message_parts if len(message_parts) > 1 else full_message, stream=True)
+            
+            chunk_count = 0
+            first_chunk_ms = None
+            stream.attach_upstream(response)
+            stream_span = trace.start_span('gemini.stream') if trace else None
+            try:
+                for chunk in response:
+                    if first_chunk_ms is None:
+                        first_chunk_ms = (time.perf_counter() - generation_started) * 1000
+                    if first_chunk_span is not None:
+                        trace.end_span(first_chunk_span)
+                        first_chunk_span = None
+                    if stream.cancelled:
+                        break
+                    
+                    # Debug: Log chunk structure for image gen models
+                    if is_image_capable:
+                        print(f"🔍 Chunk attributes: {dir(chunk)}")
+                        if hasattr(chunk, 'candidates'):
+                            print(f"🔍 Has candidates: {len(chunk.candidates)}")
+                
+                    # Handle text content
+                    if chunk.text:
+                        chunk_count += 1
+                        full_response += chunk.text
+                        checkpoint.update(full_response)
+                        yield f"data: {json.dumps({'type': 'content', 'content': chunk.text})}\n\n"
+                
+                    # Handle generated images (for image generation models)
+                    if hasattr(chunk, 'candidates') and chunk.candidates:
+                        for candidate in chunk.candidates:
+                            if hasattr(candidate.content, 'parts'):
+                                for part in candidate.content.parts:
+                                    # Debug log part structure
+                                    if is_image_capable:
+                                        print(f"🔍 Part attributes: {dir(part)}")
+                                        print(f"🔍 Has inline_data: {hasattr(part, 'inline_data')}")
+                                        if hasattr(part, 'inline_data') and part.inline_data:
+                                            print(f"🔍 inline_data content: {part.inline_data}")
+                                            print(f"🔍 inline_data has data: {hasattr(part.inline_data, 'data')}")
+                                            if hasattr(part.inline_data, 'data'):
+                                                print(f"🔍 inline_data.data is not None: {part.inline_data.data is not None}")
+                                                if part.inline_data.data:
+                                                    print(f"🔍 inline_data.data length: {len(part.inline_data.data)}")
+                                
+                                    # Check for inline data (images)
+                                    if (hasattr(part, 'inline_data') and 
+                                        part.inline_data and 
+                                        hasattr(part.inline_data, 'data') and 
+                                        part.inline_data.data):
+                                        try:
+                                            # Extract image data
+                                            image_data = part.inline_data.data
+                                            mime_type = part.inline_data.mime_type
+                                        
+                                            # Convert to base64 data URL
+                                            image_base64 = base64.b64encode(image_data).decode('utf-8')
+                                            image_url = f"data:{mime_type};base64,{image_base64}"
+                                            generated_images.append(image_url)
+                                        
+                                            print(f"🎨 Generated image found: {mime_type}, {len(image_data)} bytes")
+                                        
+                                            # Send image immediately
+                                            yield f"data: {json.dumps({'type': 'image', 'image': image_url})}\n\n"
+                                        except Exception as img_err:
+                                            print(f"⚠️ Error processing generated image: {str(img_err)}")
+                                            import traceback
+                                            traceback.print_exc()
+            except Exception:
+                # Closing the upstream call surfaces as an error in the iterator
+                if not stream.cancelled:
+                    raise
+            finally:
+                if stream_span is not None:
+                    stream_span.attributes['chunks'] = chunk_count
+                    trace.end_span(stream_span)
+            truncated = stream.cancelled
+            
+            print(f"{'🛑 Stream truncated' if truncated else '✅ Stream complete'}: {chunk_count} chunks, {len(full_response)} chars, {len(generated_images)} images")
+            
+            # If images were generated, add markdown references to the response (works for any model)
+            if generated_images:
+                image_markdown = "\n\n"
+                for i, img_url in enumerate(generated_images):
+                    image_markdown += f"![Generated Image {i+1}]({img_url})\n"
+                full_response += image_markdown
+                print(f"📝 Added {len(generated_images)} image(s) to response as markdown")
+            
+            # Finalise the assistant message
+            with span('chat.finalize'):
+                checkpoint.finish(full_response, generated_images, 'truncated' if truncated else None)
+            usage_tracker.record(user_id, *usage_counts(response), images=len(generated_images),
+                                 latency_ms=(time.perf_counter() - generation_started) * 1000)
+            if first_chunk_ms is not None:
+                model_stats.record(model_name, first_chunk_ms)
+            
+            # Send completion signal
+            end_event = {'type': 'end', 'full_response': full_response, 'images': generated_images}
+            if truncated:
+                end_event['truncated'] = True
+            if trace is not None:
+                end_event['timing'] = trace.durations()
+            yield f"data: {json.dumps(end_event)}\n\n"
+            
+        except Exception as e:
+            print(f"❌ Stream error: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            if checkpoint is not None and checkpoint.message.status == 'streaming':
+                checkpoint.finish(full_response, status='error')
+            if generation_started is not None:
+                latency_ms = (time.perf_counter() - generation_started) * 1000
+                usage_tracker.record(user_id, latency_ms=latency_ms, error=True)
+                model_stats.record(model_name, latency_ms, error=True)
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+        finally:
+            conversation_cache.unpin(conversation_key)
+            admission.release(ticket)
+    
+    # Generate in the background so the answer survives a dropped connection
+    if profile is not None:
+        profile.retain()
+    if trace is not None:
+        trace.retain()
+    threading.Thread(
+        target=run_stream_producer,
+        args=(stream, generate(), profile, trace),
+        name=f"stream-{stream.stream_id}",
+        daemon=True
+    ).start()
+    return stream
 
 
-@app.route('/auth/reset-password', methods=['POST'])
-def reset_password():
-    """Reset user password with token"""
+@app.route('/chat/stream', methods=['POST'])
+@token_required
+def chat_stream(current_user):
+    """Handle chat requests with streaming responses (JSON, or multipart/form-data with attachments)"""
     try:
-        data = request.get_json()
-        
-        if not data or 'token' not in data or 'new_password' not in data:
-            return jsonify({"error": "Token and new password are required"}), 400
-        
-        token = data['token']
-        new_password = data['new_password']
-        
-        if len(new_password) < 8:
-            return jsonify({"error": "Password must be at least 8 characters long"}), 400
-        
+        print(f"📨 Chat stream request from user: {current_user['username']}")
         try:
-            payload = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
-            
-            if payload.get('purpose') != 'password_reset':
-                return jsonify({"error": "Invalid token"}), 400
-            
-            user_id = payload.get('user_id')
-            
-        except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Reset token has expired. Please request a new one."}), 400
-        except jwt.InvalidTokenError:
-            return jsonify({"error": "Invalid reset token"}), 400
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT reset_token, reset_token_expires FROM users WHERE id = %s AND is_active = TRUE",
-            (user_id,)
-        )
-        user_data = cur.fetchone()
-        
-        if not user_data:
-            cur.close()
-            conn.close()
-            return jsonify({"error": "User not found"}), 404
-        
-        if user_data['reset_token'] != token:
-            cur.close()
-            conn.close()
-            return jsonify({"error": "Invalid or already used reset token"}), 400
-        
-        if user_data['reset_token_expires'] < datetime.utcnow():
-            cur.close()
-            conn.close()
-            return jsonify({"error": "Reset token has expired"}), 400
+            data, attachments = read_chat_request()
+        except UploadError as e:
+            return jsonify({"error": str(e)}), e.status_code
         
-        hashed_password = generate_password_hash(new_password)
-        cur.execute(
-            "UPDATE users SET password = %s, reset_token = NULL, reset_token_expires = NULL WHERE id = %s",
-            (hashed_password, user_id)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        # Reconnect to an existing stream instead of starting a new generation
+        if data and data.get('stream_id'):
+            with active_streams_lock:
+                state = active_streams.get(data['stream_id'])
+            if state is None or state.user_id != current_user['id']:
+                return jsonify({"error": "Stream not found or expired"}), 404
+            return stream_response(state, parse_last_event_id())
         
-        print(f"✅ Password reset successful for user ID: {user_id}")
+        if not data or 'message' not in data:
+            return jsonify({"error": "Message is required"}), 400
         
-        return jsonify({"message": "Password has been reset successfully"}), 200
+        try:
+            stream = start_chat_stream(current_user, data, attachments, g.get('profile'), current_trace())
+        except QuotaExceeded as e:
+            return quota_response(e)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except ConversationConflict as e:
+            return jsonify({"error": str(e)}), 409
         
+        return stream_response(stream)
+    
     except Exception as e:
-        print(f"❌ Reset password error: {str(e)}")
-        return jsonify({"error": "An error occurred. Please try again later."}), 500
+        print(f"❌ Chat stream error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 
-@app.route('/auth/logout', methods=['POST'])
+@app.route('/conversations', methods=['GET'])
 @token_required
-def logout(current_user):
-    """Logout user and invalidate token"""
+def get_conversations(current_user):
+    """Get all conversations for current user"""
     try:
-        # Get token from header
-        token = request.headers['Authorization'].split(" ")[1]
-        
-        # Invalidate session in database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE user_sessions SET is_active = FALSE WHERE token = %s",
-            (token,)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        user_id = current_user['id']
+        conversations_list = []
         
-        return jsonify({"message": "Logout successful"})
+        if PERSIST_CONVERSATIONS:
+            # Includes conversations evicted from (or never loaded into) this worker
+            conversations_list = list_conversations_db(user_id)
+        elif user_id in user_conversations:
+            # Sort by creation date (newest first)
+            ordered = sorted(user_conversations[user_id].values(), key=lambda c: c.created, reverse=True)
+            conversations_list = [conversation.summary() for conversation in ordered]
         
+        return jsonify({
+            "conversations": conversations_list,
+            "total": len(conversations_list)
+        })
+    
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/auth/me', methods=['GET'])
+@app.route('/conversations/search', methods=['GET'])
 @token_required
-def get_current_user(current_user):
-    """Get current user information"""
+def search_conversations(current_user):
+    """Full-text search across the current user's messages"""
     try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Query parameter q is required"}), 400
+        
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({"error": "limit and offset must be integers"}), 400
+        
+        if PERSIST_CONVERSATIONS:
+            total, results = search_messages_db(current_user['id'], query, limit, offset)
+        else:
+            total, results = search_messages_memory(current_user['id'], query, limit, offset)
+        
         return jsonify({
-            "user": {
-                "id": current_user['id'],
-                "username": current_user['username'],
-                "email": current_user['email'],
-                "full_name": current_user['full_name'],
-                "created_at": current_user['created_at'].isoformat() if current_user['created_at'] else None,
-                "last_login": current_user['last_login'].isoformat() if current_user['last_login'] else None
-            }
+            "query": query,
+            "results": results,
+            "total": total,
+            "limit": limit,
+            "offset": offset
         })
+    
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/auth/change-password', methods=['POST'])
+@app.route('/conversations/export', methods=['GET'])
 @token_required
-def change_password(current_user):
-    """Change user password"""
+def export_conversations(current_user):
+    """Stream all of the current user's conversations as NDJSON"""
     try:
-        data = request.get_json()
-        
-        if not data or 'old_password' not in data or 'new_password' not in data:
-            return jsonify({"error": "Old password and new password are required"}), 400
-        
-        old_password = data['old_password']
-        new_password = data['new_password']
+        user_id = current_user['id']
+        compress = request.args.get('gzip', 'true').lower() != 'false' and request.accept_encodings['gzip'] > 0
+        conversations = iter_conversations_db(user_id) if PERSIST_CONVERSATIONS else iter_conversations_memory(user_id)
         
-        # Verify old password
-        if not check_password_hash(current_user['password_hash'], old_password):
-            return jsonify({"error": "Invalid old password"}), 401
+        headers = {
+            'Content-Disposition': 'attachment; filename="cortex-conversations.ndjson"',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
         
-        # Validate new password strength
-        if len(new_password) < 6:
-            return jsonify({"error": "New password must be at least 6 characters"}), 400
+        return Response(
+            export_ndjson(conversations, compress=compress),
+            mimetype='application/x-ndjson',
+            headers=headers
+        )
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/conversations/import', methods=['POST'])
+@token_required
+def import_conversations(current_user):
+    """Import conversations from an NDJSON body (optionally gzip-encoded) in batches"""
+    try:
+        user_id = current_user['id']
+        stream = request.stream
+        if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
         
-        # Hash new password
-        new_password_hash = generate_password_hash(new_password)
+        started = time.perf_counter()
+        imported_conversations = 0
+        imported_messages = 0
+        errors = []
+        batch = []
+        batch_messages = 0
         
-        # Update password in database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (new_password_hash, current_user['id'])
-        )
-        conn.commit()
+        def flush(batch):
+            if PERSIST_CONVERSATIONS:
+                import_batch_db(user_id, batch)
+                note_user_write(user_id)
+            import_batch_memory(user_id, batch)
         
-        # Invalidate all existing sessions
-        cur.execute("UPDATE user_sessions SET is_active = FALSE WHERE user_id = %s", (current_user['id'],))
-        conn.commit()
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                conversation = parse_import_line(line)
+            except ValueError as e:
+                if len(errors) < 20:
+                    errors.append({"line": line_number, "error": str(e)})
+                continue
+            batch.append(conversation)
+            batch_messages += len(conversation.messages)
+            if batch_messages >= IMPORT_BATCH_SIZE:
+                flush(batch)
+                imported_conversations += len(batch)
+                imported_messages += batch_messages
+                batch, batch_messages = [], 0
         
-        cur.close()
-        conn.close()
+        if batch:
+            flush(batch)
+            imported_conversations += len(batch)
+            imported_messages += batch_messages
         
-        return jsonify({"message": "Password changed successfully. Please login again."})
+        elapsed = time.perf_counter() - started
+        print(f"📥 Imported {imported_conversations} conversations / {imported_messages} messages in {elapsed:.2f}s")
         
+        return jsonify({
+            "message": "Import complete",
+            "imported_conversations": imported_conversations,
+            "imported_messages": imported_messages,
+            "errors": errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "messages_per_second": round(imported_messages / elapsed) if elapsed else None
+        })
+    
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-# ============= CHAT ENDPOINTS =============
-
-@app.route('/')
-def home():
-    """Home endpoint"""
-    return jsonify({
-        "message": "Welcome to CortexAI API",
-        "version": "2.0.0",
-        "model": MODEL_NAME,
-        "endpoints": {
-            "/auth/register": "POST - Register new user",
-            "/auth/login": "POST - Login user",
-            "/auth/google": "POST - Login/Register with Google OAuth",
-            "/auth/logout": "POST - Logout user (Protected)",
-            "/auth/me": "GET - Get current user (Protected)",
-            "/auth/change-password": "POST - Change password (Protected)",
-            "/chat": "POST - Send a chat message (Protected)",
-            "/chat/stream": "POST - Stream chat responses (Protected)",
-            "/conversations": "GET - List all conversations (Protected)",
-            "/conversations/<id>": "GET - Get specific conversation (Protected)",
-            "/conversations/<id>": "DELETE - Delete a conversation (Protected)",
-            "/conversations/new": "POST - Start new conversation (Protected)",
-            "/conversations/<id>/clear": "POST - Clear conversation history (Protected)",
-            "/models": "GET - List available models"
-        }
-
-    })
-
-
-@app.route('/chat', methods=['POST'])
+@app.route('/conversations/<conversation_id>', methods=['GET'])
 @token_required
-def chat(current_user):
-    """Handle chat requests without streaming"""
+def get_conversation(current_user, conversation_id):
+    """Get a specific conversation for current user"""
     try:
-        data = request.get_json()
-        
-        if not data or 'message' not in data:
-            return jsonify({"error": "Message is required"}), 400
+        user_id = current_user['id']
         
-        user_message = data['message']
-        conversation_id = data.get('conversation_id', str(uuid.uuid4()))
-        system_prompt = data.get('system_prompt', '')
+        conversation = get_conversation_record(user_id, conversation_id)
+        if conversation is None:
+            return jsonify({"error": "Conversation not found"}), 404
         
+        return jsonify(conversation.to_dict())
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/conversations/<conversation_id>', methods=['DELETE'])
+@token_required
+def delete_conversation(current_user, conversation_id):
+    """Delete a conversation for current user"""
+    try:
         user_id = current_user['id']
         
-        # Initialize user's conversations if not exists
-        if user_id not in user_conversations:
-            user_conversations[user_id] = {}
+        if get_conversation_record(user_id, conversation_id) is None:
+            return jsonify({"error": "Conversation not found"}), 404
         
-        # Get or create conversation history
-        if conversation_id not in user_conversations[user_id]:
-            user_conversations[user_id][conversation_id] = {
-                "id": conversation_id,
-                "created_at": datetime.now().isoformat(),
-                "messages": [],
-                "title": user_message[:50] + "..." if len(user_message) > 50 else user_message
-            }
+        user_conversations[user_id].pop(conversation_id, None)
+        conversation_cache.forget((user_id, conversation_id))
+        with conversation_locks_guard:
+            conversation_locks.pop((user_id, conversation_id), None)
+        unindex_conversation(user_id, conversation_id)
+        if PERSIST_CONVERSATIONS:
+            delete_persisted_messages(user_id, conversation_id, delete_conversation=True)
+            note_user_write(user_id)
+        print(f"🗑️ Deleted conversation {conversation_id} for user {current_user['username']}")
         
-        # Initialize the model
-        model = genai.GenerativeModel(
-            model_name=MODEL_NAME,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
+        return jsonify({
+            "message": "Conversation deleted successfully",
+            "conversation_id": conversation_id
+        })
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/conversations/new', methods=['POST'])
+@token_required
+def new_conversation(current_user):
+    """Start a new conversation for current user"""
+    try:
+        user_id = current_user['id']
+        data = request.get_json() or {}
+        conversation_id = str(uuid.uuid4())
+        title = data.get('title', 'New Conversation')
         
-        # Prepare conversation history for Gemini
-        chat_history = []
-        for msg in user_conversations[user_id][conversation_id]['messages']:
-            chat_history.append({
-                "role": msg['role'],
-                "parts": [msg['content']]
-            })
+        conversation = ensure_conversation(user_id, conversation_id, title)
         
-        # Start chat session
-        chat_session = model.start_chat(history=chat_history)
+        return jsonify({
+            "conversation_id": conversation_id,
+            "message": "New conversation created",
+            "created_at": conversation.created_at
+        })
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/conversations/<conversation_id>/clear', methods=['POST'])
+@token_required
+def clear_conversation(current_user, conversation_id):
+    """Clear conversation history for current user"""
+    try:
+        user_id = current_user['id']
         
-        # Add system prompt if provided
-        full_message = f"{system_prompt}\n\n{user_message}" if system_prompt else user_message
+        conversation = get_conversation_record(user_id, conversation_id)
+        if conversation is None:
+            return jsonify({"error": "Conversation not found"}), 404
         
-        # Send message and get response
-        response = chat_session.send_message(full_message)
-        assistant_message = response.text
+        conversation.messages = []
+        conversation_cache.reset((user_id, conversation_id))
+        unindex_conversation(user_id, conversation_id)
+        if PERSIST_CONVERSATIONS:
+            delete_persisted_messages(user_id, conversation_id)
+            note_user_write(user_id)
         
-        # Store messages in conversation history
-        user_conversations[user_id][conversation_id]['messages'].append({
-            "role": "user",
-            "content": user_message,
-            "timestamp": datetime.now().isoformat()
+        return jsonify({
+            "message": "Conversation cleared successfully",
+            "conversation_id": conversation_id
         })
-        
-        user_conversations[user_id][conversation_id]['messages'].append({
-            "role": "model",
-            "content": assistant_message,
-            "timestamp": datetime.now().isoformat()
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/usage', methods=['GET'])
+@token_required
+def get_usage(current_user):
+    """Today's usage and remaining quota for the current user"""
+    try:
+        totals = usage_tracker.totals(current_user['id'])
+        tokens = totals['prompt_tokens'] + totals['response_tokens']
+        return jsonify({
+            "day": datetime.utcnow().date().isoformat(),
+            "usage": dict(totals, total_tokens=tokens),
+            "average_latency_ms": round(totals['latency_ms'] / totals['requests'], 1) if totals['requests'] else None,
+            "limits": {
+                "requests": USAGE_DAILY_REQUEST_LIMIT or None,
+                "tokens": USAGE_DAILY_TOKEN_LIMIT or None
+            },
+            "remaining": {
+                "requests": max(0, USAGE_DAILY_REQUEST_LIMIT - totals['requests']) if USAGE_DAILY_REQUEST_LIMIT else None,
+                "tokens": max(0, USAGE_DAILY_TOKEN_LIMIT - tokens) if USAGE_DAILY_TOKEN_LIMIT else None
+            }
         })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/models', methods=['GET'])
+def get_models():
+    """Get available models"""
+    try:
+        available_models = list_available_models()
         
         return jsonify({
-            "conversation_id": conversation_id,
-            "message": assistant_message,
-            "timestamp": datetime.now().isoformat(),
-            "model": MODEL_NAME
+            "models": available_models,
+            "current_model": MODEL_NAME
         })
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/chat/stream', methods=['POST'])
-@token_required
-def chat_stream(current_user):
-    """Handle chat requests with streaming responses"""
+@app.route('/api/feedback', methods=['POST'])
+def send_feedback():
+    """Send feedback via SendGrid"""
     try:
-        print(f"📨 Chat stream request from user: {current_user['username']}")
         data = request.get_json()
         
-        if not data or 'message' not in data:
-            return jsonify({"error": "Message is required"}), 400
+        # Validate required fields
+        if not data.get('name') or not data.get('email') or not data.get('message'):
+            return jsonify({"error": "Name, email, and message are required"}), 400
         
-        user_message = data['message']
-        conversation_id = data.get('conversation_id', str(uuid.uuid4()))
-        system_prompt = data.get('system_prompt', '')
-        model_name = data.get('model', MODEL_NAME)  # Allow custom model selection
-        image_base64 = data.get('image')  # Get base64 image data
+        name = data.get('name')
+        email = data.get('email')
+        message = data.get('message')
         
-        user_id = current_user['id']
+        # Create email content
+        email_content = f"""
+        <h2>New Feedback from CortexAI</h2>
+        <p><strong>From:</strong> {name} ({email})</p>
+        <p><strong>Message:</strong></p>
+        <p>{message.replace(chr(10), '<br>')}</p>
+        <hr>
+        <p><small>This feedback was sent via CortexAI feedback form.</small></p>
+        """
         
-        print(f"💬 Message: {user_message[:50]}...")
-        print(f"🆔 Conversation ID: {conversation_id}")
-        print(f"🤖 Using model: {model_name}")
-        if image_base64:
-            print(f"🖼️ Image data received: {len(image_base64)} chars")
+        # Create SendGrid message
+        message_obj = Mail(
+            from_email=SENDGRID_FROM_EMAIL,
+            to_emails=SENDGRID_FROM_EMAIL,  # Send to yourself
+            subject=f'CortexAI Feedback from {name}',
+            html_content=email_content
+        )
         
-        # Initialize user's conversations if not exists
-        if user_id not in user_conversations:
-            user_conversations[user_id] = {}
+        # Also set reply-to as the sender's email
+        message_obj.reply_to = email
         
-        # Get or create conversation history
-        if conversation_id not in user_conversations[user_id]:
-            print(f"✨ Creating new conversation: {conversation_id}")
-            user_conversations[user_id][conversation_id] = {
-                "id": conversation_id,
-                "created_at": datetime.now().isoformat(),
-                "messages": [],
-                "title": user_message[:50] + "..." if len(user_message) > 50 else user_message
-            }
+        # Send email
+        response = send_email(message_obj)
         
-        # Capture variables for closure
-        captured_image = image_base64
-        captured_user_msg = user_message
-        captured_system_prompt = system_prompt
-        captured_model_name = model_name
-        captured_conv_id = conversation_id
+        print(f"✅ Feedback email sent successfully (status: {response.status_code})")
         
-        def generate():
-            try:
-                print(f"🤖 Initializing Gemini model: {captured_model_name}")
-                
-                # Only the experimental image generation model can generate images
-                is_image_capable = 'image-generation' in captured_model_name.lower()
-                print(f"🎨 Image generation capable: {is_image_capable}")
-                
-                # Initialize the model
-                model = genai.GenerativeModel(
-                    model_name=captured_model_name,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings
-                )
-                
-                # Prepare conversation history
-                chat_history = []
-                for msg in user_conversations[user_id][captured_conv_id]['messages']:
-                    chat_history.append({
-                        "role": msg['role'],
-                        "parts": [msg['content']]
-                    })
-                
-                print(f"📚 Chat history length: {len(chat_history)} messages")
-                
-                # Start chat session
-                chat_session = model.start_chat(history=chat_history)
-                
-                # Add system prompt for image generation models ONLY
-                if is_image_capable and any(keyword in captured_user_msg.lower() for keyword in ['generate', 'create', 'make', 'draw', 'image', 'picture', 'photo']):
-                    image_system_prompt = """You are an AI with native image generation capabilities. When the user asks you to generate, create, or make an image, you must DIRECTLY generate and output the image - do not describe it or return JSON. The image will be automatically displayed to the user."""
-                    full_message = f"{image_system_prompt}\n\n{captured_system_prompt}\n\n{captured_user_msg}" if captured_system_prompt else f"{image_system_prompt}\n\n{captured_user_msg}"
-                else:
-                    full_message = f"{captured_system_prompt}\n\n{captured_user_msg}" if captured_system_prompt else captured_user_msg
-                
-                # Store user message
-                user_conversations[user_id][captured_conv_id]['messages'].append({
-                    "role": "user",
-                    "content": captured_user_msg,
-                    "timestamp": datetime.now().isoformat()
-                })
-                
-                # Send metadata first
-                yield f"data: {json.dumps({'type': 'start', 'conversation_id': captured_conv_id})}\n\n"
-                
-                print(f"🚀 Starting Gemini API stream...")
-                # Stream response with image if provided
-                full_response = ""
-                generated_images = []
-                
-                if captured_image:
-                    # Process image from base64
-                    try:
-                        # Remove data URL prefix if present
-                        image_data_str = captured_image
-                        if ',' in image_data_str:
-                            image_data_str = image_data_str.split(',')[1]
-                        
-                        # Decode base64 image
-                        image_bytes = base64.b64decode(image_data_str)
-                        image = PILImage.open(BytesIO(image_bytes))
-                        
-                        print(f"🖼️ Image processed: {image.format}, {image.size}")
-                        
-                        # Send message with image
-                        response = chat_session.send_message([full_message, image], stream=True)
-                    except Exception as img_error:
-                        print(f"❌ Image processing error: {str(img_error)}")
-                        response = chat_session.send_message(full_message, stream=True)
-                else:
-                    response = chat_session.send_message(full_message, stream=True)
-                
-                chunk_count = 0
-                for chunk in response:
-                    # Debug: Log chunk structure for image gen models
-                    if is_image_capable:
-                        print(f"🔍 Chunk attributes: {dir(chunk)}")
-                        if hasattr(chunk, 'candidates'):
-                            print(f"🔍 Has candidates: {len(chunk.candidates)}")
-                    
-                    # Handle text content
-                    if chunk.text:
-                        chunk_count += 1
-                        full_response += chunk.text
-                        yield f"data: {json.dumps({'type': 'content', 'content': chunk.text})}\n\n"
-                    
-                    # Handle generated images (for image generation models)
-                    if hasattr(chunk, 'candidates') and chunk.candidates:
-                        for candidate in chunk.candidates:
-                            if hasattr(candidate.content, 'parts'):
-                                for part in candidate.content.parts:
-                                    # Debug log part structure
-                                    if is_image_capable:
-                                        print(f"🔍 Part attributes: {dir(part)}")
-                                        print(f"🔍 Has inline_data: {hasattr(part, 'inline_data')}")
-                                        if hasattr(part, 'inline_data') and part.inline_data:
-                                            print(f"🔍 inline_data content: {part.inline_data}")
-                                            print(f"🔍 inline_data has data: {hasattr(part.inline_data, 'data')}")
-                                            if hasattr(part.inline_data, 'data'):
-                                                print(f"🔍 inline_data.data is not None: {part.inline_data.data is not None}")
-                                                if part.inline_data.data:
-                                                    print(f"🔍 inline_data.data length: {len(part.inline_data.data)}")
-                                    
-                                    # Check for inline data (images)
-                                    if (hasattr(part, 'inline_data') and 
-                                        part.inline_data and 
-                                        hasattr(part.inline_data, 'data') and 
-                                        part.inline_data.data):
-                                        try:
-                                            # Extract image data
-                                            image_data = part.inline_data.data
-                                            mime_type = part.inline_data.mime_type
-                                            
-                                            # Convert to base64 data URL
-                                            image_base64 = base64.b64encode(image_data).decode('utf-8')
-                                            image_url = f"data:{mime_type};base64,{image_base64}"
-                                            generated_images.append(image_url)
-                                            
-                                            print(f"🎨 Generated image found: {mime_type}, {len(image_data)} bytes")
-                                            
-                                            # Send image immediately
-                                            yield f"data: {json.dumps({'type': 'image', 'image': image_url})}\n\n"
-                                        except Exception as img_err:
-                                            print(f"⚠️ Error processing generated image: {str(img_err)}")
-                                            import traceback
-                                            traceback.print_exc()
-                
-                print(f"✅ Stream complete: {chunk_count} chunks, {len(full_response)} chars, {len(generated_images)} images")
-                
-                # If images were generated, add markdown references to the response (works for any model)
-                if generated_images:
-                    image_markdown = "\n\n"
-                    for i, img_url in enumerate(generated_images):
-                        image_markdown += f"![Generated Image {i+1}]({img_url})\n"
-                    full_response += image_markdown
-                    print(f"📝 Added {len(generated_images)} image(s) to response as markdown")
-                
-                # Store assistant message
-                user_conversations[user_id][captured_conv_id]['messages'].append({
-                    "role": "model",
-                    "content": full_response,
-                    "timestamp": datetime.now().isoformat(),
-                    "images": generated_images if generated_images else None
-                })
-                
-                # Send completion signal
-                yield f"data: {json.dumps({'type': 'end', 'full_response': full_response, 'images': generated_images})}\n\n"
-                
-            except Exception as e:
-                print(f"❌ Stream error: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+        return jsonify({
+            "message": "Feedback sent successfully!",
+            "status": "success"
+        }), 200
         
-        return Response(
-            stream_with_context(generate()),
-            mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no'
-            }
-        )
-    
     except Exception as e:
-        print(f"❌ Chat stream error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        print(f"❌ Error sending feedback: {str(e)}")
+        return jsonify({"error": f"Failed to send feedback: {str(e)}"}), 500
 
 
-@app.route('/conversations', methods=['GET'])
-@token_required
-def get_conversations(current_user):
-    """Get all conversations for current user"""
+# ============= WEBSOCKET TRANSPORT =============
+
+sock = Sock(app)
+socket_stats = {"connections": 0, "open": 0, "streams": 0, "frames": 0, "merged_events": 0, "slow_disconnects": 0}
+socket_stats_lock = threading.Lock()
+
+
+def count_socket(name, amount=1):
+    with socket_stats_lock:
+        socket_stats[name] += amount
+
+
+def socket_metrics():
+    with socket_stats_lock:
+        return dict(socket_stats)
+
+
+metrics_sources["websocket"] = socket_metrics
+
+
+class SocketAuthError(Exception):
+    pass
+
+
+def authenticate_token(token):
+    """(user row, claims) for a session token, with the same checks as token_required"""
     try:
-        user_id = current_user['id']
-        conversations_list = []
-        
-        if user_id in user_conversations:
-            for conv_id, conv_data in user_conversations[user_id].items():
-                conversations_list.append({
-                    "id": conv_id,
-                    "title": conv_data.get('title', 'Untitled'),
-                    "created_at": conv_data.get('created_at'),
-                    "message_count": len(conv_data.get('messages', []))
-                })
+        claims = token_verifier.verify(token)
+    except jwt.ExpiredSignatureError:
+        raise SocketAuthError("Token has expired")
+    except jwt.InvalidTokenError:
+        raise SocketAuthError("Invalid token")
+    if revocation_list.is_revoked(token_id(token, claims)):
+        raise SocketAuthError("Token has been revoked")
+    conn = get_db_connection(readonly=True, user_id=claims['user_id'])
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users WHERE id = %s AND (is_active = TRUE OR is_active IS NULL)", (claims['user_id'],))
+    user = cur.fetchone()
+    cur.close()
+    conn.close()
+    if not user:
+        raise SocketAuthError("User not found")
+    return user, claims
+
+
+class ChatSocket:
+    """One authenticated WebSocket carrying any number of concurrent chat streams.
+
+    Client frames: ``chat`` (the /chat/stream JSON body, plus an optional
+    request_id echoed in the reply), ``cancel`` and ``resume`` (by stream_id,
+    resume with a last_event_id) and ``ping``. Server frames are the SSE event
+    objects with ``stream_id`` and ``event_id`` added, plus accepted,
+    cancelled, error, pong and heartbeat control frames.
+
+    Each stream has a forwarder thread reading its StreamState; frames go
+    through one bounded queue drained by a writer thread. A slow reader fills
+    the queue, which blocks the forwarders but not the generations (they keep
+    buffering in their StreamState); once a forwarder catches up, consecutive
+    content events are merged into one frame. A client that reads nothing for
+    WS_SEND_TIMEOUT seconds is disconnected.
+    """
+
+    def __init__(self, ws, user, claims, revocation_id):
+        self.ws = ws
+        self.user = user
+        self.claims = claims
+        self.revocation_id = revocation_id
+        self.closed = threading.Event()
+        self._queue = queue.Queue(maxsize=WS_SEND_QUEUE)
+        self._lock = threading.Lock()
+        self.streams = {}  # stream_id -> StreamState being forwarded
+        self.starting = 0  # chat frames holding a stream slot while they wait for admission
+
+    def send(self, frame):
+        """Queue a frame, waiting while the client is behind; False once the socket is closed"""
+        data = json.dumps(frame)
+        deadline = time.monotonic() + WS_SEND_TIMEOUT
+        while not self.closed.is_set():
+            try:
+                self._queue.put(data, timeout=1)
+                return True
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    print(f"🐢 Closing WebSocket of user {self.user['id']}: client stopped reading")
+                    count_socket("slow_disconnects")
+                    self.close()
+        return False
+
+    def error(self, message, request_id=None, **extra):
+        self.send({"type": "error", "error": message, "request_id": request_id, **extra})
+
+    def close(self):
+        if not self.closed.is_set():
+            self.closed.set()
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+
+    def _write(self):
+        while not self.closed.is_set():
+            try:
+                data = self._queue.get(timeout=STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                data = json.dumps({"type": "heartbeat"})
+            try:
+                self.ws.send(data)
+                count_socket("frames")
+            except Exception:
+                self.close()
+
+    def serve(self):
+        threading.Thread(target=self._write, name=f"ws-writer-{self.user['id']}", daemon=True).start()
+        try:
+            while not self.closed.is_set():
+                message = self.ws.receive(timeout=1)
+                if message is not None:
+                    self.handle(message)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.close()
+
+    def handle(self, message):
+        try:
+            frame = json.loads(message)
+            if not isinstance(frame, dict):
+                raise ValueError
+        except ValueError:
+            return self.error("Frames must be JSON objects")
+        kind = frame.get('type')
+        request_id = frame.get('request_id')
+        if kind == 'ping':
+            return self.send({"type": "pong", "request_id": request_id})
+        if kind not in ('chat', 'cancel', 'resume'):
+            return self.error(f"Unknown frame type: {kind}", request_id)
         
-        # Sort by creation date (newest first)
-        conversations_list.sort(key=lambda x: x['created_at'], reverse=True)
+        # Authenticated once per connection, but an expired or revoked token stops new work
+        if self.claims.get('exp', 0) <= time.time() or revocation_list.is_revoked(self.revocation_id):
+            self.error("Token has expired or been revoked", request_id, status=401)
+            return self.close()
         
-        return jsonify({
-            "conversations": conversations_list,
-            "total": len(conversations_list)
-        })
+        if kind == 'chat':
+            # Off the receive loop: waiting for admission must not hold up cancels of other streams
+            threading.Thread(target=self.start, args=(frame, request_id), name='ws-start', daemon=True).start()
+            return
+        with active_streams_lock:
+            state = active_streams.get(frame.get('stream_id'))
+        if state is None or state.user_id != self.user['id']:
+            return self.error("Stream not found or expired", request_id, stream_id=frame.get('stream_id'), status=404)
+        if kind == 'cancel':
+            if not state.cancel('client'):
+                return self.error("Stream already finished", request_id, stream_id=state.stream_id, status=409)
+            return self.send({"type": "cancelled", "stream_id": state.stream_id, "request_id": request_id})
+        try:
+            last_event_id = max(int(frame.get('last_event_id') or 0), 0)
+        except (TypeError, ValueError):
+            last_event_id = 0
+        self.follow(state, last_event_id)
+
+    def start(self, frame, request_id):
+        if not isinstance(frame.get('message'), str) or not frame['message']:
+            return self.error("Message is required", request_id, status=400)
+        # Reserve the slot up front: a burst of chat frames must not all pass the check before any stream is added
+        with self._lock:
+            full = len(self.streams) + self.starting >= WS_MAX_STREAMS
+            if not full:
+                self.starting += 1
+        if full:
+            return self.error(f"At most {WS_MAX_STREAMS} concurrent streams per connection", request_id, status=429)
+        try:
+            try:
+                state = start_chat_stream(self.user, frame)
+            except QuotaExceeded as e:
+                return self.error("Daily usage limit reached", request_id, status=429, retry_after=e.retry_after)
+            except Overloaded as e:
+                return self.error("Server is busy, please retry shortly", request_id, status=503, retry_after=e.retry_after)
+            except ConversationConflict as e:
+                return self.error(str(e), request_id, status=409)
+            count_socket("streams")
+            self.send({"type": "accepted", "stream_id": state.stream_id, "request_id": request_id})
+            self.follow(state, 0)
+        finally:
+            with self._lock:
+                self.starting -= 1
+
+    def follow(self, state, last_event_id):
+        with self._lock:
+            self.streams[state.stream_id] = state
+        threading.Thread(target=self._forward, args=(state, last_event_id),
+                         name=f"ws-stream-{state.stream_id}", daemon=True).start()
+
+    def _forward(self, state, position):
+        state.attach()
+        try:
+            while not self.closed.is_set():
+                pending, finished = state.wait_events(position, 1)
+                if pending:
+                    for frame in self._frames(state, pending, position):
+                        if not self.send(frame):
+                            return
+                    position += len(pending)
+                elif finished:
+                    return
+        finally:
+            with self._lock:
+                if self.streams.get(state.stream_id) is state:
+                    del self.streams[state.stream_id]
+            # A dropped socket leaves the stream resumable for the grace period, like SSE
+            state.detach()
+
+    @staticmethod
+    def _frames(state, events, position):
+        """SSE events as socket frames, merging runs of content events a lagging reader missed"""
+        frames = []
+        for event_id, event in enumerate(events, start=position + 1):
+            payload = json.loads(event[len("data: "):])
+            if payload.get('type') == 'content' and frames and frames[-1]['type'] == 'content':
+                frames[-1]['content'] += payload['content']
+                frames[-1]['event_id'] = event_id
+                count_socket("merged_events")
+                continue
+            frames.append({**payload, "stream_id": state.stream_id, "event_id": event_id})
+        return frames
+
+
+@sock.route('/chat/ws')
+def chat_socket(ws):
+    """Multiplexed chat streams over one WebSocket, authenticated once (header or first auth frame)"""
+    token = None
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        token = auth_header[len('Bearer '):]
+    else:
+        # Browsers can't set headers on a WebSocket: expect {"type": "auth", "token": ...} first
+        try:
+            frame = json.loads(ws.receive(timeout=WS_AUTH_TIMEOUT) or '{}')
+            if isinstance(frame, dict) and frame.get('type') == 'auth':
+                token = frame.get('token')
+        except (ValueError, ConnectionClosed):
+            pass
+    try:
+        if not token:
+            raise SocketAuthError("Token is missing")
+        user, claims = authenticate_token(token)
+    except SocketAuthError as e:
+        print(f"❌ WebSocket authentication failed: {e}")
+        try:
+            ws.send(json.dumps({"type": "error", "error": str(e), "status": 401}))
+            ws.close()
+        except ConnectionClosed:
+            pass
+        return
     
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    print(f"🔌 WebSocket connected for user: {user['username']}")
+    ws.send(json.dumps({"type": "ready", "max_streams": WS_MAX_STREAMS, "heartbeat_seconds": STREAM_HEARTBEAT_SECONDS}))
+    count_socket("connections")
+    count_socket("open")
+    try:
+        ChatSocket(ws, user, claims, token_id(token, claims)).serve()
+    finally:
+        count_socket("open", -1)
+        print(f"🔌 WebSocket closed for user: {user['username']}")
+
+
+# ============= TEXT TO SPEECH =============
+
+TTS_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+MARKDOWN_IMAGE_PATTERN = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_SYMBOLS_PATTERN = re.compile(r"[`*_#>|~]+")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def speech_text(content):
+    """Message content as plain text to read aloud (no images, links or markdown symbols)"""
+    content = MARKDOWN_IMAGE_PATTERN.sub(' ', content)
+    content = DATA_URL_PATTERN.sub(' ', content)
+    content = MARKDOWN_LINK_PATTERN.sub(r"\1", content)
+    content = MARKDOWN_SYMBOLS_PATTERN.sub(' ', content)
+    return re.sub(r"[ \t]+", ' ', content).strip()
+
+
+def split_sentences(text, max_chars):
+    """Group sentences into chunks of at most max_chars (longer sentences are cut at spaces)"""
+    chunks = []
+    current = ''
+    for sentence in filter(None, (part.strip() for part in SENTENCE_END_PATTERN.split(text))):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ''
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def tts_key(text, voice, rate):
+    return hashlib.sha256(f"{voice or ''}\0{rate}\0{text}".encode('utf-8')).hexdigest()
+
+
+class SpeechCache:
+    """Synthesised audio on disk, one WAV file per key, evicted least recently used first.
+
+    Hits bump the file's mtime, so the LRU order survives restarts and is
+    shared by all workers using the directory. Each worker tracks the total
+    size it has seen and rescans the directory when it goes over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def temp_path(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        os.close(fd)
+        return path
+
+    def put(self, key, temp_path):
+        """Move a finished temp file into the cache; returns its cache path"""
+        path = self.path(key)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_bytes()
+            else:
+                self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.wav'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, keep):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self.evicted += 1
+            except OSError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def metrics(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted,
+                    "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+class SpeechSynthesizer:
+    """Runs pyttsx3 in a spawned process pool and caches every chunk it synthesises"""
+
+    def __init__(self, workers, cache, max_pending):
+        self.workers = workers
+        self.cache = cache
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pool = None
+        self.pending = 0
+        self.synthesized = 0
+        self.failed = 0
+        self.failed_streams = 0
+        self.synth_seconds = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=tts_worker.init_engine
+                )
+            return self._pool
+
+    def _reset_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def reserve(self, chunks):
+        """Claim queue room for chunks or raise Overloaded"""
+        with self._lock:
+            if self.pending + chunks > self.max_pending:
+                raise Overloaded('tts_queue_full', 5)
+            self.pending += chunks
+
+    def submit(self, key, text, voice, rate):
+        """Future for the cached WAV path of one chunk (already resolved on a cache hit).
+
+        The caller must have reserved a pending slot for it. The slot is released
+        when the future resolves; if submit raises, it still belongs to the caller.
+        """
+        path = self.cache.get(key)
+        if path is not None:
+            self.release()
+            future = Future()
+            future.set_result(path)
+            return future
+        temp_path = self.cache.temp_path()
+        started = time.perf_counter()
+        pool = self._get_pool()
+        result = Future()
+
+        def done(job):
+            self.release()
+            try:
+                job.result()
+                path = self.cache.put(key, temp_path)
+                self.synth_seconds += time.perf_counter() - started
+                self.synthesized += 1
+                result.set_result(path)
+            except BaseException as e:
+                self.failed += 1
+                if isinstance(e, BrokenProcessPool):
+                    self._reset_pool(pool)
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                result.set_exception(e)
+
+        try:
+            pool.submit(tts_worker.synthesize, text, voice, rate, temp_path).add_done_callback(done)
+        except Exception as e:
+            done_future = Future()
+            done_future.set_exception(e)
+            done(done_future)
+        return result
 
+    def release(self, chunks=1):
+        """Give back pending slots"""
+        with self._lock:
+            self.pending -= chunks
 
-@app.route('/conversations/<conversation_id>', methods=['GET'])
-@token_required
-def get_conversation(current_user, conversation_id):
-    """Get a specific conversation for current user"""
+    def metrics(self):
+        with self._lock:
+            pending = self.pending
+        return {
+            "workers": self.workers,
+            "pending_chunks": pending,
+            "synthesized_chunks": self.synthesized,
+            "failed_chunks": self.failed,
+            "failed_streams": self.failed_streams,
+            "synth_ms": round(self.synth_seconds * 1000, 1),
+            "cache": self.cache.metrics()
+        }
+
+
+speech_cache = SpeechCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+speech = SpeechSynthesizer(TTS_WORKERS, speech_cache, TTS_MAX_PENDING)
+metrics_sources["tts"] = speech.metrics
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        return wav.getparams(), wav.readframes(wav.getnframes())
+
+
+def wav_stream_header(params):
+    """WAV header for a stream of unknown length (sizes set to the maximum)"""
+    block_align = params.nchannels * params.sampwidth
+    return (b"RIFF" + struct.pack('<I', 0xFFFFFFFF) + b"WAVE" +
+            b"fmt " + struct.pack('<IHHIIHH', 16, 1, params.nchannels, params.framerate,
+                                  params.framerate * block_align, block_align, params.sampwidth * 8) +
+            b"data" + struct.pack('<I', 0xFFFFFFFF))
+
+
+def stream_speech(key, futures):
+    """Yield one WAV stream from chunk futures in order, then cache the assembled file under key.
+
+    The header promises the maximum WAV length, so a chunk that fails mid-stream
+    is re-raised: the server then drops the connection without the final chunk
+    and the client sees an incomplete response rather than a short clean one.
+    """
+    temp_path = speech_cache.temp_path()
+    writer = None
     try:
-        user_id = current_user['id']
-        
-        if user_id not in user_conversations or conversation_id not in user_conversations[user_id]:
-            return jsonify({"error": "Conversation not found"}), 404
-        
-        return jsonify(user_conversations[user_id][conversation_id])
-    
+        for future in futures:
+            params, frames = read_wav(future.result(timeout=TTS_TIMEOUT))
+            if writer is None:
+                writer = wave.open(temp_path, 'wb')
+                writer.setparams(params)
+                yield wav_stream_header(params)
+            writer.writeframes(frames)
+            yield frames
+        writer.close()
+        writer = None
+        speech_cache.put(key, temp_path)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        speech.failed_streams += 1
+        print(f"❌ TTS stream failed: {str(e)}")
+        raise
+    finally:
+        # Chunks still being synthesised finish in the pool and stay cached for the next request
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
-@app.route('/conversations/<conversation_id>', methods=['DELETE'])
+def send_speech(path, key, cache_status):
+    response = send_file(path, mimetype='audio/wav', conditional=True, etag=key, max_age=86400)
+    response.headers['X-TTS-Cache'] = cache_status
+    response.headers['X-TTS-Url'] = f"/tts/{key}"
+    return response
+
+
+@app.route('/tts', methods=['POST'])
 @token_required
-def delete_conversation(current_user, conversation_id):
-    """Delete a conversation for current user"""
+def text_to_speech(current_user):
+    """Read text, or an assistant message of a conversation, aloud as WAV audio"""
     try:
-        user_id = current_user['id']
+        data = request.get_json() or {}
+        text = data.get('text')
+        if not text and data.get('conversation_id'):
+            conversation = get_conversation_record(current_user['id'], data['conversation_id'])
+            if conversation is None:
+                return jsonify({"error": "Conversation not found"}), 404
+            answers = [index for index, message in enumerate(conversation.messages) if message.role == 'model']
+            index = data.get('message_index', answers[-1] if answers else None)
+            if not isinstance(index, int) or index not in answers:
+                return jsonify({"error": "message_index must point at an assistant message"}), 400
+            text = conversation.messages[index].content
+        if not isinstance(text, str) or not text:
+            return jsonify({"error": "text or conversation_id is required"}), 400
         
-        if user_id not in user_conversations or conversation_id not in user_conversations[user_id]:
-            return jsonify({"error": "Conversation not found"}), 404
+        text = speech_text(text)
+        if not text:
+            return jsonify({"error": "Nothing to read aloud"}), 400
+        if len(text) > TTS_MAX_CHARS:
+            return jsonify({"error": f"Text is too long to read aloud (max {TTS_MAX_CHARS} characters)"}), 413
+        voice = data.get('voice') or None
+        try:
+            rate = int(data.get('rate', TTS_DEFAULT_RATE))
+        except (TypeError, ValueError):
+            return jsonify({"error": "rate must be an integer"}), 400
+        if not 50 <= rate <= 500:
+            return jsonify({"error": "rate must be between 50 and 500 words per minute"}), 400
         
-        del user_conversations[user_id][conversation_id]
-        print(f"🗑️ Deleted conversation {conversation_id} for user {current_user['username']}")
+        key = tts_key(text, voice, rate)
+        path = speech_cache.get(key)
+        if path is not None:
+            return send_speech(path, key, 'hit')
         
-        return jsonify({
-            "message": "Conversation deleted successfully",
-            "conversation_id": conversation_id
+        chunks = split_sentences(text, TTS_CHUNK_CHARS)
+        try:
+            speech.reserve(len(chunks))
+        except Overloaded as e:
+            return overloaded_response(e)
+        
+        futures = []
+        try:
+            for chunk in chunks:
+                futures.append(speech.submit(key if len(chunks) == 1 else tts_key(chunk, voice, rate), chunk, voice, rate))
+        finally:
+            # Slots of chunks that never reached the pool (submit raised part way through)
+            speech.release(len(chunks) - len(futures))
+        
+        if len(chunks) == 1:
+            path = futures[0].result(timeout=TTS_TIMEOUT)
+            return send_speech(path, key, 'miss')
+        
+        # Long answers: chunks are synthesised in parallel and streamed in order as they finish
+        print(f"🔊 Streaming speech in {len(chunks)} chunks for user {current_user['username']}")
+        return Response(stream_speech(key, futures), mimetype='audio/wav', headers={
+            'Cache-Control': 'no-cache',
+            'X-TTS-Cache': 'miss',
+            'X-TTS-Url': f"/tts/{key}",
+            'X-Accel-Buffering': 'no'
         })
     
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        print(f"❌ TTS error: {str(e)}")
+        return jsonify({"error": f"Text-to-speech failed: {str(e)}"}), 503
 
 
-@app.route('/conversations/new', methods=['POST'])
-@token_required
-def new_conversation(current_user):
-    """Start a new conversation for current user"""
-    try:
-        user_id = current_user['id']
-        data = request.get_json() or {}
-        conversation_id = str(uuid.uuid4())
-        title = data.get('title', 'New Conversation')
-        
-        if user_id not in user_conversations:
-            user_conversations[user_id] = {}
-        
-        user_conversations[user_id][conversation_id] = {
-            "id": conversation_id,
-            "created_at": datetime.now().isoformat(),
-            "messages": [],
-            "title": title
+@app.route('/tts/<key>', methods=['GET'])
+def get_speech(key):
+    """Cached speech audio by key; the key is a hash of the text, so it works as an <audio> src"""
+    if not TTS_KEY_PATTERN.match(key):
+        return jsonify({"error": "Audio not found"}), 404
+    path = speech_cache.get(key)
+    if path is None:
+        return jsonify({"error": "Audio not found"}), 404
+    return send_speech(path, key, 'hit')
+
+
+# ============= MAINTENANCE =============
+
+class SessionMaintenance:
+    """Periodic cleanup of rows nothing reads any more, run by one worker at a time.
+
+    Every MAINTENANCE_INTERVAL seconds each worker tries a session-level advisory lock; the one that
+    gets it deletes expired session rows, clears lapsed password reset tokens and marks answers left
+    'streaming' by a worker that died mid-stream as 'truncated'. Each task works in batches of
+    MAINTENANCE_BATCH_SIZE rows, committed one at a time so no sweep holds locks for long, and stops
+    after MAINTENANCE_MAX_BATCHES; whatever is left is picked up on the next run.
+
+    Revoked sessions are kept until they expire: the revocation list is loaded from them.
+    """
+
+    TASKS = {
+        "expired_sessions": """
+            DELETE FROM user_sessions WHERE id IN (
+                SELECT id FROM user_sessions WHERE expires_at < %(now)s LIMIT %(limit)s
+            )""",
+        "reset_tokens": """
+            UPDATE users SET reset_token = NULL, reset_token_expires = NULL WHERE id IN (
+                SELECT id FROM users WHERE reset_token_expires < %(now)s LIMIT %(limit)s
+            )""",
+        "stale_streams": """
+            UPDATE messages SET status = 'truncated' WHERE id IN (
+                SELECT id FROM messages WHERE status = 'streaming' AND created_at < %(stale_before)s LIMIT %(limit)s
+            )"""
+    }
+
+    def __init__(self, interval, batch_size, max_batches):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._lock = threading.Lock()
+        self._thread = None
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.reclaimed = {name: 0 for name in self.TASKS}
+        self.last_run = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        """Run every task if this worker wins the lock; returns rows reclaimed per task, or None"""
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (MAINTENANCE_LOCK_ID,))
+            locked = cur.fetchone()['locked']
+            conn.commit()
+            if not locked:
+                with self._lock:
+                    self.skipped += 1
+                return None
+            started = time.perf_counter()
+            reclaimed = {}
+            try:
+                for name, sql in self.TASKS.items():
+                    reclaimed[name] = self._sweep(conn, cur, name, sql)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MAINTENANCE_LOCK_ID,))
+                conn.commit()
+            duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            with self._lock:
+                self.runs += 1
+                for name, rows in reclaimed.items():
+                    self.reclaimed[name] += rows
+                self.last_run = {"at": datetime.now().isoformat(), "duration_ms": duration_ms, "reclaimed": reclaimed}
+            if any(reclaimed.values()):
+                summary = ', '.join(f"{name}={rows}" for name, rows in reclaimed.items())
+                print(f"🧹 Maintenance reclaimed {summary} ({duration_ms} ms)")
+            return reclaimed
+        finally:
+            cur.close()
+            conn.close()
+
+    def _sweep(self, conn, cur, name, sql):
+        params = {
+            "now": datetime.utcnow(),
+            "stale_before": datetime.utcnow() - timedelta(seconds=MAINTENANCE_STALE_STREAM_SECONDS),
+            "limit": self.batch_size
         }
-        
-        return jsonify({
-            "conversation_id": conversation_id,
-            "message": "New conversation created",
-            "created_at": user_conversations[user_id][conversation_id]['created_at']
-        })
+        total = 0
+        try:
+            for _ in range(self.max_batches):
+                cur.execute(sql, params)
+                rows = cur.rowcount
+                conn.commit()
+                total += rows
+                if rows < self.batch_size:
+                    break
+        except Exception as e:
+            conn.rollback()
+            with self._lock:
+                self.errors += 1
+            print(f"⚠️ Maintenance task {name} failed after {total} row(s): {e}")
+        return total
+
+    def _run(self):
+        # Spread workers' first attempts so they don't all race for the lock at once
+        time.sleep(self.interval * random.uniform(0.5, 1.0))
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                print(f"⚠️ Maintenance run failed: {e}")
+            time.sleep(self.interval)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "skipped_not_leader": self.skipped,
+                "errors": self.errors,
+                "reclaimed": dict(self.reclaimed),
+                "last_run": self.last_run
+            }
+
+
+session_maintenance = SessionMaintenance(MAINTENANCE_INTERVAL, MAINTENANCE_BATCH_SIZE, MAINTENANCE_MAX_BATCHES)
+metrics_sources["maintenance"] = session_maintenance.metrics
+if MAINTENANCE_INTERVAL > 0:
+    session_maintenance.start()
+
+
+# ============= PROFILING =============
+
+def admin_required(f):
+    """Decorator for operator-only routes: requires the ADMIN_API_KEY in the X-Admin-Key header"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not is_admin_request():
+            return jsonify({"error": "Admin access required"}), 403
+        return f(*args, **kwargs)
     
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return decorated
 
 
-@app.route('/conversations/<conversation_id>/clear', methods=['POST'])
-@token_required
-def clear_conversation(current_user, conversation_id):
-    """Clear conversation history for current user"""
+def is_admin_request():
+    key = request.headers.get('X-Admin-Key', '')
+    return bool(ADMIN_API_KEY) and hmac.compare_digest(key, ADMIN_API_KEY)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+def collapse_stack(frame):
+    """Root-first stack in collapsed (flamegraph.pl / speedscope) notation"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class RequestProfile:
+    """Stack samples for one request across every thread working on it (request thread and stream producer).
+
+    Each participant retain()s the profile and release()s it when done; the last release writes it out.
+    """
+
+    def __init__(self, method, path, reason):
+        self.id = uuid.uuid4().hex[:8]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started = time.time()
+        self.stacks = Counter()
+        self.samples = 0
+        self.threads = set()  # idents of threads currently sampled
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def retain(self):
+        with self._lock:
+            self._refs += 1
+
+    def track_thread(self):
+        with self._lock:
+            self.threads.add(threading.get_ident())
+        request_profiler.add(self)
+
+    def release(self):
+        with self._lock:
+            self.threads.discard(threading.get_ident())
+            self._refs -= 1
+            finished = self._refs == 0
+        if finished:
+            request_profiler.remove(self)
+            write_profile(self)
+
+
+class SamplingProfiler:
+    """Samples the threads of profiled requests every PROFILE_INTERVAL_MS.
+
+    A sampler rather than cProfile: on Python 3.12 only one cProfile can be active per process,
+    which rules out profiling concurrent requests or a request plus its stream producer thread.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile):
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self._thread.start()
+
+    def remove(self, profile):
+        with self._lock:
+            self._active.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._active)
+                if not profiles:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            for profile in profiles:
+                for ident in list(profile.threads):
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        profile.stacks[collapse_stack(frame)] += 1
+                        profile.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+
+request_profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+profile_stats = {"profiled": 0, "written": 0, "rotated": 0}
+
+PROFILE_NAME_PATTERN = re.compile(r'^(\d{8}T\d{6})-(\w+)-([\w.-]*)-(\d+)ms-([0-9a-f]{8})\.collapsed$')
+
+
+def write_profile(profile):
+    """Write collapsed stacks to PROFILE_DIR, keeping only the newest PROFILE_KEEP files"""
+    duration_ms = int((time.time() - profile.started) * 1000)
+    slug = re.sub(r'[^\w.-]+', '_', profile.path.strip('/')) or 'root'
+    name = f"{datetime.utcfromtimestamp(profile.started).strftime('%Y%m%dT%H%M%S')}-{profile.method}-{slug[:60]}-{duration_ms}ms-{profile.id}.collapsed"
     try:
-        user_id = current_user['id']
-        
-        if user_id not in user_conversations or conversation_id not in user_conversations[user_id]:
-            return jsonify({"error": "Conversation not found"}), 404
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, name)
+        with open(path + '.tmp', 'w') as f:
+            for stack, count in profile.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(path + '.tmp', path)
+        profile_stats["written"] += 1
+        print(f"🔬 Profiled {profile.method} {profile.path} ({profile.reason}): {profile.samples} samples, {duration_ms} ms -> {name}")
         
-        user_conversations[user_id][conversation_id]['messages'] = []
-        
-        return jsonify({
-            "message": "Conversation cleared successfully",
-            "conversation_id": conversation_id
-        })
-    
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        files = sorted(
+            (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.collapsed')),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for entry in files[PROFILE_KEEP:]:
+            os.remove(entry.path)
+            profile_stats["rotated"] += 1
+    except OSError as e:
+        print(f"⚠️ Failed to write profile {name}: {e}")
 
 
-@app.route('/models', methods=['GET'])
-def get_models():
-    """Get available models"""
+def profile_reason():
+    """Why this request should be profiled, or None"""
+    if request.path in ('/health', '/ready', '/metrics') or request.path.startswith('/admin/'):
+        return None
+    if request.headers.get('X-Profile') == '1' and is_admin_request():
+        return 'requested'
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+@app.before_request
+def start_request_profile():
+    reason = profile_reason()
+    if reason is None:
+        return
+    profile = RequestProfile(request.method, request.path, reason)
+    profile.retain()
+    profile.track_thread()
+    g.profile = profile
+    profile_stats["profiled"] += 1
+
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        response.headers['X-Profile-Id'] = profile.id
+        # Released when the response is closed, i.e. after a streamed body has been fully sent
+        response.call_on_close(profile.release)
+    return response
+
+
+@app.route('/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    """Recently written request profiles, newest first"""
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for entry in os.scandir(PROFILE_DIR):
+            match = PROFILE_NAME_PATTERN.match(entry.name)
+            if not match:
+                continue
+            stamp, method, slug, duration_ms, profile_id = match.groups()
+            profiles.append({
+                "name": entry.name,
+                "id": profile_id,
+                "method": method,
+                "path": slug,
+                "duration_ms": int(duration_ms),
+                "created_at": datetime.strptime(stamp, '%Y%m%dT%H%M%S').isoformat() + 'Z',
+                "size": entry.stat().st_size
+            })
+    profiles.sort(key=lambda p: p["created_at"], reverse=True)
+    return jsonify({
+        "profiles": profiles,
+        "total": len(profiles),
+        "format": "collapsed stacks (flamegraph.pl, speedscope)",
+        "stats": profile_stats
+    })
+
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+@admin_required
+def get_profile(name):
+    """Download one profile"""
+    if not PROFILE_NAME_PATTERN.match(name):
+        return jsonify({"error": "Invalid profile name"}), 400
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.isfile(path):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(os.path.abspath(path), mimetype='text/plain', as_attachment=True, download_name=name)
+
+
+# ============= READINESS =============
+
+# "disabled" (WARMUP_ON_BOOT off) counts as warmed up; "failed" steps are retried with backoff
+warmup_state = {"status": "pending" if WARMUP_ON_BOOT else "disabled", "started_at": None, "duration_ms": None, "attempts": 0, "steps": {}}
+# Listed models are cached for MODELS_CACHE_TTL seconds
+models_cache = {"models": None, "fetched_at": 0.0}
+models_cache_lock = threading.Lock()
+readiness_cache = {"result": None, "checked_at": 0.0}
+readiness_lock = threading.Lock()
+
+
+def list_available_models(refresh=False):
+    """Models supporting generateContent, cached for MODELS_CACHE_TTL seconds"""
+    with models_cache_lock:
+        if not refresh and models_cache["models"] is not None and time.monotonic() - models_cache["fetched_at"] < MODELS_CACHE_TTL:
+            return models_cache["models"]
+    available_models = []
+    for model in genai.list_models():
+        if 'generateContent' in model.supported_generation_methods:
+            available_models.append({
+                "name": model.name,
+                "display_name": model.display_name,
+                "description": model.description if hasattr(model, 'description') else "",
+            })
+    with models_cache_lock:
+        models_cache["models"] = available_models
+        models_cache["fetched_at"] = time.monotonic()
+    return available_models
+
+
+def timed_check(check):
+    """Run one readiness check, returning its status and latency"""
+    started = time.perf_counter()
     try:
-        models = genai.list_models()
-        available_models = []
-        
-        for model in models:
-            if 'generateContent' in model.supported_generation_methods:
-                available_models.append({
-                    "name": model.name,
-                    "display_name": model.display_name,
-                    "description": model.description if hasattr(model, 'description') else "",
-                })
-        
-        return jsonify({
-            "models": available_models,
-            "current_model": MODEL_NAME
-        })
-    
+        detail = check()
+        result = {"status": "ok"}
+        if detail is not None:
+            result.update(detail)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        result = {"status": "error", "error": str(e)}
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
 
 
-@app.route('/api/feedback', methods=['POST'])
-def send_feedback():
-    """Send feedback via SendGrid"""
+def ping_database():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT 1")
+    cur.fetchone()
+    cur.close()
+    conn.close()
+
+
+def ping_model_backend():
+    # A probe should fail fast, so bound the whole call instead of using the default 60s retry budget
+    genai.get_model(f"models/{MODEL_NAME}", request_options={
+        "retry": api_retry.Retry(timeout=READY_CHECK_TIMEOUT),
+        "timeout": READY_CHECK_TIMEOUT
+    })
+
+
+def queue_depth():
+    with active_streams_lock:
+        live_streams = sum(1 for stream in active_streams.values() if not stream.done)
+    return {
+        "live_streams": live_streams,
+        "batch_queue": batch_executor._work_queue.qsize(),
+        "admission_queue": admission.metrics()["queued"],
+        "pending_checkpoints": checkpoint_writer.metrics()["pending"]
+    }
+
+
+def open_database_pools():
+    primary_db.open()
+    if replica_router is not None:
+        try:
+            replica_router.replica.open()
+        except Exception as e:
+            # The router falls back to the primary, so a missing replica doesn't block warm-up
+            return {"connections": primary_db.minconn, "replica_error": str(e)}
+    return {"connections": primary_db.minconn}
+
+
+def ping_replica():
+    conn = replica_router.replica.connect()
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        if not data.get('name') or not data.get('email') or not data.get('message'):
-            return jsonify({"error": "Name, email, and message are required"}), 400
-        
-        name = data.get('name')
-        email = data.get('email')
-        message = data.get('message')
-        
-        # Create email content
-        email_content = f"""
-        <h2>New Feedback from CortexAI</h2>
-        <p><strong>From:</strong> {name} ({email})</p>
-        <p><strong>Message:</strong></p>
-        <p>{message.replace(chr(10), '<br>')}</p>
-        <hr>
-        <p><small>This feedback was sent via CortexAI feedback form.</small></p>
-        """
-        
-        # Create SendGrid message
-        message_obj = Mail(
-            from_email=SENDGRID_FROM_EMAIL,
-            to_emails=SENDGRID_FROM_EMAIL,  # Send to yourself
-            subject=f'CortexAI Feedback from {name}',
-            html_content=email_content
-        )
-        
-        # Also set reply-to as the sender's email
-        message_obj.reply_to = email
-        
-        # Send email
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message_obj)
-        
-        print(f"✅ Feedback email sent successfully (status: {response.status_code})")
-        
-        return jsonify({
-            "message": "Feedback sent successfully!",
-            "status": "success"
-        }), 200
-        
+        return {"lag_seconds": replica_router._check_lag(conn)}
+    finally:
+        conn.close()
+
+
+def load_revocations():
+    revocation_list.sync()
+    revocation_list.start()
+    return {"revoked_tokens": revocation_list.metrics()["revoked_tokens"]}
+
+
+def warm_up_worker():
+    """Open pool connections, build the default model and fill the /models cache before taking traffic.
+
+    Steps that fail are retried with exponential backoff until they all pass, so a transient
+    error at boot doesn't keep the worker out of rotation until it restarts.
+    """
+    warmup_state["started_at"] = datetime.now().isoformat()
+    delay = WARMUP_RETRY_SECONDS
+    while not run_warm_up():
+        print(f"🔁 Retrying failed warm-up steps in {delay:g}s")
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+
+
+def run_warm_up():
+    """One warm-up attempt over the steps that haven't passed yet; True once all have"""
+    warmup_state["status"] = "running"
+    warmup_state["attempts"] += 1
+    started = time.perf_counter()
+    steps = {
+        "database_pool": open_database_pools,
+        "database": ping_database,
+        "revocation_list": load_revocations,
+        "default_model": lambda: get_model(MODEL_NAME) and None,
+        "models_list": lambda: {"models": len(list_available_models(refresh=True))}
+    }
+    for name, step in steps.items():
+        if warmup_state["steps"].get(name, {}).get("status") != "ok":
+            warmup_state["steps"][name] = timed_check(step)
+    warmup_state["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    failed = [name for name, result in warmup_state["steps"].items() if result["status"] != "ok"]
+    warmup_state["status"] = "failed" if failed else "done"
+    print(f"{'⚠️ Warm-up finished with failures: ' + ', '.join(failed) if failed else '🔥 Worker warm-up complete'} ({warmup_state['duration_ms']} ms)")
+    return not failed
+
+
+def check_readiness():
+    """Per-dependency readiness, cached for READY_CACHE_SECONDS so frequent probes stay cheap"""
+    with readiness_lock:
+        cached = readiness_cache["result"]
+        if cached is not None and time.monotonic() - readiness_cache["checked_at"] < READY_CACHE_SECONDS:
+            return cached
+        checks = {
+            "database": timed_check(ping_database),
+            "model_backend": timed_check(ping_model_backend),
+            "queue": timed_check(queue_depth)
+        }
+        ready = warmup_state["status"] in ("done", "disabled") and all(check["status"] == "ok" for check in checks.values())
+        if replica_router is not None:
+            # Reported but not required: reads fall back to the primary when the replica is unhealthy
+            checks["database_replica"] = timed_check(ping_replica)
+        result = {
+            "status": "ready" if ready else "not_ready",
+            "timestamp": datetime.now().isoformat(),
+            "warmup": dict(warmup_state),
+            "checks": checks
+        }
+        readiness_cache["result"] = result
+        readiness_cache["checked_at"] = time.monotonic()
+        return result
+
+
+# Schema migrations run in every worker (gunicorn never executes __main__) before warm-up reads the tables
+if MIGRATE_ON_BOOT:
+    try:
+        init_db()
     except Exception as e:
-        print(f"❌ Error sending feedback: {str(e)}")
-        return jsonify({"error": f"Failed to send feedback: {str(e)}"}), 500
+        print(f"⚠️  Database initialization warning: {e}")
+
+if WARMUP_ON_BOOT:
+    threading.Thread(target=warm_up_worker, name='warm-up', daemon=True).start()
 
 
 @app.route('/health', methods=['GET'])
@@ -1321,6 +6345,26 @@ def health_check():
     })
 
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: warm-up state plus database, model backend and queue checks"""
+    try:
+        result = check_readiness()
+        return jsonify(result), 200 if result["status"] == "ready" else 503
+    except Exception as e:
+        return jsonify({"status": "not_ready", "error": str(e)}), 503
+
+
+@app.route('/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Per-worker runtime metrics"""
+    try:
+        return jsonify({name: source() for name, source in metrics_sources.items()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Endpoint not found"}), 404
@@ -1332,12 +6376,6 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
-    # Initialize database
-    try:
-        init_db()
-    except Exception as e:
-        print(f"⚠️  Database initialization warning: {e}")
-    
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('DEBUG', 'True').lower() == 'true'
     
@@ -1362,15 +6400,27 @@ if __name__ == '__main__':
     Chat Endpoints (All Protected):
     • POST   /chat                  - Send chat message
     • POST   /chat/stream           - Stream chat response
+    • POST   /chat/batch            - Batch prompts (NDJSON)
+    • GET    /chat/stream/:id       - Resume stream (Last-Event-ID)
+    • POST   /chat/stream/:id/cancel - Cancel stream
+    • WS     /chat/ws               - Multiplexed chat streams
     • GET    /conversations         - List conversations
+    • GET    /conversations/search  - Search messages (?q=)
+    • GET    /conversations/export  - Export conversations (NDJSON)
+    • POST   /conversations/import  - Import conversations (NDJSON)
     • POST   /conversations/new     - Create conversation
     • GET    /conversations/:id     - Get conversation
     • DELETE /conversations/:id     - Delete conversation
     • POST   /conversations/:id/clear - Clear conversation
     • GET    /models                - List available models
+    • GET    /usage                 - Today's usage and quota
+    • POST   /tts                   - Read a message aloud (WAV)
     
     Other:
     • GET    /health                - Health check
+    • GET    /ready                 - Readiness check
+    • GET    /admin/profiles        - Recent request profiles (admin)
+    • GET    /metrics               - Runtime metrics (admin)
     • POST   /api/feedback          - Send feedback via email
     
     Press Ctrl+C to stop the server
@@ -0,0 +1,32 @@
+"""Text-to-speech worker process for the /tts endpoint.
+
+pyttsx3 engines block while speaking and are not thread-safe, so Cortex runs
+them in a process pool with one engine per process. The pool processes are
+spawned, and they import only this module, not the Flask app.
+"""
+
+import pyttsx3
+
+engine = None
+engine_error = None
+
+
+def init_engine():
+    """Pool initializer: create this process's engine (errors are reported per call)"""
+    global engine, engine_error
+    try:
+        engine = pyttsx3.init()
+    except Exception as e:
+        engine_error = f"{type(e).__name__}: {e}"
+
+
+def synthesize(text, voice, rate, path):
+    """Speak text into a WAV file at path"""
+    if engine is None:
+        raise RuntimeError(f"Speech engine unavailable ({engine_error})")
+    engine.setProperty('rate', rate)
+    if voice:
+        engine.setProperty('voice', voice)
+    engine.save_to_file(text, path)
+    engine.runAndWait()
+    return path